@@ -0,0 +1,220 @@
+"""
+This module benchmarks loading, pivoting and estimation on synthetic data in a local database.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import click
+from datetime import datetime
+import json
+import logging
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.data_loading import INTERNAL_TEMPS_QUERY, get_day_window, get_internal_temps, get_time_bounds, _pivot_temps
+from src.lease_satisfied_estimator import YourEstimator
+from src.sensor_index import SensorQualityIndex
+from src.sensor_matrix import get_internal_temp_matrix
+from src.synthetic_data import generate_synthetic_data
+
+RESULT_COLUMNS = [
+    "seconds", "rows", "rows_per_sec", "peak_mb", "day_mean_ms", "day_p50_ms", "day_p95_ms", "day_max_ms"
+]
+
+
+def _measure(fn):
+    """
+    Run fn once, tracing memory allocations.
+    :return: tuple (result of fn, wall clock seconds, peak traced memory in MB)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+
+def _latencies(fn, dates):
+    """
+    Call fn(date) for every date, without tracing memory. fn returns the number of rows it processed, or None if
+    that is unknown.
+    :return: dict with the per day latencies in milliseconds, and the total number of rows fn processed.
+    """
+    seconds, rows = [], []
+    for date in dates:
+        start = time.perf_counter()
+        rows.append(fn(str(date)))
+        seconds.append(time.perf_counter() - start)
+    ms = 1000. * np.array(seconds)
+    return {
+        "seconds": float(ms.sum() / 1000.),
+        "rows": np.nan if None in rows else sum(rows),
+        "day_mean_ms": float(ms.mean()),
+        "day_p50_ms": float(np.percentile(ms, 50)),
+        "day_p95_ms": float(np.percentile(ms, 95)),
+        "day_max_ms": float(ms.max()),
+    }
+
+
+def run_benchmarks(db, building_id, start_date, end_date, latency_days):
+    """
+    :param db: an active sql engine holding the synthetic data
+    :param building_id: building to benchmark
+    :param start_date: first day of the range, date string
+    :param end_date: last day of the range, date string
+    :param latency_days: number of days (from start_date) to measure per day latencies over
+    :return: DataFrame indexed by stage with the RESULT_COLUMNS
+    """
+    results = {}
+    dates = pd.date_range(start_date, end_date)
+    range_start, _ = get_day_window(str(dates[0]))
+    _, range_end = get_day_window(str(dates[-1]))
+    range_start, range_end = str(range_start), str(range_end)
+    latency_dates = dates[:latency_days]
+
+    df, seconds, peak_mb = _measure(lambda: get_internal_temps(db, building_id, range_start, range_end))
+    results["load_range"] = {"seconds": seconds, "rows": int(df.count().sum()), "peak_mb": peak_mb}
+    results["load_day"] = _latencies(
+        lambda date: int(get_internal_temps(db, building_id, date, date).count().sum()), latency_dates
+    )
+
+    window_start, window_end = get_time_bounds(range_start, range_end)
+    params = {"building_id": building_id, "start_time": window_start, "end_time": window_end}
+    with db.connect() as conn:
+        rows = pd.read_sql(INTERNAL_TEMPS_QUERY, conn, params=params)
+    _, seconds, peak_mb = _measure(lambda: _pivot_temps(rows))
+    results["pivot_range"] = {"seconds": seconds, "rows": len(rows), "peak_mb": peak_mb}
+    del rows, df
+
+    matrix, seconds, peak_mb = _measure(
+        lambda: get_internal_temp_matrix(db, building_id, range_start, range_end)
+    )
+    results["matrix_range"] = {"seconds": seconds, "rows": int(matrix.mask.sum()), "peak_mb": peak_mb}
+
+    sensor_index, seconds, peak_mb = _measure(lambda: SensorQualityIndex(building_id).refresh(db))
+    results["sensor_index"] = {"seconds": seconds, "rows": int(sensor_index.sums["n"].sum()), "peak_mb": peak_mb}
+
+    estimator = YourEstimator(building_id, db=db, sensor_index=sensor_index)
+
+    def estimate_day(date):
+        window_start, window_end = get_day_window(date)
+        day = matrix.time_slice(window_start, window_end)
+        estimator.estimate_from_temps(day, date)
+        return int(day.mask.sum())
+
+    results["estimate_day"] = _latencies(estimate_day, latency_dates)
+
+    def compute_day(date):
+        estimator.compute_lease_satisfied_time(date)
+        return None
+
+    results["compute_day"] = _latencies(compute_day, latency_dates)
+
+    _, seconds, peak_mb = _measure(lambda: estimator.compute_lease_satisfied_times(start_date, end_date))
+    results["historical_range"] = {
+        "seconds": seconds,
+        "rows": results["matrix_range"]["rows"],
+        "peak_mb": peak_mb,
+        "day_mean_ms": 1000. * seconds / len(dates),
+    }
+
+    report = pd.DataFrame.from_dict(results, orient="index").reindex(columns=RESULT_COLUMNS)
+    report["rows_per_sec"] = report["rows"] / report["seconds"]
+    return report
+
+
+@click.command()
+@click.option(
+    "--db-url", default=None,
+    help="Database to generate the synthetic data in. Its tables are dropped! Defaults to a temporary SQLite file.",
+)
+@click.option("--skip-generate", is_flag=True, help="Benchmark the data already in --db-url.")
+@click.option("--buildings", default=1, show_default=True, help="Number of buildings.")
+@click.option("--sensors", default=100, show_default=True, help="Number of sensors per building.")
+@click.option("--days", default=90, show_default=True, help="Number of days of measurements.")
+@click.option("--start-date", default="2018-01-01", show_default=True)
+@click.option("--bad-data-rate", default=0.01, show_default=True, help="Fraction of readings flagged bad_data.")
+@click.option("--ignored-rate", default=0.05, show_default=True, help="Fraction of sensors flagged ignore.")
+@click.option("--latency-days", default=14, show_default=True, help="Number of days to measure per day latency over.")
+@click.option("--seed", default=0, show_default=True)
+@click.option(
+    "--results-file", default=None, type=click.Path(),
+    help="JSON lines file the results are appended to, to track them over time.",
+)
+def benchmark(db_url, skip_generate, buildings, sensors, days, start_date, bad_data_rate, ignored_rate,
+              latency_days, seed, results_file):
+    """
+    Generate synthetic data and report rows/sec, peak memory and per day latency of the loading, pivoting and
+    estimation stages. Peak memory is measured with tracemalloc and only counts allocations made by the stage.
+    """
+    tmp_dir = None
+    if db_url is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        db_url = "sqlite:///" + os.path.join(tmp_dir.name, "benchmark.db")
+    db = create_engine(db_url)
+    building_ids = list(range(1, buildings + 1))
+    end_date = str((pd.Timestamp(start_date) + pd.Timedelta(days=days - 1)).date())
+
+    settings = {
+        "buildings": buildings,
+        "sensors": sensors,
+        "days": days,
+        "start_date": start_date,
+        "bad_data_rate": bad_data_rate,
+        "ignored_rate": ignored_rate,
+        "seed": seed,
+        "dialect": db.dialect.name,
+    }
+    generated = None
+    if not skip_generate:
+        generated, seconds, peak_mb = _measure(
+            lambda: generate_synthetic_data(
+                db, building_ids, sensors, start_date, days, seed=seed, bad_data_rate=bad_data_rate,
+                ignored_rate=ignored_rate,
+            )
+        )
+        logging.info(
+            "Generated {} in {:.1f}s ({:.0f} rows/sec)".format(generated, seconds, generated["rows"] / seconds)
+        )
+
+    report = run_benchmarks(db, building_ids[0], start_date, end_date, latency_days)
+    click.echo(report.to_string(float_format=lambda x: "{:.3f}".format(x)))
+
+    if results_file:
+        record = {
+            "timestamp": datetime.utcnow().isoformat(),
+            "settings": settings,
+            "generated": generated,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "results": {
+                stage: {column: (None if pd.isna(value) else float(value)) for column, value in row.items()}
+                for stage, row in report.iterrows()
+            },
+        }
+        with open(results_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        logging.info("Appended results to {}".format(results_file))
+
+    db.dispose()
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    benchmark()
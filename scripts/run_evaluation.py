@@ -0,0 +1,89 @@
+"""
+This module compares variants of the lease satisfied estimation algorithm for all historical days in one pass.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import click
+from collections import OrderedDict
+from dotenv import load_dotenv, find_dotenv
+import logging
+import os
+import yaml
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.db import configure_from_config
+from src.evaluation import DEFAULT_VARIANTS, evaluate_building, summarize_agreement
+from src.measurement_cache import MeasurementCache
+from src.sensor_index import get_sensor_index
+
+load_dotenv(find_dotenv(), verbose=True)
+
+
+def _get_variants(config):
+    """
+    Variants from the optional `evaluation_variants` section of a run config, e.g.
+        evaluation_variants:
+          pred2: {aggregator: mean, sensors: relevant}
+          median_all: {aggregator: quantile, sensors: all, q: 0.5}
+    :param config: dict parsed from config.yml
+    :return: dict of variant name to (aggregator name, params), DEFAULT_VARIANTS if the section is missing.
+    """
+    if not config.get("evaluation_variants"):
+        return DEFAULT_VARIANTS
+    variants = OrderedDict()
+    for name, params in config["evaluation_variants"].items():
+        params = dict(params)
+        variants[name] = (params.pop("aggregator"), params)
+    return variants
+
+
+@click.command()
+@click.argument("config_file", type=click.Path(exists=True))
+@click.option(
+    "--output-dir", default=None, type=click.Path(),
+    help="Directory to write the tables to. Defaults to the evaluation directory in the error directory.",
+)
+@click.option("--reference", default="pred2", show_default=True, help="Variant the others are compared with.")
+def evaluate_variants(config_file, output_dir, reference):
+    """
+    Run all variants over the days of the config, loading every building-day once, and write per building a wide
+    table with the lease satisfied time of every variant and a summary of their agreement with the reference.
+    :param config_file: run config, see example_config.yml
+    :param output_dir:
+    :param reference:
+    :return:
+    """
+    with open(config_file, "rb") as f:
+        config = yaml.safe_load(f)
+    configure_from_config(config)
+    variants = _get_variants(config)
+    if reference not in variants:
+        raise click.BadParameter("{} is not one of the variants {}".format(reference, list(variants)))
+    if output_dir is None:
+        output_dir = os.path.join(config["error_analysis_dir"], "evaluation")
+    os.makedirs(output_dir, exist_ok=True)
+    cache = MeasurementCache(config["cache_dir"]) if config.get("cache_dir") else None
+
+    for building_id in config["buildings"]:
+        if cache is not None:
+            cache.refresh(None, building_id)
+        sensor_index = None
+        if config.get("sensor_index_dir"):
+            sensor_index = get_sensor_index(config["sensor_index_dir"], building_id)
+        logging.info("Evaluating {} variants for building = {}".format(len(variants), building_id))
+        df = evaluate_building(
+            building_id, config["start_date"], config["end_date"], variants=variants, cache=cache,
+            sensor_index=sensor_index,
+        )
+        df.to_csv(os.path.join(output_dir, "evaluation_{}.csv".format(building_id)))
+        summary = summarize_agreement(df, reference)
+        summary.to_csv(os.path.join(output_dir, "agreement_{}.csv".format(building_id)))
+        click.echo("Building {}\n{}".format(building_id, summary.to_string()))
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    evaluate_variants()
@@ -4,33 +4,51 @@ This module runs the lease satisfied estimation algorithm for all historical day
 :author: Sourav Dey <sdey@manifold.ai>
 """
 import click
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv, find_dotenv
+import glob
 import logging
 import os
 import pandas as pd
+import shutil
+import tempfile
+import time
 import yaml
 import sys
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
-from src.lease_satisfied_estimator import YourEstimator, operatingDayCheck, getPred1, getPred2
+from src.lease_satisfied_estimator import (
+    DEFAULT_CHUNK_DAYS,
+    YourEstimator,
+    operatingDayCheck,
+    getPred1,
+    getPred2,
+)
 from src.data_loading import get_internal_temps
+from src.checkpoints import CheckpointStore, get_day_fingerprints, get_estimator_key
+from src.db import configure, configure_from_config, get_pool_stats, get_settings
+from src.estimators import make_estimator, refresh_local_stores
+from src.instrumentation import Metrics, merge_profiles, profile, reset_metrics, write_metrics
+from src.prefetch import run_prefetched
 
 load_dotenv(find_dotenv(), verbose=True)
 
-def _parse_config_and_setup_directory(config_file):
+def _parse_config_and_setup_directory(config_file, resume=False, overwrite=False):
     """
     Helper function to parse config file and setup the directory structure of the error directory.
     :param config_file:
+    :param resume: keep an existing error directory without asking, to continue from its checkpoints.
+    :param overwrite: overwrite an existing error directory without asking.
     :return:
     """
     with open(config_file, "rb") as f:
-        config = yaml.load(f)
+        config = yaml.safe_load(f)
 
     # Create error output directory
     if not os.path.exists(config["error_analysis_dir"]):
         os.makedirs(config["error_analysis_dir"])
-    else:
+    elif not (resume or overwrite):
         choice = input(
             "Directory {} exists. Do you want to overwrite? (Hit y to overwrite, any other key to abort): ".format(
                 config["error_analysis_dir"]
@@ -47,44 +65,304 @@ def _parse_config_and_setup_directory(config_file):
     return config
 
 
+def _make_shards(config, shard_days, pending=None):
+    """
+    Split the run into (building_id, start_date, end_date) shards of at most shard_days consecutive days.
+    :param config: run config
+    :param shard_days: number of days per shard
+    :param pending: optional dict of building_id to the DatetimeIndex of the days to compute. All days if None.
+    :return: list of shards in building, date order
+    """
+    dates = pd.date_range(start=config["start_date"], end=config["end_date"])
+    shards = []
+    for building_id in config["buildings"]:
+        building_dates = dates if pending is None else pending[building_id]
+        # Split into runs of consecutive days first, shards never span a gap.
+        run_ids = (building_dates.to_series().diff() != pd.Timedelta(days=1)).cumsum().values
+        for run_id in pd.unique(run_ids):
+            run_dates = building_dates[run_ids == run_id]
+            for i in range(0, len(run_dates), shard_days):
+                shard_dates = run_dates[i:i + shard_days]
+                shards.append((building_id, str(shard_dates[0].date()), str(shard_dates[-1].date())))
+    return shards
+
+
+def _make_estimator(db_settings, config, building_id):
+    """
+    Set up the database settings of this process and create the estimator of a building.
+    :param db_settings: database settings of the parent process, see src.db.get_settings
+    :param config: run config
+    :return: the estimator
+    """
+    if get_settings() != db_settings:
+        db_settings = dict(db_settings)
+        url = db_settings.pop("url")
+        configure(url, **db_settings)
+    return make_estimator(config, building_id)
+
+
+def _profile_prefix(profile_dir, shard):
+    """
+    :return: path prefix of the profile of a shard in profile_dir, None if profile_dir is None.
+    """
+    if profile_dir is None:
+        return None
+    building_id, start_date, _ = shard
+    return os.path.join(profile_dir, "{}_{}".format(building_id, start_date))
+
+
+def _estimate_shard(db_settings, config, building_id, start_date, end_date, prefetch=0, profile_prefix=None):
+    """
+    Estimate the lease satisfied times of one shard. Runs in a worker process when --workers > 1.
+    :param db_settings: database settings of the parent process, see src.db.get_settings
+    :param config: run config
+    :param prefetch: number of chunks to prefetch while estimating, 0 runs fetch and estimation in turn.
+    :param profile_prefix: if given, the shard runs under cProfile and its stats go to profile_prefix.prof.
+    :return: tuple (DataFrame of the shard in the format of the output CSV, dict of the metrics of the shard)
+    """
+    if profile_prefix is not None:
+        return profile(
+            lambda: _estimate_shard(db_settings, config, building_id, start_date, end_date, prefetch=prefetch),
+            profile_prefix,
+        )
+    metrics = reset_metrics()
+    me = _make_estimator(db_settings, config, building_id)
+    if prefetch:
+        results, failures = run_prefetched([(me, start_date, end_date)], prefetch, chunk_days=DEFAULT_CHUNK_DAYS)
+        if failures:
+            raise failures[0]
+        df = results[0]
+    else:
+        df = me.compute_lease_satisfied_times(start_date, end_date, chunk_days=DEFAULT_CHUNK_DAYS)
+    return df, metrics.to_dict()
+
+
+def _run_shards_prefetched(shards, prefetch, db_settings, config, metrics, on_result):
+    """
+    Run all shards in this process as one pipeline, so the next chunks are fetched while the current one is
+    estimated, also across shards.
+    :return: Same as _run_shards.
+    """
+    shard_metrics = reset_metrics()
+    estimators = {}
+    tasks = []
+    for building_id, start_date, end_date in shards:
+        if building_id not in estimators:
+            estimators[building_id] = _make_estimator(db_settings, config, building_id)
+        tasks.append((estimators[building_id], start_date, end_date))
+    task_results, task_failures = run_prefetched(
+        tasks, prefetch, chunk_days=DEFAULT_CHUNK_DAYS, on_result=lambda i, df: on_result(shards[i], df)
+    )
+    metrics.merge(shard_metrics)
+
+    results, failures = {}, {}
+    for i, shard in enumerate(shards):
+        if i in task_failures:
+            logging.error("Shard {} failed: {!r}".format(shard, task_failures[i]))
+            failures[shard] = task_failures[i]
+        else:
+            results[shard] = task_results[i]
+    return results, failures
+
+
+def _run_shards(shards, workers, db_settings, config, metrics, on_result, prefetch=0, profile_dir=None):
+    """
+    Run all shards, serially in this process or on a pool of worker processes. Every worker process creates its own
+    database engine. A failing shard is logged and reported back without stopping the other shards.
+    :param metrics: Metrics the metrics of the shards are merged into
+    :param on_result: function called with (shard, DataFrame) in this process as soon as a shard is done.
+    :param prefetch: number of chunks to prefetch while estimating, 0 runs fetch and estimation in turn.
+    :param profile_dir: if given, every shard runs under cProfile and writes its stats into this directory, see
+    _profile_prefix. Not supported together with prefetch, whose fetches run in other threads.
+    :return: tuple (results, failures) of dicts keyed by shard with DataFrames and exceptions respectively
+    """
+    results, failures = {}, {}
+    if workers <= 1 and prefetch:
+        return _run_shards_prefetched(shards, prefetch, db_settings, config, metrics, on_result)
+    if workers <= 1:
+        for i, shard in enumerate(shards):
+            try:
+                results[shard], shard_metrics = _estimate_shard(
+                    dict(db_settings), config, *shard, profile_prefix=_profile_prefix(profile_dir, shard)
+                )
+                metrics.merge(shard_metrics)
+                on_result(shard, results[shard])
+            except Exception as e:
+                logging.exception("Shard {} failed".format(shard))
+                failures[shard] = e
+            logging.info("Finished shard {}/{}: {}".format(i + 1, len(shards), shard))
+        return results, failures
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                _estimate_shard, dict(db_settings), config, *shard, prefetch=prefetch,
+                profile_prefix=_profile_prefix(profile_dir, shard)
+            ): shard
+            for shard in shards
+        }
+        for i, future in enumerate(as_completed(futures)):
+            shard = futures[future]
+            try:
+                results[shard], shard_metrics = future.result()
+                metrics.merge(shard_metrics)
+                on_result(shard, results[shard])
+            except Exception as e:
+                logging.error("Shard {} failed: {!r}".format(shard, e))
+                failures[shard] = e
+            logging.info("Finished shard {}/{}: {}".format(i + 1, len(shards), shard))
+    return results, failures
+
+
 @click.command()
 @click.argument("config_file", type=click.Path(exists=True))
-def estimate_lease_satisfied_times(config_file):
+@click.option("--workers", default=1, show_default=True, help="Number of worker processes.")
+@click.option(
+    "--shard-days", default=DEFAULT_CHUNK_DAYS, show_default=True, help="Number of days per unit of work."
+)
+@click.option(
+    "--prefetch", default=0, show_default=True,
+    help="Number of chunks of days fetched ahead while estimating. Bounds memory. 0 fetches and estimates in turn.",
+)
+@click.option(
+    "--profile", "profile_hottest", is_flag=True,
+    help="Run every shard under cProfile and write the profile of the building that took longest to "
+         "profile_building_<id>.prof/.txt. Not with --prefetch.",
+)
+@click.option(
+    "--resume", is_flag=True,
+    help="Keep the checkpoints of an earlier run in the error directory and only compute missing or stale days. "
+         "Start a run with --resume to be able to resume it.",
+)
+@click.option("--overwrite", is_flag=True, help="Overwrite an existing error directory without asking.")
+def estimate_lease_satisfied_times(config_file, workers, shard_days, prefetch, profile_hottest, resume, overwrite):
     """
     Main function that estimates lease satisfied times for all historical days for all buildings.
     :param config_file:
+    :param workers: number of worker processes, 1 runs everything in this process
+    :param shard_days: number of days per (building, date range) shard
+    :param prefetch: queue depth of the fetch / estimate pipeline, 0 for the serial loop
+    :param profile_hottest: whether to profile the building with the most wall clock time
+    :param resume: whether to continue from the checkpoints in the error directory
+    :param overwrite: whether to start over in an existing error directory without asking
     :return:
     """
-    config = _parse_config_and_setup_directory(config_file)
+    run_start, run_cpu = time.perf_counter(), time.process_time()
+    if resume and overwrite:
+        raise click.UsageError("--resume and --overwrite are mutually exclusive")
+    if profile_hottest and prefetch:
+        raise click.UsageError("--profile and --prefetch are mutually exclusive, prefetched fetches run in threads")
+    config = _parse_config_and_setup_directory(config_file, resume=resume, overwrite=overwrite)
+    configure_from_config(config)
+    for building_id in config["buildings"]:
+        refreshed = refresh_local_stores(config, building_id)
+        if refreshed["new_rows"] is not None:
+            logging.info(
+                "Refreshed measurement cache for building = {} with {} new or changed rows".format(
+                    building_id, refreshed["new_rows"]
+                )
+            )
+        if refreshed["relevant_sensors"] is not None:
+            logging.info(
+                "Refreshed sensor index for building = {}, {} relevant sensors".format(
+                    building_id, len(refreshed["relevant_sensors"])
+                )
+            )
+        if refreshed["rollup_days"] is not None:
+            logging.info(
+                "Refreshed rollup for building = {}, {} days rolled up".format(building_id, refreshed["rollup_days"])
+            )
+
+    metrics = Metrics()
+    store = CheckpointStore(os.path.join(config["error_analysis_dir"], "checkpoints.jsonl"))
+    if not resume:
+        store.clear()
     dates = pd.date_range(start=config["start_date"], end=config["end_date"])
+    fingerprints, estimator_keys, pending = {}, {}, {}
     for building_id in config["buildings"]:
+        estimator_keys[building_id] = get_estimator_key(_make_estimator(get_settings(), config, building_id))
+        if not resume:
+            # Fingerprinting reads every day of the run and only finds the days to resume. Days checkpointed
+            # without a fingerprint are computed again by a later --resume.
+            fingerprints[building_id] = {}
+            continue
+        with metrics.stage("fingerprint", building_id) as counters:
+            fingerprints[building_id] = get_day_fingerprints(None, building_id, dates)
+            counters["rows"] = len(dates)
+        pending[building_id] = store.pending_dates(
+            building_id, dates, fingerprints[building_id], estimator_keys[building_id]
+        )
         logging.info(
-            "Estimating lease obligation satisfied times for building = {}".format(
-                building_id
+            "Building = {}: {} of {} days checkpointed and up to date, {} to compute".format(
+                building_id, len(dates) - len(pending[building_id]), len(dates), len(pending[building_id])
             )
         )
-        me = YourEstimator(building_id=building_id)
-        df_dict = {}
-        for date in dates:
-            logging.debug(
-                "Estimating for building = {}, date = {}".format(building_id, date)
+
+    def checkpoint(shard, df):
+        building_id = shard[0]
+        store.append(df, fingerprints[building_id], estimator_keys[building_id])
+
+    shards = _make_shards(config, shard_days, pending if resume else None)
+    logging.info(
+        "Estimating lease obligation satisfied times for buildings = {} in {} shards on {} worker(s)".format(
+            config["buildings"], len(shards), workers
+        )
+    )
+    # Profiles of all shards, only the ones of the building that took longest are kept.
+    profile_dir = tempfile.mkdtemp(dir=config["error_analysis_dir"]) if profile_hottest else None
+    _, failures = _run_shards(
+        shards, workers, get_settings(), config, metrics, checkpoint, prefetch=prefetch, profile_dir=profile_dir
+    )
+
+    for building_id in config["buildings"]:
+        # Checkpointed days of earlier runs and the days computed now.
+        lease_satisfied_time_df = store.results(building_id, dates)
+        if lease_satisfied_time_df.empty:
+            logging.error("No results for building = {}, not writing a CSV".format(building_id))
+            continue
+        logging.debug(lease_satisfied_time_df)
+        with metrics.stage("csv", building_id) as counters:
+            lease_satisfied_time_df.to_csv(
+                os.path.join(
+                    config["error_analysis_dir"],
+                    "lease_obligation_satisfied_times_{}.csv".format(building_id),
+                )
             )
-            operating, lease_satisfied_time = me.compute_lease_satisfied_time(str(date))
-            df_dict[str(date)] = {
-                "building_id": building_id,
-                "operating": operating,
-                "lease_satisfied_time": lease_satisfied_time,
-            }
-            logging.debug(df_dict[str(date)])
-
-        lease_satisfied_time_df = pd.DataFrame.from_dict(df_dict, orient="index")
-        lease_satisfied_time_df.to_csv(
-            os.path.join(
-                config["error_analysis_dir"],
-                "lease_obligation_satisfied_times_{}.csv".format(building_id),
+            counters["rows"] = len(lease_satisfied_time_df)
+        logging.info("Wrote CSV for building = {}".format(building_id))
+    logging.info("Database pool stats: {}".format(get_pool_stats()))
+
+    if profile_dir is not None:
+        building_seconds = metrics.building_seconds()
+        hottest = max(building_seconds, key=building_seconds.get) if building_seconds else None
+        # Failed shards have no profile.
+        paths = sorted(glob.glob(os.path.join(profile_dir, "{}_*.prof".format(hottest))))
+        if paths:
+            path_prefix = os.path.join(config["error_analysis_dir"], "profile_building_{}".format(hottest))
+            logging.info("Writing the profile of building = {} ({:.1f}s) to {}.prof".format(
+                hottest, building_seconds[hottest], path_prefix
+            ))
+            merge_profiles(paths, path_prefix)
+        shutil.rmtree(profile_dir)
+
+    write_metrics(
+        os.path.join(config["error_analysis_dir"], "metrics.json"),
+        metrics,
+        wall_seconds=time.perf_counter() - run_start,
+        cpu_seconds=time.process_time() - run_cpu,
+        workers=workers,
+        prefetch=prefetch,
+        shards=len(shards),
+        failed_shards=len(failures),
+        pool_stats=get_pool_stats(),
+    )
+
+    if failures:
+        raise click.ClickException(
+            "{} of {} shards failed, their days are missing from the CSVs: {}".format(
+                len(failures), len(shards), sorted(failures)
             )
         )
-        logging.info("Wrote CSV for building = {}".format(building_id))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+"""
+This module runs a long running local service that answers lease satisfied time queries, see src/service.py.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import click
+from dotenv import load_dotenv, find_dotenv
+import logging
+import os
+import threading
+import yaml
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from src.db import configure_from_config
+from src.result_cache import ResultCache
+from src.service import EstimationService, make_server
+
+load_dotenv(find_dotenv(), verbose=True)
+
+
+def _refresh_periodically(service, interval, stopped):
+    """
+    Refresh the local stores and fingerprints of the service every interval seconds until stopped is set.
+    :param service: EstimationService
+    :param interval: seconds between refreshes
+    :param stopped: threading.Event
+    """
+    while not stopped.wait(interval):
+        try:
+            if service.refresh():
+                logging.info("Local stores or data changed since the last refresh")
+        except Exception:
+            logging.exception("Refreshing the local stores failed, serving from the old ones")
+
+
+@click.command()
+@click.argument("config_file", type=click.Path(exists=True))
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address to listen on.")
+@click.option("--port", default=8080, show_default=True, help="Port to listen on.")
+@click.option("--socket", "socket_path", default=None, type=click.Path(), help="Listen on this Unix socket instead.")
+@click.option(
+    "--result-cache", default=None, type=click.Path(),
+    help="SQLite file to keep results in across restarts. In memory only if not given.",
+)
+@click.option("--warm-days", default=0, show_default=True, help="Number of recent days to estimate at startup.")
+@click.option(
+    "--refresh-interval", default=300, show_default=True,
+    help="Seconds between refreshes of the local stores of the config and of the fingerprints of the days served, "
+         "which new readings are picked up with. 0 to never refresh.",
+)
+def serve_estimates(config_file, host, port, socket_path, result_cache, warm_days, refresh_interval):
+    """
+    Serve the lease satisfied times of the buildings of a run config:
+        GET /estimate?building_id=1&date=2018-03-05
+        GET /estimates?building_id=1&start_date=2018-03-01&end_date=2018-03-31
+        POST /estimates with {"queries": [{"building_id": 1, "date": "2018-03-05"}, ...]}
+        GET /stats for the request latencies, cache hit rates and database pool statistics.
+    :param config_file: run config, see example_config.yml
+    :param host:
+    :param port:
+    :param socket_path:
+    :param result_cache:
+    :param warm_days:
+    :param refresh_interval:
+    :return:
+    """
+    with open(config_file, "rb") as f:
+        config = yaml.safe_load(f)
+    configure_from_config(config)
+    service = EstimationService(config, result_cache=ResultCache(result_cache))
+    service.refresh()
+    service.warm(days=warm_days, end_date=config.get("end_date"))
+    logging.info("Warmed up {} buildings".format(len(service.stats()["buildings"])))
+
+    stopped = threading.Event()
+    if refresh_interval:
+        threading.Thread(
+            target=_refresh_periodically, args=(service, refresh_interval, stopped), daemon=True
+        ).start()
+    server = make_server(service, host=host, port=port, socket_path=socket_path)
+    logging.info("Serving on {}".format(socket_path or "http://{}:{}".format(*server.server_address[:2])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+        service.result_cache.close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    log_fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    serve_estimates()
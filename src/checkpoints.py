@@ -0,0 +1,227 @@
+"""
+This module houses the checkpoints of the historical runs: the result of every completed (building, date) together
+with what it was computed from, so that an interrupted or repeated run only recomputes missing or stale days.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pandas as pd
+from sqlalchemy import DateTime, text
+from .data_loading import get_day_window, values_rows
+from .db import get_engine
+
+# Number of days fingerprinted per query.
+FINGERPRINT_CHUNK_DAYS = 100
+
+# Filled in with one VALUES row per window.
+WINDOW_FINGERPRINT_QUERY = (
+    "WITH windows (window_start, window_end) AS (VALUES {windows}) "
+    # measurement is a real, summed as one the total of a day is only good to a few thousandths and depends on the
+    # order of the rows.
+    "SELECT w.window_start, COUNT(*) as n_rows, MAX(f1.measured_at) as last_time, "
+    "SUM(CAST(f1.measurement AS DOUBLE PRECISION)) as total "
+    "FROM windows w "
+    "JOIN floor_temperature_measurements f1 ON f1.measured_at >= w.window_start AND f1.measured_at <= w.window_end "
+    "JOIN building_sensor_configs b2 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False "
+    "GROUP BY w.window_start"
+)
+
+RESULT_COLUMNS = ["building_id", "operating", "lease_satisfied_time"]
+
+
+class CheckpointStore:
+    """
+    Append only JSON lines file of (building, date) results. Every record carries the fingerprint of the day's data
+    and the key of the estimator it was computed with, the last record of a (building, date) wins. A line torn by a
+    crash is ignored.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the JSON lines file. Created on the first append.
+        """
+        self.path = path
+        self._records = None
+
+    def records(self):
+        """
+        :return: dict of (building_id, date string) to the last record stored for it.
+        """
+        if self._records is None:
+            self._records = {}
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        self._records[(record["building_id"], record["date"])] = record
+        return self._records
+
+    def append(self, df, fingerprints, estimator_key):
+        """
+        Store the results of a run of days and flush them to disk.
+        :param df: DataFrame in the format of compute_lease_satisfied_times
+        :param fingerprints: dict of date string to the fingerprint of the day, see get_day_fingerprints. Days
+        without one are stored as never up to date.
+        :param estimator_key: see get_estimator_key
+        """
+        records = self.records()
+        torn = not _ends_with_newline(self.path)
+        with open(self.path, "a") as f:
+            if torn:
+                # Start after a line torn by a crash, not on it.
+                f.write("\n")
+            for date, row in df.iterrows():
+                lease_satisfied_time = row["lease_satisfied_time"]
+                record = {
+                    "building_id": int(row["building_id"]),
+                    "date": date,
+                    "operating": None if pd.isna(row["operating"]) else bool(row["operating"]),
+                    # Timestamps are stored as they are written to the CSVs.
+                    "lease_satisfied_time": None if _is_missing(lease_satisfied_time) else str(lease_satisfied_time),
+                    "fingerprint": fingerprints.get(date),
+                    "estimator": estimator_key,
+                }
+                f.write(json.dumps(record) + "\n")
+                records[(record["building_id"], date)] = record
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending_dates(self, building_id, dates, fingerprints, estimator_key):
+        """
+        :param dates: DatetimeIndex of the days of the run
+        :return: DatetimeIndex of the days that have no result, or whose data or estimator changed since.
+        """
+        records = self.records()
+        pending = []
+        for date in dates:
+            record = records.get((building_id, str(date)))
+            if (
+                record is None
+                or record["estimator"] != estimator_key
+                or record["fingerprint"] != fingerprints.get(str(date))
+            ):
+                pending.append(date)
+        return pd.DatetimeIndex(pending)
+
+    def results(self, building_id, dates):
+        """
+        :return: DataFrame in the format of compute_lease_satisfied_times with the stored results of the days that
+        have one.
+        """
+        records = self.records()
+        df_dict = OrderedDict()
+        for date in dates:
+            record = records.get((building_id, str(date)))
+            if record is not None:
+                df_dict[str(date)] = {column: record[column] for column in RESULT_COLUMNS}
+        return pd.DataFrame.from_dict(df_dict, orient="index").reindex(columns=RESULT_COLUMNS)
+
+    def clear(self):
+        """
+        Drop all checkpoints.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._records = {}
+
+
+def get_estimator_key(estimator):
+    """
+    :return: string identifying the estimator class, version and parameters.
+    """
+    params = json.dumps(estimator.get_params(), sort_keys=True)
+    return "{}:{}:{}".format(
+        type(estimator).__name__, estimator.version, hashlib.sha1(params.encode("utf-8")).hexdigest()[:16]
+    )
+
+
+def get_day_fingerprints(db, building_id, dates):
+    """
+    Fingerprint the data every day's estimate is computed from: the number of readings, the last measured_at and the
+    sum of the measurements in the day window, after the same filters as get_internal_temps. Late readings, changed
+    values and changed bad_data or ignore flags all change it.
+    :param db: an active sql engine, or None for the shared engine.
+    :param building_id: integer
+    :param dates: DatetimeIndex of days
+    :return: dict of date string to fingerprint string. Days without readings get "0".
+    """
+    windows = pd.DataFrame([get_day_window(str(date)) for date in dates], columns=["window_start", "window_end"])
+    return dict(zip(
+        [str(date) for date in dates], get_window_fingerprints(db, building_id, windows).values()
+    ))
+
+
+def get_whole_day_windows(days):
+    """
+    :param days: DatetimeIndex of days
+    :return: DataFrame with the window_start and window_end (both inclusive) of the whole of every day, from
+    midnight to the last microsecond before the next midnight, see get_window_fingerprints.
+    """
+    days = pd.DatetimeIndex(days)
+    return pd.DataFrame({
+        "window_start": days,
+        "window_end": days + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1),
+    }, columns=["window_start", "window_end"])
+
+
+def get_window_fingerprints(db, building_id, windows):
+    """
+    Same as get_day_fingerprints for arbitrary windows.
+    :param db: an active sql engine, or None for the shared engine.
+    :param building_id: integer
+    :param windows: DataFrame with the naive UTC window_start and window_end (both inclusive) of windows with distinct
+    starts
+    :return: OrderedDict of window_start string to fingerprint string, in the order of windows.
+    """
+    if db is None:
+        db = get_engine()
+    fingerprints = OrderedDict((str(pd.Timestamp(start)), "0") for start in windows["window_start"])
+    with db.connect() as conn:
+        for i in range(0, len(windows), FINGERPRINT_CHUNK_DAYS):
+            rows, bindparams, params = values_rows(
+                windows.iloc[i:i + FINGERPRINT_CHUNK_DAYS],
+                OrderedDict([("window_start", DateTime), ("window_end", DateTime)]),
+            )
+            params["building_id"] = building_id
+            query = text(WINDOW_FINGERPRINT_QUERY.format(windows=rows)).bindparams(*bindparams)
+            for row in pd.read_sql(query, conn, params=params).itertuples(index=False):
+                fingerprints[str(pd.Timestamp(row.window_start))] = format_fingerprint(
+                    row.n_rows, row.last_time, row.total
+                )
+    return fingerprints
+
+
+def format_fingerprint(n_rows, last_time, total):
+    """
+    :param n_rows: number of readings
+    :param last_time: time of the last reading
+    :param total: sum of the readings
+    :return: fingerprint string of the readings of a window, "0" if there are none.
+    """
+    if not n_rows:
+        return "0"
+    # Rounded, the order the database adds the measurements up in is not fixed. Summed in double precision, the
+    # rounding errors are far below the last digit kept.
+    return "{}|{}|{:.3f}".format(n_rows, pd.Timestamp(last_time), total)
+
+
+def _ends_with_newline(path):
+    """
+    :return: whether the file at path is missing, empty or ends with a newline.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return True
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _is_missing(value):
+    return value is None or (not isinstance(value, str) and pd.isna(value))
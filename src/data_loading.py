@@ -3,75 +3,185 @@ This module houses helper functions to access the sensor time series data and le
 :copyright: Cortex
 :author: Sourav Dey <sdey@manifold.ai>
 """
+from collections import OrderedDict
 from datetime import timedelta, datetime
 from dateutil.parser import parse
 from dateutil import tz
 import pandas as pd
+from sqlalchemy import DateTime, bindparam, text
+from .db import get_engine
+from .instrumentation import get_metrics
 
 
-def get_internal_temps(db, building_id, start_time, end_time):
+# Rows fetched per round trip from the server side cursor in iter_internal_temps.
+DEFAULT_CHUNKSIZE = 50000
+
+INTERNAL_TEMPS_QUERY = text(
+    "SELECT f1.measured_at as time, f1.measurement as temperature, b2.id as sensor_id "
+    "FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False "
+    "and f1.measured_at >= :start_time AND f1.measured_at <= :end_time "
+    "ORDER BY f1.measured_at"
+).bindparams(bindparam("start_time", type_=DateTime), bindparam("end_time", type_=DateTime))
+
+
+# Filled in with one VALUES row per fetch window. The windows must not overlap.
+WINDOWED_INTERNAL_TEMPS_QUERY = (
+    "WITH windows (fetch_start, fetch_end) AS (VALUES {windows}) "
+    "SELECT f1.measured_at as time, f1.measurement as temperature, b2.id as sensor_id "
+    "FROM windows w "
+    "JOIN floor_temperature_measurements f1 ON f1.measured_at >= w.fetch_start AND f1.measured_at <= w.fetch_end "
+    "JOIN building_sensor_configs b2 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False "
+    "ORDER BY f1.measured_at"
+)
+
+
+def get_internal_temps(db, building_id, start_time, end_time, chunksize=DEFAULT_CHUNKSIZE, cache=None):
     """
     Get a portion of all the internal temperature time series for a building.
-    :param db: an active sql engine - ex. `db = create_engine(os.environ["HW_DATABASE_URL"])`
+    :param db: an active sql engine - ex. `db = create_engine(os.environ["HW_DATABASE_URL"])`. None uses the shared
+    engine from `db.get_engine()`.
     :param building_id: integer
     :param start_time: start time string - 'yyyy-dd-mm' treated differently than 'yyyy-dd-mm hh:mm:ss'
     :param end_time: end time string - 'yyyy-dd-mm' treated differently than 'yyyy-dd-mm hh:mm:ss'
+    :param chunksize: number of rows fetched and pivoted at a time.
+    :param cache: optional MeasurementCache to read from instead of the database. It is not refreshed here.
     :return: DataFrame with time as index and columns as internal temperature sensors.
     """
-    #Need to create the SQL query. But that depends on a number of ways that the dates are input.
+    if cache is not None:
+        return cache.get_internal_temps(building_id, start_time, end_time)
+    frames = list(iter_internal_temps(db, building_id, start_time, end_time, chunksize=chunksize))
+    if not frames:
+        return _pivot_temps(pd.DataFrame(columns=["time", "temperature", "sensor_id"]))
+    df = pd.concat(frames, sort=False).sort_index(axis=1)
+    df.columns.name = "sensor_id"
+    return df
+
+
+def iter_internal_temps(db, building_id, start_time, end_time, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Stream the internal temperature time series for a building as wide frames. Rows are read from a server side
+    cursor chunksize at a time and pivoted as they arrive, so only one chunk of long format rows is held in memory.
+    Every timestamp ends up in exactly one of the yielded frames, and the frames come in time order. Fetching,
+    decoding and pivoting are timed as the "sql", "decode" and "pivot" stages of the process' metrics.
+    :param db: an active sql engine, or None for the shared engine.
+    :param building_id: integer
+    :param start_time: start time string, see get_internal_temps
+    :param end_time: end time string, see get_internal_temps
+    :param chunksize: number of rows fetched and pivoted at a time.
+    :return: generator of DataFrames with time as index and columns as internal temperature sensors.
     """
-    The gnarly bit of code that follows is largely because the query strings differ between test_*.py and run_historical_estimation.py,
-    and rather than alter your code (because I wasn't sure if you would test my functions with other code snippets) I wrote a series
-    of if statements to respond to the different submission types.
+    window_start, window_end = get_time_bounds(start_time, end_time)
+    params = {"building_id": building_id, "start_time": window_start, "end_time": window_end}
+    return _iter_pivoted(db, building_id, INTERNAL_TEMPS_QUERY, params, chunksize)
+
+
+def iter_internal_temps_in_windows(db, building_id, windows, chunksize=DEFAULT_CHUNKSIZE):
     """
-    #Determining if range is one day, or a date range
+    Same as iter_internal_temps, but only the readings within a set of time windows are fetched, in a single query.
+    :param db: an active sql engine, or None for the shared engine.
+    :param building_id: integer
+    :param windows: DataFrame with the naive UTC fetch_start and fetch_end (both inclusive) of non overlapping windows
+    :param chunksize: number of rows fetched and pivoted at a time.
+    :return: generator of DataFrames with time as index and columns as internal temperature sensors.
+    """
+    if windows.empty:
+        return iter([])
+    rows, bindparams, params = values_rows(windows, OrderedDict([("fetch_start", DateTime), ("fetch_end", DateTime)]))
+    params["building_id"] = building_id
+    query = text(WINDOWED_INTERNAL_TEMPS_QUERY.format(windows=rows)).bindparams(*bindparams)
+    return _iter_pivoted(db, building_id, query, params, chunksize)
+
+
+def _iter_pivoted(db, building_id, query, params, chunksize):
+    if db is None:
+        db = get_engine()
+    metrics = get_metrics()
+    with db.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        with metrics.stage("sql", building_id):
+            result = conn.execute(query, params)
+            columns = list(result.keys())
+        carry = None
+        while True:
+            with metrics.stage("sql", building_id) as counters:
+                records = result.fetchmany(chunksize)
+                counters["rows"] = len(records)
+            if not records:
+                break
+            with metrics.stage("decode", building_id) as counters:
+                chunk = pd.DataFrame.from_records(records, columns=columns, coerce_float=True)
+                chunk["time"] = pd.to_datetime(chunk["time"])
+                counters["rows"] = len(chunk)
+                counters["bytes"] = int(chunk.memory_usage(index=False).sum())
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            # The rows of the last timestamp may continue in the next chunk, so hold them back until it arrives.
+            complete = (chunk["time"] != chunk["time"].iloc[-1]).values
+            carry = chunk[~complete]
+            if complete.any():
+                yield _timed_pivot(metrics, building_id, chunk[complete])
+        if carry is not None and len(carry):
+            yield _timed_pivot(metrics, building_id, carry)
+
+
+def get_time_bounds(start_time, end_time):
+    """
+    Translate the start and end time strings accepted by get_internal_temps into the inclusive window of readings.
+    Date only strings start at midnight. If start and end are the same date only string the whole day is covered, if
+    they are the same 'yyyy-mm-dd hh:mm:ss' string the window runs to 23:00 of that day.
+    :param start_time: start time string - 'yyyy-dd-mm' or 'yyyy-dd-mm hh:mm:ss'
+    :param end_time: end time string - 'yyyy-dd-mm' or 'yyyy-dd-mm hh:mm:ss'
+    :return: tuple (window_start, window_end) of datetimes
+    """
+    window_start = parse(start_time)
     if start_time != end_time:
-        #Identifying if start_time end_time are 'yyyy-dd-mm hh:mm:ss'
-        if len(start_time) > 10:
-            #Define a custom SQL query based on the inputs
-            sql_query = 'SELECT f1.measured_at as time, f1.measurement as temperature, b2.id as sensor_id FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id WHERE b2.building_id = ' \
-            + str(building_id) + \
-            ' and b2.ignore = False and  f1.bad_data = False and f1.measured_at >= ' \
-            + "'" + start_time + "'" +\
-            ' AND f1.measured_at <= ' \
-            + "'" + end_time + "'"
-        #otherwise our start_time and end_time are 'yyy-dd-mm'
-        else:
-            start_ = start_time + " 00:00:00"
-            end_ = end_time + " 00:00:00"
-            #Define a custom SQL query based on the inputs
-            sql_query = 'SELECT f1.measured_at as time, f1.measurement as temperature, b2.id as sensor_id FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id WHERE b2.building_id = ' \
-            + str(building_id) + \
-            ' and b2.ignore = False and  f1.bad_data = False and f1.measured_at >= ' \
-            + "'" + start_ + "'" +\
-            ' AND f1.measured_at <= ' \
-            + "'" + end_ + "'"
-    #In this case, the input dates are the same
-    else:
-        if len(start_time) > 10:
-            #Define a custom SQL query based on the inputs
-            sql_query = 'SELECT f1.measured_at as time, f1.measurement as temperature, b2.id as sensor_id FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id WHERE b2.building_id = ' \
-            + str(building_id) + \
-            ' and b2.ignore = False and  f1.bad_data = False and f1.measured_at between ' \
-            + "'" + start_time + "'" +\
-            ' AND ' \
-            + "date '" + start_time + "' + interval '23 hour';"
-        else:
-            start_ = start_time + " 00:00:00"
-            end_ = start_time + " 23:59:59"
-            #Define a custom SQL query based on the inputs
-            sql_query = 'SELECT f1.measured_at as time, f1.measurement as temperature, b2.id as sensor_id FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id WHERE b2.building_id = ' \
-            + str(building_id) + \
-            ' and b2.ignore = False and  f1.bad_data = False and f1.measured_at >= ' \
-            + "'" + start_ + "'" +\
-            ' AND f1.measured_at <= ' \
-            + "'" + end_ + "'"
-
-    #Run that query and put results into a dataframe
-    df = pd.read_sql(sql_query, db)
-    df['time'] = pd.to_datetime(df['time'])
-    df_a = df.pivot(index='time', columns='sensor_id', values='temperature')
-    return df_a
+        return window_start, parse(end_time)
+    if len(start_time) > 10:
+        return window_start, get_day_window(start_time)[1]
+    return window_start, window_start + timedelta(hours=23, minutes=59, seconds=59)
+
+
+def values_rows(frame, types):
+    """
+    Bind the rows of a DataFrame as the rows of a VALUES list, for queries that join against a small table of
+    parameters, e.g. one row per day window.
+    :param frame: DataFrame with one row per VALUES row
+    :param types: dict of column to DateTime or Float, the columns in the order of the VALUES list
+    :return: tuple (sql of the rows, list of bindparams, dict of params)
+    """
+    rows, bindparams, params = [], [], {}
+    for i, record in enumerate(frame[list(types)].itertuples(index=False)):
+        names = ["{}_{}".format(column, i) for column in types]
+        rows.append("(" + ", ".join(":" + name for name in names) + ")")
+        for name, (column, type_), value in zip(names, types.items(), record):
+            bindparams.append(bindparam(name, type_=type_))
+            params[name] = pd.Timestamp(value).to_pydatetime() if type_ is DateTime else float(value)
+    return ", ".join(rows), bindparams, params
+
+
+def _timed_pivot(metrics, building_id, df):
+    with metrics.stage("pivot", building_id) as counters:
+        counters["rows"] = len(df)
+        return _pivot_temps(df)
+
+
+def _pivot_temps(df):
+    df = df.assign(time=pd.to_datetime(df["time"]))
+    return df.pivot(index="time", columns="sensor_id", values="temperature")
+
+
+def get_day_window(estimation_date):
+    """
+    Get the naive UTC window of readings that belong to a single estimation day. This matches what
+    get_internal_temps fetches when given the same 'yyyy-mm-dd hh:mm:ss' string as start and end time, i.e. midnight
+    through 23:00 inclusive.
+    :param estimation_date: date in string format
+    :return: tuple (window_start, window_end) of datetimes
+    """
+    window_start = datetime.combine(parse(estimation_date).date(), datetime.min.time())
+    return window_start, window_start + timedelta(hours=23)
 
 
 def get_lease_obligations(building_id):
@@ -113,6 +223,36 @@ def get_lease_obligations(building_id):
     return pd.DataFrame(lease_obligations).set_index("dow")
 
 
+def get_lease_obligation_schedule(building_id):
+    """
+    Get the lease obligations of a building over time, for buildings whose obligations change, e.g. winter vs. summer.
+    :param building_id: integer
+    :return: DataFrame indexed by an IntervalIndex of the (left closed) periods in which the obligations are in
+    effect, with a dow column and the columns of get_lease_obligations. Every period has one row per day of week.
+    """
+    # TODO: Like get_lease_obligations this is mocked, with a single period covering all time.
+    return make_lease_obligation_schedule([(pd.Timestamp.min, pd.Timestamp.max, get_lease_obligations(building_id))])
+
+
+def make_lease_obligation_schedule(periods):
+    """
+    Build a lease obligation schedule from per period lease obligations.
+    :param periods: list of (effective_from, effective_to, lease_obligations) tuples, where lease_obligations is a
+    DataFrame in the format of get_lease_obligations. Periods must not overlap.
+    :return: DataFrame in the format of get_lease_obligation_schedule
+    """
+    frames = []
+    for effective_from, effective_to, lease_obligations in periods:
+        frame = lease_obligations.reset_index()
+        frame.index = pd.IntervalIndex.from_arrays(
+            [pd.Timestamp(effective_from)] * len(frame), [pd.Timestamp(effective_to)] * len(frame), closed="left"
+        )
+        frames.append(frame)
+    schedule = pd.concat(frames)
+    schedule.index.name = "effective"
+    return schedule
+
+
 def get_lease_obligation_temp_range(lease_obligations, estimation_date):
     """
     Extract the lower and upper lease obligation temperatures for a building on a single day.
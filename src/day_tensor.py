@@ -0,0 +1,176 @@
+"""
+This module houses a vectorized kernel that estimates the lease satisfied times of many days at once, from the
+internal temperatures laid out as a (day x time slot x sensor) tensor.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import numpy as np
+import pandas as pd
+from .data_loading import get_day_window
+from .sensor_matrix import DEFAULT_SENSOR_CHUNK, GRID_FREQ
+
+
+class DayTensor:
+    """
+    Internal temperatures of consecutive days as a float32 (day x slot x sensor) tensor, with a validity mask. Slot s
+    of day d is the grid point s steps after the start of the day window of d (see get_day_window), so every day has
+    the same number of slots. Slots the source matrix does not cover are masked out.
+    """
+
+    def __init__(self, values, mask, dates, sensor_ids, freq=GRID_FREQ):
+        """
+        :param values: float32 array of shape (n_days, n_slots, n_sensors)
+        :param mask: boolean array of the shape of values, True where there is a reading.
+        :param dates: DatetimeIndex of the days
+        :param sensor_ids: int array of the sensor ids of the last axis.
+        :param freq: grid frequency
+        """
+        self.values = values
+        self.mask = mask
+        self.dates = pd.DatetimeIndex(dates)
+        self.sensor_ids = sensor_ids
+        self.freq = freq
+
+    @classmethod
+    def from_matrix(cls, matrix, dates, sensor_ids=None):
+        """
+        :param matrix: SensorMatrix covering the day windows of dates, e.g. from load_chunk.
+        :param dates: DatetimeIndex of days
+        :param sensor_ids: optional set of the sensor ids to keep, all sensors if None.
+        :return: DayTensor
+        """
+        freq = matrix.times.freq if matrix.times.freq is not None else GRID_FREQ
+        index, on_grid = _slot_index(matrix.times, _slot_times(dates, freq))
+        rows = np.arange(len(matrix.sensor_ids))
+        if sensor_ids is not None:
+            rows = rows[np.isin(matrix.sensor_ids, list(sensor_ids))]
+        if not len(matrix.times):
+            shape = index.shape + (len(rows),)
+            return cls(np.full(shape, np.nan, dtype=np.float32), np.zeros(shape, dtype=bool), dates,
+                       matrix.sensor_ids[rows], freq)
+        gather = (rows[None, None, :], index[:, :, None])
+        values = matrix.values[gather]
+        mask = matrix.mask[gather] & on_grid[:, :, None]
+        return cls(values, mask, dates, matrix.sensor_ids[rows], freq)
+
+    def slot_times(self):
+        """
+        :return: datetime64 array of shape (n_days, n_slots) with the time of every slot.
+        """
+        return _slot_times(self.dates, self.freq)
+
+    def count(self):
+        """
+        :return: int array of shape (n_days, n_slots) with the number of readings per slot.
+        """
+        return self.mask.sum(axis=2)
+
+    def sum(self, sensor_chunk=DEFAULT_SENSOR_CHUNK):
+        """
+        Sum of the readings per slot, added one sensor after the other in sensor order like SensorMatrix.sum, so
+        both give the same float64 results.
+        :param sensor_chunk: number of sensors up-cast and reduced at a time.
+        :return: float64 array of shape (n_days, n_slots), 0 where there are no readings.
+        """
+        total = np.zeros(self.values.shape[:2])
+        for i in range(0, self.values.shape[2], sensor_chunk):
+            chunk = np.where(
+                self.mask[:, :, i:i + sensor_chunk], self.values[:, :, i:i + sensor_chunk].astype(np.float64), 0.
+            )
+            for j in range(chunk.shape[2]):
+                total += chunk[:, :, j]
+        return total
+
+    def mean(self, sensor_chunk=DEFAULT_SENSOR_CHUNK):
+        """
+        :return: float64 array of shape (n_days, n_slots) with the mean reading per slot, NaN where there are none.
+        """
+        count = self.count()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 0, self.sum(sensor_chunk) / count, np.nan)
+
+
+def first_crossings(temps, lower=70.0, upper=75.0):
+    """
+    :param temps: float array of shape (n_days, n_slots), NaN where unknown.
+    :param lower: lower bound of the band, inclusive
+    :param upper: upper bound of the band, inclusive
+    :return: int array with the first slot of every day at which temps is in [lower, upper], -1 if there is none.
+    """
+    with np.errstate(invalid="ignore"):
+        in_band = (temps >= lower) & (temps <= upper)
+    first = in_band.argmax(axis=1)
+    first[~in_band.any(axis=1)] = -1
+    return first
+
+
+def estimate_days(matrix, dates, relevant_sensors, lower=70.0, upper=75.0):
+    """
+    Vectorized YourEstimator.estimate_from_temps for every day of dates: operatingDayCheck and getPred2 with a
+    handful of array operations instead of a DataFrame pass per day.
+    :param matrix: SensorMatrix covering the day windows of dates
+    :param dates: DatetimeIndex of days
+    :param relevant_sensors: set of the sensor ids getPred2 averages over
+    :return: list of (operating, lease_satisfied_time) tuples, one per day, equal to what estimate_from_temps
+    returns for the day windows.
+    """
+    tensor = DayTensor.from_matrix(matrix, dates, relevant_sensors)
+    first = first_crossings(tensor.mean(), lower, upper)
+    slot_times = tensor.slot_times()
+    # Whether a day is operating is decided on all sensors, like operatingDayCheck.
+    index, on_grid = _slot_index(matrix.times, slot_times)
+    has_readings = (matrix.mask.any(axis=0)[index] & on_grid).any(axis=1) if len(matrix.times) else on_grid[:, 0]
+    results = []
+    for i, date in enumerate(tensor.dates):
+        if not has_readings[i]:
+            results.append((None, None))
+        elif date.dayofweek > 4:
+            results.append((False, None))
+        elif first[i] < 0:
+            results.append((True, "Not Satisfied"))
+        else:
+            results.append((True, pd.Timestamp(slot_times[i, first[i]])))
+    return results
+
+
+def count_day_readings(matrix, dates):
+    """
+    :param matrix: SensorMatrix covering the day windows of dates
+    :param dates: DatetimeIndex of days
+    :return: tuple of int arrays (number of readings, number of sensors with readings), one entry per day.
+    """
+    if not len(matrix.times):
+        return np.zeros(len(dates), dtype=np.int64), np.zeros(len(dates), dtype=np.int64)
+    index, on_grid = _slot_index(matrix.times, _slot_times(dates, matrix.times.freq or GRID_FREQ))
+    # (sensor x day x slot), only the mask is gathered.
+    mask = matrix.mask[:, index] & on_grid[None, :, :]
+    return mask.sum(axis=(0, 2)), mask.any(axis=2).sum(axis=0)
+
+
+def _slot_times(dates, freq):
+    """
+    :return: datetime64 array of shape (n_days, n_slots) with the grid points of the day window of every date.
+    """
+    # The day window is the same for every day, relative to midnight. Parsing every date would dominate the kernel.
+    window_start, window_end = get_day_window("2018-01-01")
+    midnight = pd.Timestamp("2018-01-01")
+    step = pd.Timedelta(freq)
+    n_slots = int((pd.Timestamp(window_end) - pd.Timestamp(window_start)) // step) + 1
+    day_starts = pd.DatetimeIndex(dates).normalize().values + np.timedelta64((window_start - midnight).value, "ns")
+    return day_starts[:, None] + (np.arange(n_slots) * np.timedelta64(step.value, "ns"))[None, :]
+
+
+def _slot_index(times, slot_times):
+    """
+    :param times: DatetimeIndex of a grid
+    :param slot_times: datetime64 array of slot times
+    :return: tuple (index, on_grid) of arrays of the shape of slot_times, the position of every slot in times and
+    whether times has it. The index of a slot that is not on the grid is 0.
+    """
+    index = times.values.searchsorted(slot_times)
+    on_grid = index < len(times)
+    if not len(times):
+        return index, on_grid
+    index[~on_grid] = 0
+    on_grid &= times.values[index] == slot_times
+    return index, on_grid
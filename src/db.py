@@ -0,0 +1,208 @@
+"""
+This module manages the database engine shared by the estimators, the data loading helpers and the scripts.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import QueuePool
+
+DATABASE_URL_ENV = "HW_DATABASE_URL"
+
+DEFAULT_POOL_SETTINGS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+}
+
+_settings = {"url": None, "pool": dict(DEFAULT_POOL_SETTINGS)}
+_engines = {}
+_lock = threading.Lock()
+
+
+class PoolStats:
+    """
+    Counters for pool checkouts of one engine. Wait time is the time spent getting a connection from the pool
+    (including opening a new one), hold time is the time between checkout and checkin.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.total_wait_seconds = 0.
+        self.max_wait_seconds = 0.
+        self.total_hold_seconds = 0.
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.total_wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def record_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+    def record_checkin(self, hold_seconds):
+        with self._lock:
+            self.checked_out -= 1
+            self.total_hold_seconds += hold_seconds
+
+    def record_connect(self):
+        with self._lock:
+            self.connects += 1
+
+    def as_dict(self):
+        """
+        :return: dict of the counters plus the mean wait and hold times in seconds.
+        """
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "total_wait_seconds": self.total_wait_seconds,
+                "mean_wait_seconds": self.total_wait_seconds / self.checkouts if self.checkouts else 0.,
+                "max_wait_seconds": self.max_wait_seconds,
+                "mean_hold_seconds": self.total_hold_seconds / self.checkouts if self.checkouts else 0.,
+            }
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long each checkout waited for a connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.stats = PoolStats()
+        super().__init__(*args, **kwargs)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.stats.record_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def configure(url=None, **pool_settings):
+    """
+    Set the database url and pool settings used by get_engine. Engines created before this call are disposed.
+    :param url: database url. Falls back to the HW_DATABASE_URL environment variable when None.
+    :param pool_settings: any of pool_size, max_overflow, pool_timeout, pool_recycle.
+    """
+    unknown = set(pool_settings) - set(DEFAULT_POOL_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown pool settings: {}".format(sorted(unknown)))
+    with _lock:
+        _settings["url"] = url
+        _settings["pool"] = dict(DEFAULT_POOL_SETTINGS, **pool_settings)
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def configure_from_config(config):
+    """
+    Configure the engine from the optional `database` section of a run config, e.g.
+        database:
+          url: postgresql://...
+          pool_size: 8
+          pool_recycle: 900
+    :param config: dict parsed from config.yml
+    """
+    database_config = dict(config.get("database") or {})
+    configure(database_config.pop("url", None), **database_config)
+
+
+def get_settings():
+    """
+    :return: dict with the url and pool settings currently in use, suitable for passing to configure in a worker.
+    """
+    with _lock:
+        return dict(_settings["pool"], url=_settings["url"])
+
+
+def get_engine():
+    """
+    Get the pooled engine of the current process. The engine is created on first use and shared afterwards. A forked
+    child gets its own engine and never reuses connections opened by the parent.
+    :return: sqlalchemy Engine
+    """
+    pid = os.getpid()
+    engine = _engines.get(pid)
+    if engine is not None:
+        return engine
+    with _lock:
+        # Engines inherited from a parent process are dropped without closing their connections, which still belong
+        # to the parent.
+        for other_pid in [p for p in _engines if p != pid]:
+            del _engines[other_pid]
+        if pid not in _engines:
+            url = _settings["url"] or os.environ.get(DATABASE_URL_ENV)
+            if not url:
+                raise RuntimeError(
+                    "No database url configured. Set {} or the database url in the config.".format(DATABASE_URL_ENV)
+                )
+            _engines[pid] = _create_engine(url, _settings["pool"])
+        return _engines[pid]
+
+
+def get_pool_stats():
+    """
+    :return: dict of pool statistics for the engine of the current process, empty if no engine was created yet.
+    """
+    engine = _engines.get(os.getpid())
+    if engine is None or not isinstance(engine.pool, TimedQueuePool):
+        return {}
+    return engine.pool.stats.as_dict()
+
+
+def _create_engine(url, pool_settings):
+    if url.startswith("sqlite"):
+        # SQLite has no network connections to pool, and its pools don't take the QueuePool settings.
+        return create_engine(url)
+    engine = create_engine(url, poolclass=TimedQueuePool, **pool_settings)
+    stats = engine.pool.stats
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        stats.record_connect()
+        connection_record.info["pid"] = os.getpid()
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        # Guard against a connection that was opened before a fork being handed out in the child. The DBAPI connection
+        # is detached first so that it is not closed under the parent, the DisconnectionError then has the pool
+        # invalidate the record and connect again.
+        pid = os.getpid()
+        if connection_record.info["pid"] != pid:
+            connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                "Connection record belongs to pid {}, attempting to check out in pid {}".format(
+                    connection_record.info["pid"], pid
+                )
+            )
+        connection_record.info["checkout_time"] = time.perf_counter()
+        stats.record_checkout()
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        checkout_time = connection_record.info.pop("checkout_time", None)
+        if checkout_time is not None:
+            stats.record_checkin(time.perf_counter() - checkout_time)
+
+    return engine
@@ -0,0 +1,63 @@
+"""
+This module houses the mapping from the estimator settings of a run config (see example_config.yml) to the estimator
+of a building, and the refresh of the local stores those estimators read from.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from .fetch_planner import DEFAULT_LOOKBACK_HOURS, OperatingWindowEstimator
+from .lease_satisfied_estimator import YourEstimator
+from .measurement_cache import MeasurementCache
+from .pushdown import PushdownEstimator
+from .rollup import RollupEstimator, SlotRollup
+from .sensor_index import get_sensor_index
+
+
+def make_estimator(config, building_id, db=None):
+    """
+    The local stores are read as they are, see refresh_local_stores.
+    :param config: dict parsed from config.yml
+    :param building_id: integer
+    :param db: an active sql engine, or None for the shared engine.
+    :return: the estimator of the building
+    """
+    cache = MeasurementCache(config["cache_dir"]) if config.get("cache_dir") else None
+    sensor_index = None
+    if config.get("sensor_index_dir"):
+        sensor_index = get_sensor_index(config["sensor_index_dir"], building_id, db=db, refresh=False)
+    if config.get("pushdown"):
+        return PushdownEstimator(
+            building_id=building_id, db=db, sensor_index=sensor_index,
+            search_window=config.get("search_window", "day"),
+        )
+    if config.get("fetch_window", "day") == "operating":
+        return OperatingWindowEstimator(
+            building_id=building_id, db=db, sensor_index=sensor_index,
+            lookback_hours=config.get("lookback_hours", DEFAULT_LOOKBACK_HOURS),
+        )
+    if config.get("rollup_dir"):
+        return RollupEstimator(
+            building_id=building_id, db=db, sensor_index=sensor_index, rollup=SlotRollup(config["rollup_dir"])
+        )
+    return YourEstimator(building_id=building_id, db=db, cache=cache, sensor_index=sensor_index)
+
+
+def refresh_local_stores(config, building_id, db=None):
+    """
+    Bring the measurement cache, the sensor index and the rollup of a building up to date, for the ones the config
+    has. The rollup is refreshed last, it is over the relevant sensors of the refreshed sensor index.
+    :param config: dict parsed from config.yml
+    :param building_id: integer
+    :param db: an active sql engine, or None for the shared engine.
+    :return: dict with the number of new_rows of the cache, the sorted relevant_sensors of the sensor index and the
+    number of rollup_days rolled up again. None for the stores the config does not have.
+    """
+    refreshed = {"new_rows": None, "relevant_sensors": None, "rollup_days": None}
+    if config.get("cache_dir"):
+        refreshed["new_rows"] = MeasurementCache(config["cache_dir"]).refresh(db, building_id)
+    if config.get("sensor_index_dir"):
+        sensor_index = get_sensor_index(config["sensor_index_dir"], building_id, db=db)
+        refreshed["relevant_sensors"] = sorted(int(sensor_id) for sensor_id in sensor_index.relevant_sensors)
+    if config.get("rollup_dir"):
+        relevant_sensors = make_estimator(config, building_id, db=db).relevant_sensors
+        refreshed["rollup_days"] = SlotRollup(config["rollup_dir"]).refresh(db, building_id, relevant_sensors)
+    return refreshed
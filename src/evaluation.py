@@ -0,0 +1,259 @@
+"""
+This module houses an evaluation engine that runs many variants of the lease satisfied time estimate over the same
+data in a single pass, to compare algorithms without a historical run per variant.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from .data_loading import get_day_window
+from .instrumentation import get_metrics
+from .lease_satisfied_estimator import DEFAULT_CHUNK_DAYS, YourEstimator, operatingDayCheck
+
+DEFAULT_TEMP_RANGE = (70., 75.)
+
+# Aggregator name to function(day, sensors, **params) returning a boolean array, True at the grid points at which the
+# building counts as at lease obligation temperature. See register_aggregator.
+AGGREGATORS = OrderedDict()
+
+# Variant name to (aggregator name, params). "pred1" and "pred2" reproduce getPred1 and getPred2.
+DEFAULT_VARIANTS = OrderedDict([
+    ("pred1", ("mean", {"sensors": "all"})),
+    ("pred2", ("mean", {"sensors": "relevant"})),
+    ("median", ("quantile", {"q": 0.5})),
+    ("quantile_25", ("quantile", {"q": 0.25})),
+    ("quantile_75", ("quantile", {"q": 0.75})),
+    ("trimmed_mean_10", ("trimmed_mean", {"proportion": 0.1})),
+    ("fraction_in_band_50", ("fraction_in_band", {"threshold": 0.5})),
+    ("fraction_in_band_75", ("fraction_in_band", {"threshold": 0.75})),
+])
+
+
+class DayData:
+    """
+    The internal temperatures of one building-day and the intermediate results computed from them, e.g. the sorted
+    readings or the in-band mask. Every intermediate is computed once and shared by all aggregators that need it.
+    """
+
+    def __init__(self, matrix, relevant_sensors, temp_range=DEFAULT_TEMP_RANGE):
+        """
+        :param matrix: SensorMatrix of the day window
+        :param relevant_sensors: set of the sensor ids of the "relevant" selection
+        :param temp_range: tuple (lower, upper) of the lease obligation temperatures, inclusive
+        """
+        self.matrix = matrix
+        self.relevant_sensors = relevant_sensors
+        self.temp_range = temp_range
+        self._memo = {}
+
+    @property
+    def times(self):
+        return self.matrix.times
+
+    def shared(self, name, sensors, fn):
+        """
+        :param name: name of the intermediate result
+        :param sensors: sensor selection it is computed over, "all" or "relevant"
+        :param fn: function of the SensorMatrix of the selection computing it
+        :return: the result of fn, computed on the first call only.
+        """
+        key = (name, sensors)
+        if key not in self._memo:
+            self._memo[key] = fn(self.sensors(sensors))
+        return self._memo[key]
+
+    def sensors(self, sensors):
+        """
+        :param sensors: "all" or "relevant"
+        :return: SensorMatrix of the selection
+        """
+        if sensors == "all":
+            return self.matrix
+        if sensors == "relevant":
+            key = ("matrix", sensors)
+            if key not in self._memo:
+                self._memo[key] = self.matrix.select(self.relevant_sensors)
+            return self._memo[key]
+        raise ValueError("Unknown sensor selection {}".format(sensors))
+
+    def count(self, sensors):
+        """
+        :return: int array with the number of readings per grid point.
+        """
+        return self.shared("count", sensors, lambda matrix: matrix.count())
+
+    def mean(self, sensors):
+        """
+        :return: float64 array with the mean reading per grid point, the same as getPred1 / getPred2.
+        """
+        return self.shared("mean", sensors, lambda matrix: matrix.mean())
+
+    def sorted_readings(self, sensors):
+        """
+        :return: float64 (sensor x time) array with the readings of every grid point sorted, NaN after the readings.
+        """
+        return self.shared(
+            "sorted", sensors,
+            lambda matrix: np.sort(np.where(matrix.mask, matrix.values.astype(np.float64), np.nan), axis=0),
+        )
+
+    def sensor_in_band(self, sensors):
+        """
+        :return: boolean (sensor x time) array, True for the readings within temp_range.
+        """
+        lower, upper = self.temp_range
+        return self.shared(
+            "sensor_in_band", sensors,
+            lambda matrix: matrix.mask & (matrix.values >= lower) & (matrix.values <= upper),
+        )
+
+    def in_band(self, temps):
+        """
+        :param temps: float array of building temperatures per grid point, NaN where unknown.
+        :return: boolean array, True where temps is within temp_range.
+        """
+        lower, upper = self.temp_range
+        with np.errstate(invalid="ignore"):
+            return (temps >= lower) & (temps <= upper)
+
+
+def register_aggregator(name, fn):
+    """
+    Make an aggregator available to variants.
+    :param name: name variants refer to it by
+    :param fn: function(day, sensors="relevant", **params) of a DayData returning a boolean array, True at the grid
+    points at which the building counts as at lease obligation temperature.
+    """
+    AGGREGATORS[name] = fn
+
+
+def _mean(day, sensors="relevant"):
+    return day.in_band(day.mean(sensors))
+
+
+def _quantile(day, sensors="relevant", q=0.5):
+    """
+    Quantile of the readings per grid point, interpolated linearly like numpy.percentile.
+    """
+    readings = day.sorted_readings(sensors)
+    count = day.count(sensors)
+    if len(readings) == 0:
+        return np.zeros(len(count), dtype=bool)
+    position = np.maximum(count - 1, 0) * q
+    lo = np.floor(position).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(count - 1, 0))
+    columns = np.arange(readings.shape[1])
+    weight = position - lo
+    with np.errstate(invalid="ignore"):
+        temps = readings[lo, columns] * (1. - weight) + readings[hi, columns] * weight
+    return day.in_band(np.where(count > 0, temps, np.nan))
+
+
+def _trimmed_mean(day, sensors="relevant", proportion=0.1):
+    """
+    Mean of the readings per grid point after cutting int(proportion * count) readings off either end, like
+    scipy.stats.trim_mean.
+    """
+    readings = day.sorted_readings(sensors)
+    count = day.count(sensors)
+    cut = np.floor(count * proportion).astype(np.int64)
+    prefix = np.concatenate([np.zeros((1, readings.shape[1])), np.cumsum(np.nan_to_num(readings), axis=0)])
+    columns = np.arange(readings.shape[1])
+    kept = count - 2 * cut
+    with np.errstate(invalid="ignore", divide="ignore"):
+        temps = (prefix[count - cut, columns] - prefix[cut, columns]) / kept
+    return day.in_band(np.where(kept > 0, temps, np.nan))
+
+
+def _fraction_in_band(day, sensors="relevant", threshold=0.5):
+    """
+    Satisfied where at least threshold of the sensors with a reading are within the temperature range.
+    """
+    count = day.count(sensors)
+    n_in_band = day.shared("n_in_band", sensors, lambda _: day.sensor_in_band(sensors).sum(axis=0))
+    return (count > 0) & (n_in_band >= threshold * count)
+
+
+register_aggregator("mean", _mean)
+register_aggregator("quantile", _quantile)
+register_aggregator("trimmed_mean", _trimmed_mean)
+register_aggregator("fraction_in_band", _fraction_in_band)
+
+
+def evaluate_day(day, estimation_date, variants=DEFAULT_VARIANTS):
+    """
+    :param day: DayData of the day window of estimation_date
+    :param estimation_date: A date in string format.
+    :param variants: dict of variant name to (aggregator name, params)
+    :return: dict with the operating flag and the lease satisfied time of every variant. Like YourEstimator, the
+    times are None on days that are not operating and "Not Satisfied" if the band is never reached.
+    """
+    operating = operatingDayCheck(day.matrix, estimation_date)
+    row = OrderedDict([("operating", operating)])
+    for name, (aggregator, params) in variants.items():
+        if not operating:
+            row[name] = None
+            continue
+        satisfied = AGGREGATORS[aggregator](day, **params)
+        row[name] = day.times[satisfied.argmax()] if satisfied.any() else "Not Satisfied"
+    return row
+
+
+def evaluate_building(building_id, start_date, end_date, variants=DEFAULT_VARIANTS, db=None, cache=None,
+                      sensor_index=None, temp_range=DEFAULT_TEMP_RANGE, chunk_days=DEFAULT_CHUNK_DAYS):
+    """
+    Evaluate all variants for every day between start_date and end_date (inclusive). The data is loaded once, in
+    chunks of chunk_days days like compute_lease_satisfied_times, and every variant runs on the same matrices.
+    :param building_id: integer
+    :param variants: dict of variant name to (aggregator name, params), see DEFAULT_VARIANTS
+    :param db: sql engine, see LeaseSatisfiedTimeEstimator
+    :param cache: optional MeasurementCache
+    :param sensor_index: optional SensorQualityIndex selecting the "relevant" sensors
+    :param temp_range: tuple (lower, upper) of the lease obligation temperatures, inclusive
+    :return: wide DataFrame indexed by date string with the columns building_id, operating and one lease satisfied
+    time column per variant.
+    """
+    for name, (aggregator, _) in variants.items():
+        if aggregator not in AGGREGATORS:
+            raise ValueError("Variant {} uses the unknown aggregator {}".format(name, aggregator))
+    loader = YourEstimator(building_id, db=db, cache=cache, sensor_index=sensor_index)
+    metrics = get_metrics()
+    rows = OrderedDict()
+    for chunk in loader.chunk_dates(start_date, end_date, chunk_days):
+        matrix = loader.load_chunk(chunk)
+        for date in chunk:
+            window_start, window_end = get_day_window(str(date))
+            day = DayData(matrix.time_slice(window_start, window_end), loader.relevant_sensors, temp_range)
+            with metrics.stage("evaluate", building_id):
+                rows[str(date)] = OrderedDict(
+                    [("building_id", building_id)] + list(evaluate_day(day, str(date), variants).items())
+                )
+    return pd.DataFrame.from_dict(rows, orient="index").reindex(
+        columns=["building_id", "operating"] + list(variants)
+    )
+
+
+def summarize_agreement(df, reference="pred2"):
+    """
+    :param df: DataFrame from evaluate_building
+    :param reference: variant to compare the others with
+    :return: DataFrame indexed by variant with the number of operating days satisfied, the fraction of operating
+    days on which it agrees with the reference and the mean difference to the reference in minutes, over the days
+    both are satisfied.
+    """
+    operating = df[df["operating"].fillna(False).astype(bool)]
+    reference_times = pd.to_datetime(operating[reference].where(operating[reference] != "Not Satisfied"))
+    summary = OrderedDict()
+    for name in df.columns.drop(["building_id", "operating"]):
+        times = pd.to_datetime(operating[name].where(operating[name] != "Not Satisfied"))
+        both = times.notna() & reference_times.notna()
+        summary[name] = {
+            "days_satisfied": int(times.notna().sum()),
+            "agreement": float((operating[name] == operating[reference]).mean()) if len(operating) else np.nan,
+            "mean_minutes_vs_reference": (
+                float(((times[both] - reference_times[both]).dt.total_seconds() / 60.).mean()) if both.any()
+                else np.nan
+            ),
+        }
+    return pd.DataFrame.from_dict(summary, orient="index")
@@ -0,0 +1,146 @@
+"""
+This module houses a fetch planner that uses the lease calendar to load only the readings around the operating
+period of every operating day, instead of whole days including weekends.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import numpy as np
+import pandas as pd
+from .data_loading import get_day_window
+from .day_tensor import DayTensor, count_day_readings, first_crossings
+from .instrumentation import get_metrics
+from .lease_satisfied_estimator import YourEstimator
+from .sensor_matrix import get_internal_temp_matrix_in_windows
+
+# Hours before the local operating start that are fetched, so that buildings that reach the band before the
+# operating period starts are found at the start of the look-back instead of not at all.
+DEFAULT_LOOKBACK_HOURS = 3
+
+
+def plan_fetch_windows(lease_calendar, start_date, end_date, lookback_hours=DEFAULT_LOOKBACK_HOURS):
+    """
+    :param lease_calendar: LeaseCalendar of the building
+    :param start_date: A date in string format.
+    :param end_date: A date in string format.
+    :param lookback_hours: hours before the operating start to fetch as well
+    :return: DataFrame indexed by day with the operating flag of the lease calendar and the naive UTC
+    {fetch_start, fetch_end} window of readings to fetch, both inclusive. The window runs from lookback_hours before
+    the operating start to the operating end, in UTC with the offset in effect on the day, and is clipped to the day
+    window (see get_day_window). It is NaT on days that are not operating or whose window is empty after clipping.
+    """
+    calendar = lease_calendar.days(start_date, end_date)
+    day_start = calendar.index
+    day_end = pd.DatetimeIndex([get_day_window(str(day))[1] for day in day_start])
+    operating_start = pd.DatetimeIndex(calendar["utc_operating_start"]).tz_convert("UTC").tz_localize(None)
+    operating_end = pd.DatetimeIndex(calendar["utc_operating_end"]).tz_convert("UTC").tz_localize(None)
+    fetch_start = np.maximum(
+        (operating_start - pd.Timedelta(hours=lookback_hours)).values, day_start.values
+    )
+    fetch_end = np.minimum(operating_end.values, day_end.values)
+    # Days that are not operating have no operating period, only their operating flag counts.
+    fetch = calendar["operating"].values & (fetch_start <= fetch_end)
+    return pd.DataFrame(
+        {
+            "operating": calendar["operating"].values,
+            "fetch_start": np.where(fetch, fetch_start, np.datetime64("NaT")),
+            "fetch_end": np.where(fetch, fetch_end, np.datetime64("NaT")),
+        },
+        index=day_start,
+        columns=["operating", "fetch_start", "fetch_end"],
+    )
+
+
+def get_fetch_fraction(windows):
+    """
+    :param windows: DataFrame as returned by plan_fetch_windows
+    :return: fraction of the time of the day windows that is fetched, an estimate of the fraction of rows fetched.
+    """
+    if windows.empty:
+        return 0.
+    day_hours = (pd.Timestamp(get_day_window("2018-01-01")[1]) - pd.Timestamp("2018-01-01")) / pd.Timedelta(hours=1)
+    fetched_hours = ((windows["fetch_end"] - windows["fetch_start"]) / pd.Timedelta(hours=1)).fillna(0.).sum()
+    return fetched_hours / (day_hours * len(windows))
+
+
+class OperatingWindowEstimator(YourEstimator):
+    """
+    YourEstimator that only fetches the readings from lookback_hours before the operating start to the operating end
+    of the lease calendar, and skips the days the calendar says are not operating without touching the database.
+    Whether a day is operating comes from the calendar instead of the weekday of the first reading, and the satisfied
+    time is searched in the fetched window only. The measurement cache is not used.
+    """
+
+    def __init__(self, building_id, db=None, cache=None, sensor_index=None, lookback_hours=DEFAULT_LOOKBACK_HOURS,
+                 **kwargs):
+        """
+        :param lookback_hours: hours before the operating start that are fetched as well
+        """
+        super().__init__(building_id, db=db, cache=cache, sensor_index=sensor_index, **kwargs)
+        self.lookback_hours = lookback_hours
+
+    def get_params(self):
+        """
+        :return: Same as LeaseSatisfiedTimeEstimator.get_params.
+        """
+        return dict(super().get_params(), lookback_hours=self.lookback_hours)
+
+    def compute_lease_satisfied_time(self, estimation_date):
+        """
+        :param estimation_date: date in string format
+        :return: Same as YourEstimator.compute_lease_satisfied_time.
+        """
+        df = self.compute_lease_satisfied_times(estimation_date, estimation_date)
+        return df["operating"].iloc[0], df["lease_satisfied_time"].iloc[0]
+
+    def plan(self, chunk):
+        """
+        :param chunk: DatetimeIndex of consecutive days
+        :return: the fetch windows of the days, see plan_fetch_windows
+        """
+        return plan_fetch_windows(self.lease_calendar, str(chunk[0]), str(chunk[-1]), self.lookback_hours)
+
+    def load_chunk(self, chunk):
+        """
+        :param chunk: DatetimeIndex of consecutive days, see chunk_dates
+        :return: SensorMatrix over the day windows of the chunk, with readings in the fetch windows only.
+        """
+        windows = self.plan(chunk).dropna(subset=["fetch_start"])
+        chunk_start, _ = get_day_window(str(chunk[0]))
+        _, chunk_end = get_day_window(str(chunk[-1]))
+        return get_internal_temp_matrix_in_windows(self.db, self.building_id, windows, chunk_start, chunk_end)
+
+    def estimate_chunk(self, chunk, df_chunk):
+        """
+        :param chunk: DatetimeIndex of consecutive days, see chunk_dates
+        :param df_chunk: SensorMatrix from load_chunk
+        :return: dict of date string to the output row of the day, see compute_lease_satisfied_times. Days the
+        calendar says are not operating are (False, None), operating days without readings (None, None).
+        """
+        windows = self.plan(chunk)
+        metrics = get_metrics()
+        with metrics.stage("estimate", self.building_id) as counters:
+            tensor = DayTensor.from_matrix(df_chunk, chunk, self.relevant_sensors)
+            first = first_crossings(tensor.mean())
+            slot_times = tensor.slot_times()
+        readings, sensors = count_day_readings(df_chunk, chunk)
+        df_dict = {}
+        for i, date in enumerate(chunk):
+            metrics.record_day(
+                self.building_id, date, rows=int(readings[i]), sensors=int(sensors[i]),
+                estimate_wall_seconds=counters["wall_seconds"] / len(chunk),
+                estimate_cpu_seconds=counters["cpu_seconds"] / len(chunk),
+            )
+            if not windows["operating"].iloc[i]:
+                operating, lease_satisfied_time = False, None
+            elif not readings[i]:
+                operating, lease_satisfied_time = None, None
+            elif first[i] < 0:
+                operating, lease_satisfied_time = True, "Not Satisfied"
+            else:
+                operating, lease_satisfied_time = True, pd.Timestamp(slot_times[i, first[i]])
+            df_dict[str(date)] = {
+                "building_id": self.building_id,
+                "operating": operating,
+                "lease_satisfied_time": lease_satisfied_time,
+            }
+        return df_dict
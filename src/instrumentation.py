@@ -0,0 +1,165 @@
+"""
+This module houses the stage timers and counters of the historical runs, and helpers to write them out and profile.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from contextlib import contextmanager
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+
+STAGE_FIELDS = ["calls", "wall_seconds", "cpu_seconds", "rows", "bytes"]
+
+
+class Metrics:
+    """
+    Wall clock and CPU time, rows and bytes per (building, stage), plus one record per building-day. Stages are timed
+    per chunk of work, not per row, so collecting them is cheap. CPU time is the CPU time of the thread running the
+    stage, so stages overlapping in other threads (e.g. prefetched fetches) are not counted twice.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.days = []
+
+    @contextmanager
+    def stage(self, name, building_id=None):
+        """
+        Time the block as a call of stage name.
+        :param name: stage name, e.g. "sql", "decode", "pivot", "estimate"
+        :param building_id: building the work is for, None for work that is not for a single building.
+        :return: context manager yielding a dict the block can add rows and bytes to. After the block it also holds
+        the wall_seconds and cpu_seconds of the call.
+        """
+        counters = {"rows": 0, "bytes": 0}
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield counters
+        finally:
+            counters["wall_seconds"] = time.perf_counter() - wall
+            counters["cpu_seconds"] = time.thread_time() - cpu
+            self.add(name, building_id, calls=1, **counters)
+
+    def add(self, name, building_id=None, **values):
+        """
+        Add values to the totals of a stage.
+        :param values: any of STAGE_FIELDS
+        """
+        key = (building_id, name)
+        with self._lock:
+            totals = self.stages.setdefault(key, dict.fromkeys(STAGE_FIELDS, 0))
+            for field, value in values.items():
+                totals[field] += value
+
+    def record_day(self, building_id, date, **values):
+        """
+        :param values: what to record for the building-day, e.g. rows, sensors and the timings of a stage.
+        """
+        with self._lock:
+            self.days.append(dict(values, building_id=building_id, date=str(date)))
+
+    def merge(self, other):
+        """
+        :param other: Metrics, or a dict from Metrics.to_dict (e.g. of a worker process)
+        """
+        if isinstance(other, Metrics):
+            other = other.to_dict()
+        for record in other["stages"]:
+            record = dict(record)
+            self.add(record.pop("stage"), record.pop("building_id"), **record)
+        with self._lock:
+            self.days.extend(other["days"])
+
+    def building_seconds(self):
+        """
+        :return: dict of building_id to the total wall clock seconds of its stages.
+        """
+        totals = {}
+        with self._lock:
+            for (building_id, _), stage in self.stages.items():
+                if building_id is not None:
+                    totals[building_id] = totals.get(building_id, 0.) + stage["wall_seconds"]
+        return totals
+
+    def to_dict(self):
+        """
+        :return: JSON serializable dict with a list of stage records and a list of day records.
+        """
+        with self._lock:
+            stages = [
+                dict(totals, building_id=building_id, stage=name)
+                for (building_id, name), totals in sorted(self.stages.items(), key=lambda item: str(item[0]))
+            ]
+            return {"stages": stages, "days": list(self.days)}
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    """
+    :return: the Metrics of the current process.
+    """
+    return _metrics
+
+
+def reset_metrics():
+    """
+    Start collecting into fresh Metrics, e.g. at the start of a unit of work whose metrics are shipped elsewhere.
+    :return: the new Metrics of the current process.
+    """
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def write_metrics(path, metrics, **run_info):
+    """
+    :param path: json file to write
+    :param metrics: Metrics
+    :param run_info: run level entries, e.g. the total wall clock time and the number of workers.
+    """
+    with open(path + ".tmp", "w") as f:
+        json.dump(dict(metrics.to_dict(), run=run_info), f, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+
+
+def profile(fn, path_prefix, top=50):
+    """
+    Run fn under cProfile and write the stats to path_prefix.prof (for pstats / snakeviz) and the top functions by
+    cumulative time to path_prefix.txt.
+    :return: the return value of fn
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = fn()
+    finally:
+        profiler.disable()
+    profiler.dump_stats(path_prefix + ".prof")
+    _write_report(pstats.Stats(profiler), path_prefix, top)
+    return result
+
+
+def merge_profiles(paths, path_prefix, top=50):
+    """
+    Add up the stats of .prof files written by profile, e.g. of the shards of a building run in different processes,
+    and write them to path_prefix.prof and path_prefix.txt the way profile does.
+    :param paths: list of .prof files
+    """
+    stats = pstats.Stats(*paths)
+    stats.dump_stats(path_prefix + ".prof")
+    _write_report(stats, path_prefix, top)
+
+
+def _write_report(stats, path_prefix, top):
+    report = io.StringIO()
+    stats.stream = report
+    stats.sort_stats("cumulative").print_stats(top)
+    with open(path_prefix + ".txt", "w") as f:
+        f.write(report.getvalue())
@@ -0,0 +1,130 @@
+"""
+This module turns lease obligations into a calendar of operating windows and temperature ranges, built for a whole
+date range at once.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from .data_loading import get_lease_obligation_schedule, make_lease_obligation_schedule
+
+CALENDAR_COLUMNS = [
+    "operating",
+    "lower_operating_temp",
+    "upper_operating_temp",
+    "utc_operating_start",
+    "utc_operating_end",
+]
+
+
+def build_lease_calendar(lease_obligations, dates):
+    """
+    Vectorized version of get_lease_obligation_temp_range and get_operating_period_in_utc for many days.
+    :param lease_obligations: DataFrame in the format of get_lease_obligations, or a schedule in the format of
+    get_lease_obligation_schedule.
+    :param dates: DatetimeIndex (or anything DatetimeIndex accepts) of days. Times of day are ignored.
+    :return: DataFrame indexed by day with the columns {operating, lower_operating_temp, upper_operating_temp,
+    utc_operating_start, utc_operating_end}. Days that are not operating, or not covered by the schedule, have
+    operating False and NaN / NaT in the other columns. The operating period is in UTC, handling DST.
+    """
+    if not isinstance(lease_obligations.index, pd.IntervalIndex):
+        lease_obligations = make_lease_obligation_schedule([(pd.Timestamp.min, pd.Timestamp.max, lease_obligations)])
+    days = pd.DatetimeIndex(dates).normalize()
+    n = len(days)
+    operating = np.zeros(n, dtype=bool)
+    lower = np.full(n, np.nan)
+    upper = np.full(n, np.nan)
+    start_hour = np.full(n, np.nan)
+    end_hour = np.full(n, np.nan)
+    timezone = np.empty(n, dtype=object)
+
+    dows = days.dayofweek.values
+    for period in lease_obligations.index.unique():
+        in_period = np.asarray((days >= period.left) & (days < period.right))
+        if not in_period.any():
+            continue
+        by_dow = lease_obligations.loc[lease_obligations.index == period].set_index("dow").reindex(range(7))
+        period_dows = dows[in_period]
+        operating[in_period] = by_dow["operating"].fillna(False).values.astype(bool)[period_dows]
+        lower[in_period] = by_dow["lower_operating_temp"].values.astype(float)[period_dows]
+        upper[in_period] = by_dow["upper_operating_temp"].values.astype(float)[period_dows]
+        start_hour[in_period] = by_dow["local_operating_start_hour"].values.astype(float)[period_dows]
+        end_hour[in_period] = by_dow["local_operating_end_hour"].values.astype(float)[period_dows]
+        timezone[in_period] = by_dow["local_timezone"].values[period_dows]
+
+    lower[~operating] = upper[~operating] = np.nan
+    utc_start = pd.Series(pd.NaT, index=days, dtype="datetime64[ns, UTC]")
+    utc_end = pd.Series(pd.NaT, index=days, dtype="datetime64[ns, UTC]")
+    for local_timezone in pd.unique(timezone[operating]):
+        in_zone = operating & (timezone == local_timezone)
+        # Localize the wall clock times per timezone so every day gets the UTC offset in effect on that day.
+        utc_start[in_zone] = _local_to_utc(days[in_zone], start_hour[in_zone], local_timezone)
+        utc_end[in_zone] = _local_to_utc(days[in_zone], end_hour[in_zone], local_timezone)
+
+    return pd.DataFrame(
+        {
+            "operating": operating,
+            "lower_operating_temp": lower,
+            "upper_operating_temp": upper,
+            "utc_operating_start": utc_start,
+            "utc_operating_end": utc_end,
+        },
+        index=days,
+        columns=CALENDAR_COLUMNS,
+    )
+
+
+class LeaseCalendar:
+    """
+    Lease calendar of a building. Days are built with build_lease_calendar and kept, so that asking for the same or a
+    smaller range again is a slice.
+    """
+
+    def __init__(self, lease_obligations):
+        """
+        :param lease_obligations: DataFrame in the format of get_lease_obligations or get_lease_obligation_schedule
+        """
+        self.lease_obligations = lease_obligations
+        self._days = None
+
+    def days(self, start_date, end_date):
+        """
+        :param start_date: A date in string format, or anything pd.Timestamp accepts.
+        :param end_date: A date in string format, or anything pd.Timestamp accepts.
+        :return: DataFrame in the format of build_lease_calendar for the days from start_date to end_date inclusive.
+        """
+        start, end = pd.Timestamp(start_date).normalize(), pd.Timestamp(end_date).normalize()
+        if self._days is None or start < self._days.index[0] or end > self._days.index[-1]:
+            if self._days is not None:
+                start, end = min(start, self._days.index[0]), max(end, self._days.index[-1])
+            self._days = build_lease_calendar(self.lease_obligations, pd.date_range(start, end))
+        return self._days.loc[pd.Timestamp(start_date).normalize():pd.Timestamp(end_date).normalize()]
+
+    def day(self, estimation_date):
+        """
+        :param estimation_date: A date in string format.
+        :return: Series with the calendar columns for a single day.
+        """
+        return self.days(estimation_date, estimation_date).iloc[0]
+
+
+@lru_cache(maxsize=None)
+def get_lease_calendar(building_id):
+    """
+    Get the (shared) lease calendar of a building.
+    :param building_id: integer
+    :return: LeaseCalendar
+    """
+    return LeaseCalendar(get_lease_obligation_schedule(building_id))
+
+
+def _local_to_utc(days, hours, local_timezone):
+    local_times = days + pd.to_timedelta(hours, unit="h")
+    # As get_operating_period_in_utc (dateutil) does: a wall clock time that occurs twice is the first one, in daylight
+    # saving time, and one skipped by the clock change gets the UTC offset in effect after it.
+    in_zone = local_times.tz_localize(
+        local_timezone, ambiguous=np.ones(len(local_times), dtype=bool), nonexistent="shift_forward"
+    )
+    offsets = in_zone.tz_localize(None) - in_zone.tz_convert("UTC").tz_localize(None)
+    return (local_times - offsets).tz_localize("UTC")
@@ -0,0 +1,316 @@
+"""
+This module houses a local, columnar cache of the floor temperature measurements so that repeated runs over the same
+history read from disk instead of the database.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from datetime import datetime
+import json
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, bindparam, text
+from .checkpoints import format_fingerprint, get_whole_day_windows, get_window_fingerprints
+from .data_loading import DEFAULT_CHUNKSIZE, get_time_bounds, _pivot_temps
+from .db import get_engine
+
+# Bump when the on-disk layout changes. Caches written with another version are rebuilt on refresh.
+CACHE_FORMAT_VERSION = 1
+
+COLUMN_DTYPES = {
+    "time": "datetime64[ns]",
+    "sensor_id": "int64",
+    "temperature": "float64",
+    "bad_data": "bool",
+}
+
+# Days up to the watermark whose fingerprints are checked on every refresh, to pick up readings that arrived late and
+# bad_data flags that changed after the day was cached.
+DEFAULT_VERIFY_DAYS = 31
+
+# Number of days fetched again per query when their fingerprints changed.
+VERIFY_CHUNK_DAYS = 7
+
+_START_OF_TIME = datetime(1970, 1, 1)
+
+SENSORS_QUERY = text(
+    "SELECT b2.id as sensor_id, b2.ignore as ignore FROM building_sensor_configs b2 WHERE b2.building_id = :building_id"
+)
+
+NEW_ROWS_QUERY = text(
+    "SELECT f1.measured_at as time, b2.id as sensor_id, f1.measurement as temperature, f1.bad_data as bad_data "
+    "FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and f1.measured_at > :watermark "
+    "ORDER BY f1.measured_at"
+).bindparams(bindparam("watermark", type_=DateTime))
+
+DAY_ROWS_QUERY = text(
+    "SELECT f1.measured_at as time, b2.id as sensor_id, f1.measurement as temperature, f1.bad_data as bad_data "
+    "FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and f1.measured_at >= :start_time and f1.measured_at < :end_time "
+    "ORDER BY f1.measured_at"
+).bindparams(bindparam("start_time", type_=DateTime), bindparam("end_time", type_=DateTime))
+
+
+class MeasurementCache:
+    """
+    Columnar cache of floor_temperature_measurements. Every building has a directory with one sub directory per month,
+    holding one .npy file per column that is memory mapped on read. Rows are stored with their bad_data flag and the
+    ignore flags of the sensors are kept in the building's meta.json, so that ignore flag changes only need a metadata
+    sync.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: directory the cache lives in. Created if it does not exist.
+        """
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def refresh(self, db, building_id, chunksize=DEFAULT_CHUNKSIZE, verify_days=DEFAULT_VERIFY_DAYS):
+        """
+        Bring the cache of a building up to date. The rows measured after the stored watermark are fetched, and the
+        ignore flags of the sensors are re-synced. Then the fingerprints (see checkpoints.get_window_fingerprints) of
+        the last verify_days days up to the watermark are compared with the cached rows, and the days that differ,
+        because readings arrived late or bad_data flags changed, are fetched again. Changes further back are only
+        picked up by a refresh with verify_days=None.
+        :param db: an active sql engine, or None for the shared engine.
+        :param building_id: integer
+        :param chunksize: number of rows fetched at a time.
+        :param verify_days: days up to the watermark to check for changes, None to check the whole cache.
+        :return: number of rows fetched, the new rows and the rows of the days that were fetched again.
+        """
+        if db is None:
+            db = get_engine()
+        meta = self._read_meta(building_id)
+        watermark = pd.Timestamp(meta["watermark"]) if meta["watermark"] else None
+        if watermark is None:
+            # Starting from scratch, drop partitions left by an older cache format or an unfinished first refresh.
+            _remove_partitions(self._building_dir(building_id))
+        params = {"building_id": building_id}
+        with db.connect() as conn:
+            sensors = pd.read_sql(SENSORS_QUERY, conn, params=params)
+
+            n_new = 0
+            new_watermark = watermark
+            pending = {}
+            conn = conn.execution_options(stream_results=True)
+            new_rows_params = dict(
+                params, watermark=watermark.to_pydatetime() if watermark is not None else _START_OF_TIME
+            )
+            for chunk in pd.read_sql(NEW_ROWS_QUERY, conn, params=new_rows_params, chunksize=chunksize):
+                if chunk.empty:
+                    continue
+                chunk = _as_cache_columns(chunk)
+                n_new += len(chunk)
+                new_watermark = chunk["time"].iloc[-1]
+                for month, month_rows in chunk.groupby(_months(chunk["time"])):
+                    pending.setdefault(month, []).append(month_rows)
+                # Rows come in time order, so every month before the one of the last row is complete.
+                last_month = str(new_watermark.to_period("M"))
+                for month in [month for month in pending if month != last_month]:
+                    self._merge_partition(building_id, month, pd.concat(pending.pop(month), ignore_index=True))
+            for month in pending:
+                self._merge_partition(building_id, month, pd.concat(pending[month], ignore_index=True))
+
+        meta["watermark"] = str(new_watermark) if new_watermark is not None else None
+        meta["sensors"] = {
+            str(int(row.sensor_id)): bool(row.ignore) for row in sensors.itertuples(index=False)
+        }
+        self._write_meta(building_id, meta)
+        if new_watermark is None:
+            return n_new
+        ignored = [int(sensor_id) for sensor_id, ignore in meta["sensors"].items() if ignore]
+        return n_new + self._verify(db, building_id, new_watermark.normalize(), verify_days, ignored)
+
+    def get_internal_temps(self, building_id, start_time, end_time):
+        """
+        Read the internal temperatures of a building from the cache. Same arguments and return value as
+        data_loading.get_internal_temps.
+        """
+        window_start, window_end = get_time_bounds(start_time, end_time)
+        window_start, window_end = np.datetime64(window_start, "ns"), np.datetime64(window_end, "ns")
+        meta = self._read_meta(building_id)
+        ignored = [int(sensor_id) for sensor_id, ignore in meta["sensors"].items() if ignore]
+
+        frames = []
+        for month in pd.period_range(pd.Timestamp(window_start), pd.Timestamp(window_end), freq="M"):
+            columns = self._load_partition(building_id, str(month), mmap_mode="r")
+            if columns is None:
+                continue
+            times = columns["time"]
+            lo = np.searchsorted(times, window_start, side="left")
+            hi = np.searchsorted(times, window_end, side="right")
+            keep = ~columns["bad_data"][lo:hi] & ~np.isin(columns["sensor_id"][lo:hi], ignored)
+            frames.append(
+                pd.DataFrame(
+                    {
+                        "time": times[lo:hi][keep],
+                        "temperature": columns["temperature"][lo:hi][keep],
+                        "sensor_id": columns["sensor_id"][lo:hi][keep],
+                    }
+                )
+            )
+        if not frames:
+            return _pivot_temps(pd.DataFrame(columns=["time", "temperature", "sensor_id"]))
+        return _pivot_temps(pd.concat(frames, ignore_index=True))
+
+    def _verify(self, db, building_id, last_day, verify_days, ignored):
+        """
+        Fetch the days up to last_day whose fingerprint in the database differs from the one of the cached rows again.
+        :return: number of rows fetched.
+        """
+        first_day = pd.Timestamp(self._cached_months(building_id)[0])
+        if verify_days is not None:
+            first_day = max(first_day, last_day - pd.Timedelta(days=verify_days - 1))
+        days = pd.date_range(first_day, last_day)
+        expected = get_window_fingerprints(db, building_id, get_whole_day_windows(days))
+        cached = self._cached_fingerprints(building_id, days, ignored)
+        # Both totals are double precision sums of the same readings, only their order differs. A total that rounds
+        # differently locally anyway only costs fetching the day again.
+        changed = pd.DatetimeIndex([day for day in days if expected[str(day)] != cached.get(str(day), "0")])
+        n_rows = 0
+        with db.connect() as conn:
+            for run in _chunk_runs(changed, VERIFY_CHUNK_DAYS):
+                params = {
+                    "building_id": building_id,
+                    "start_time": run[0].to_pydatetime(),
+                    "end_time": (run[-1] + pd.Timedelta(days=1)).to_pydatetime(),
+                }
+                rows = _as_cache_columns(pd.read_sql(DAY_ROWS_QUERY, conn, params=params))
+                self._replace_days(building_id, run, rows)
+                n_rows += len(rows)
+        return n_rows
+
+    def _cached_fingerprints(self, building_id, days, ignored):
+        """
+        :return: dict of day string to the fingerprint of the cached rows of the day that are not bad data and not of
+        an ignored sensor, in the format of checkpoints.get_window_fingerprints. Days without rows are left out.
+        """
+        start, end = np.datetime64(days[0], "ns"), np.datetime64(days[-1] + pd.Timedelta(days=1), "ns")
+        fingerprints = {}
+        for month in pd.period_range(days[0], days[-1], freq="M"):
+            columns = self._load_partition(building_id, str(month), mmap_mode="r")
+            if columns is None:
+                continue
+            lo = np.searchsorted(columns["time"], start, side="left")
+            hi = np.searchsorted(columns["time"], end, side="left")
+            keep = ~columns["bad_data"][lo:hi] & ~np.isin(columns["sensor_id"][lo:hi], ignored)
+            rows = pd.DataFrame({
+                "time": columns["time"][lo:hi][keep],
+                "temperature": columns["temperature"][lo:hi][keep],
+            })
+            by_day = rows.groupby(rows["time"].dt.normalize())
+            summary = pd.DataFrame(
+                {"n_rows": by_day.size(), "last_time": by_day["time"].max(), "total": by_day["temperature"].sum()}
+            )
+            for day, row in summary.iterrows():
+                fingerprints[str(day)] = format_fingerprint(row["n_rows"], row["last_time"], row["total"])
+        return fingerprints
+
+    def _merge_partition(self, building_id, month, rows):
+        columns = self._load_partition(building_id, month)
+        if columns is not None:
+            rows = pd.concat([pd.DataFrame(columns), rows], ignore_index=True)
+        # A refresh that died before writing meta.json fetches the same rows again, keep the newest copy.
+        rows = rows.drop_duplicates(subset=["time", "sensor_id"], keep="last")
+        self._write_partition(building_id, month, rows)
+
+    def _replace_days(self, building_id, days, rows):
+        """
+        Replace the cached rows of days with rows. Only the partitions of the months of days are written.
+        """
+        row_months = _months(rows["time"])
+        for month in sorted(set(str(day.to_period("M")) for day in days)):
+            month_rows = rows[row_months == month]
+            columns = self._load_partition(building_id, month)
+            if columns is not None:
+                cached = pd.DataFrame(columns)
+                cached = cached[~cached["time"].dt.normalize().isin(days)]
+                month_rows = pd.concat([cached, month_rows], ignore_index=True)
+            self._write_partition(building_id, month, month_rows)
+
+    def _write_partition(self, building_id, month, rows):
+        rows = rows.sort_values(["time", "sensor_id"])
+        partition_dir = self._partition_dir(building_id, month)
+        os.makedirs(partition_dir, exist_ok=True)
+        for column, dtype in COLUMN_DTYPES.items():
+            _atomic_save(os.path.join(partition_dir, column + ".npy"), rows[column].values.astype(dtype))
+
+    def _load_partition(self, building_id, month, mmap_mode=None):
+        partition_dir = self._partition_dir(building_id, month)
+        if not os.path.exists(os.path.join(partition_dir, "time.npy")):
+            return None
+        return {
+            column: np.load(os.path.join(partition_dir, column + ".npy"), mmap_mode=mmap_mode)
+            for column in COLUMN_DTYPES
+        }
+
+    def _cached_months(self, building_id):
+        building_dir = self._building_dir(building_id)
+        if not os.path.isdir(building_dir):
+            return []
+        return sorted(name for name in os.listdir(building_dir) if os.path.isdir(os.path.join(building_dir, name)))
+
+    def _building_dir(self, building_id):
+        return os.path.join(self.cache_dir, "building_{}".format(building_id))
+
+    def _partition_dir(self, building_id, month):
+        return os.path.join(self._building_dir(building_id), month)
+
+    def _read_meta(self, building_id):
+        path = os.path.join(self._building_dir(building_id), "meta.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                meta = json.load(f)
+            if meta.get("version") == CACHE_FORMAT_VERSION:
+                return meta
+        return {"version": CACHE_FORMAT_VERSION, "watermark": None, "sensors": {}}
+
+    def _write_meta(self, building_id, meta):
+        os.makedirs(self._building_dir(building_id), exist_ok=True)
+        path = os.path.join(self._building_dir(building_id), "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+def _as_cache_columns(df):
+    df = df.assign(time=pd.to_datetime(df["time"]))
+    return pd.DataFrame({column: df[column].values.astype(dtype) for column, dtype in COLUMN_DTYPES.items()})
+
+
+def _months(times):
+    return times.dt.to_period("M").astype(str).values
+
+
+def _chunk_runs(days, chunk_days):
+    """
+    :param days: sorted DatetimeIndex of days
+    :return: list of DatetimeIndexes of at most chunk_days consecutive days, covering days.
+    """
+    if not len(days):
+        return []
+    run_ids = (days.to_series().diff() != pd.Timedelta(days=1)).cumsum().values
+    runs = []
+    for run_id in np.unique(run_ids):
+        run = days[run_ids == run_id]
+        runs.extend(run[i:i + chunk_days] for i in range(0, len(run), chunk_days))
+    return runs
+
+
+def _atomic_save(path, values):
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, values)
+    os.replace(path + ".tmp", path)
+
+
+def _remove_partitions(building_dir):
+    if not os.path.isdir(building_dir):
+        return
+    for month in os.listdir(building_dir):
+        partition_dir = os.path.join(building_dir, month)
+        if os.path.isdir(partition_dir):
+            for name in os.listdir(partition_dir):
+                os.remove(os.path.join(partition_dir, name))
+            os.rmdir(partition_dir)
@@ -0,0 +1,200 @@
+"""
+This module contains an online version of the lease satisfied time estimation, which updates as readings arrive
+instead of re-querying whole days.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import numpy as np
+import pandas as pd
+from .data_loading import get_day_window
+from .lease_calendar import get_lease_calendar
+from .lease_satisfied_estimator import LEGACY_GOOD_SENSORS
+from .sensor_matrix import GRID_FREQ
+
+# How far readings may lag behind the latest grid point seen before their grid point is finalized without them.
+DEFAULT_ALLOWED_LATENESS = "30min"
+
+
+class OnlineLeaseSatisfiedEstimator:
+    """
+    Online counterpart of YourEstimator for a single building. Readings are fed in batches with update(). Every grid
+    point is finalized once a reading for a grid point more than allowed_lateness later arrives (or on flush()), at
+    which point the building mean over the relevant sensors is computed exactly the way SensorMatrix.mean does it.
+    Sensors may report out of order as long as they lag the others by at most allowed_lateness. The first finalized
+    grid point of an operating day with the mean inside the lease obligation temperature range produces an event, so
+    events come allowed_lateness after their grid point.
+
+    The state is the readings of the grid points that are still open (at most one value per sensor each) and the
+    result of the current day, so it is O(sensors x allowed_lateness). Replaying a historical day gives the same
+    result as YourEstimator.compute_lease_satisfied_time for that day, if no reading was later than
+    allowed_lateness.
+    """
+
+    def __init__(self, building_id, relevant_sensors=None, lease_calendar=None, operating_window_only=False,
+                 freq=GRID_FREQ, allowed_lateness=DEFAULT_ALLOWED_LATENESS):
+        """
+        :param building_id: integer
+        :param relevant_sensors: set of the sensor ids to estimate from. Defaults to the estimators' default.
+        :param lease_calendar: LeaseCalendar of the building. Defaults to get_lease_calendar(building_id).
+        :param operating_window_only: only look for the satisfied time inside the operating period of the day. The
+        batch estimator looks at the whole day window, so replays only agree with it if this is False.
+        :param freq: grid frequency
+        :param allowed_lateness: how far behind the latest grid point with a reading a reading may be and still count.
+        0 finalizes every grid point as soon as a reading for a later one arrives.
+        """
+        self.building_id = building_id
+        self.relevant_sensors = LEGACY_GOOD_SENSORS if relevant_sensors is None else relevant_sensors
+        self.lease_calendar = lease_calendar or get_lease_calendar(building_id)
+        self.operating_window_only = operating_window_only
+        self.freq = pd.Timedelta(freq)
+        self.allowed_lateness = pd.Timedelta(allowed_lateness)
+        self.results = {}
+        self.n_late = 0
+        self._open_slots = {}
+        self._finalized_until = None
+        self._latest_slot = None
+        self._day = None
+
+    def update(self, readings):
+        """
+        Feed a batch of readings.
+        :param readings: DataFrame with columns {time, sensor_id, temperature}, e.g. new rows of the query behind
+        get_internal_temps. Readings for grid points that were already finalized are counted in n_late and dropped.
+        :return: list of lease satisfied events, see _finalize.
+        """
+        if len(readings) == 0:
+            return []
+        times = pd.to_datetime(readings["time"])
+        # Only readings inside the day window of their day count, like in get_internal_temps for a single day.
+        window_start, window_end = get_day_window(str(times.iloc[0]))
+        in_window = (times - times.dt.normalize() <= window_end - window_start).values
+        slots = times.dt.floor(self.freq).values[in_window]
+        order = np.argsort(slots, kind="mergesort")
+        for slot, sensor_id, temperature in zip(
+            slots[order],
+            readings["sensor_id"].values[in_window][order],
+            readings["temperature"].values[in_window][order],
+        ):
+            slot = pd.Timestamp(slot)
+            if self._finalized_until is not None and slot <= self._finalized_until:
+                self.n_late += 1
+                continue
+            if pd.isna(temperature):
+                continue
+            # Same rounding as the float32 SensorMatrix.
+            self._open_slots.setdefault(slot, {})[int(sensor_id)] = float(np.float32(temperature))
+            if self._latest_slot is None or slot > self._latest_slot:
+                self._latest_slot = slot
+        if self._latest_slot is None:
+            return []
+        # Readings more than allowed_lateness behind the latest grid point with a reading are late.
+        complete_before = self._latest_slot - self.allowed_lateness
+        return self._finalize(lambda slot: slot < complete_before)
+
+    def flush(self):
+        """
+        Finalize all open grid points, e.g. at the end of a replay.
+        :return: list of lease satisfied events, see _finalize.
+        """
+        return self._finalize(lambda slot: True)
+
+    def result(self, estimation_date):
+        """
+        :param estimation_date: A date in string format.
+        :return: (operating, lease_satisfied_time) for the day, in the format of compute_lease_satisfied_time, from
+        the grid points finalized so far.
+        """
+        day = self.results.get(pd.Timestamp(estimation_date).normalize())
+        if day is None or day["operating"] is None:
+            return None, None
+        if not day["operating"]:
+            return False, None
+        satisfied_time = day["lease_satisfied_time"]
+        return True, satisfied_time if satisfied_time is not None else "Not Satisfied"
+
+    def results_frame(self):
+        """
+        :return: DataFrame of the results of all days seen, in the format of compute_lease_satisfied_times.
+        """
+        df_dict = {}
+        for day in sorted(self.results):
+            operating, lease_satisfied_time = self.result(day)
+            df_dict[str(day)] = {
+                "building_id": self.building_id,
+                "operating": operating,
+                "lease_satisfied_time": lease_satisfied_time,
+            }
+        return pd.DataFrame.from_dict(df_dict, orient="index")
+
+    def _finalize(self, is_complete):
+        """
+        Finalize the open grid points that are complete, in time order.
+        :return: list of events, dicts with {building_id, date, lease_satisfied_time, mean_temp}.
+        """
+        events = []
+        for slot in sorted(slot for slot in self._open_slots if is_complete(slot)):
+            readings = self._open_slots.pop(slot)
+            self._finalized_until = slot
+            event = self._finalize_slot(slot, readings)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def _finalize_slot(self, slot, readings):
+        day = slot.normalize()
+        if not readings:
+            return None
+        if day != self._day:
+            self._day = day
+            calendar_day = self.lease_calendar.day(day)
+            lower, upper = calendar_day["lower_operating_temp"], calendar_day["upper_operating_temp"]
+            self.results[day] = {
+                # Same rule as operatingDayCheck: the day of week of the first reading of the day.
+                "operating": day.dayofweek <= 4,
+                "lease_satisfied_time": None,
+                # Same range as getPred2 on days the lease obligations do not cover.
+                "lower": 70. if pd.isna(lower) else lower,
+                "upper": 75. if pd.isna(upper) else upper,
+                "window": (
+                    _naive_utc(calendar_day["utc_operating_start"]),
+                    _naive_utc(calendar_day["utc_operating_end"]),
+                ),
+            }
+        state = self.results[day]
+        if state["lease_satisfied_time"] is not None or not state["operating"]:
+            return None
+        if self.operating_window_only and not state["window"][0] <= slot <= state["window"][1]:
+            return None
+
+        mean_temp = _running_mean(readings, self.relevant_sensors)
+        if mean_temp is None or not state["lower"] <= mean_temp <= state["upper"]:
+            return None
+        state["lease_satisfied_time"] = slot
+        return {
+            "building_id": self.building_id,
+            "date": str(day),
+            "lease_satisfied_time": slot,
+            "mean_temp": mean_temp,
+        }
+
+
+def _running_mean(readings, relevant_sensors):
+    """
+    Mean of the readings of the relevant sensors, summed in sensor order like SensorMatrix.sum.
+    :param readings: dict of sensor_id to float32 rounded reading
+    :return: float, or None if no relevant sensor has a reading
+    """
+    total, count = 0., 0
+    for sensor_id in sorted(readings):
+        if sensor_id in relevant_sensors:
+            total += readings[sensor_id]
+            count += 1
+    if count == 0:
+        return None
+    return float(np.float64(total) / count)
+
+
+def _naive_utc(timestamp):
+    if pd.isna(timestamp):
+        return pd.NaT
+    return pd.Timestamp(timestamp).tz_convert("UTC").tz_localize(None)
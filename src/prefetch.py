@@ -0,0 +1,128 @@
+"""
+This module houses a pipelined runner for compute_lease_satisfied_times, which fetches the next chunks of days while
+the current one is estimated.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import time
+import pandas as pd
+from .instrumentation import get_metrics
+from .lease_satisfied_estimator import DEFAULT_CHUNK_DAYS, LeaseSatisfiedTimeEstimator
+
+# Number of loaded chunks that may wait for estimation.
+DEFAULT_PREFETCH = 2
+
+_DONE = object()
+
+
+def run_prefetched(tasks, prefetch=DEFAULT_PREFETCH, chunk_days=DEFAULT_CHUNK_DAYS, on_result=None):
+    """
+    Run compute_lease_satisfied_times for many (estimator, start_date, end_date) tasks as a producer / consumer
+    pipeline. A fetch thread loads the chunks of days of all tasks in order (load_chunk) into a queue of at most
+    prefetch chunks, while an estimation thread works through the queue (estimate_chunk), so queries and estimation
+    overlap, also across tasks. At most prefetch + 2 chunks are in memory: the queued ones, the one being fetched and
+    the one being estimated. Estimators that override compute_lease_satisfied_times are run whole on the estimation
+    thread. Time spent waiting for the queue is recorded as the "prefetch_wait" stage.
+    :param tasks: list of (estimator, start_date, end_date) tuples
+    :param prefetch: queue depth, at least 1
+    :param chunk_days: Number of days loaded per query.
+    :param on_result: optional function called with (task index, DataFrame) as soon as a task is done.
+    :return: tuple (results, failures) of dicts keyed by task index with the DataFrames of compute_lease_satisfied_times
+    and the exceptions of the tasks that failed respectively.
+    """
+    if prefetch < 1:
+        raise ValueError("prefetch must be at least 1, got {}".format(prefetch))
+    loop = asyncio.new_event_loop()
+    fetch_executor = ThreadPoolExecutor(max_workers=1)
+    estimate_executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        return loop.run_until_complete(
+            _pipeline(tasks, prefetch, chunk_days, fetch_executor, estimate_executor, on_result)
+        )
+    finally:
+        fetch_executor.shutdown()
+        estimate_executor.shutdown()
+        loop.close()
+
+
+async def _pipeline(tasks, prefetch, chunk_days, fetch_executor, estimate_executor, on_result):
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue(maxsize=prefetch)
+    producer = loop.create_task(_produce(loop, queue, tasks, chunk_days, fetch_executor))
+    try:
+        return await _consume(loop, queue, tasks, chunk_days, estimate_executor, on_result)
+    finally:
+        # Only still running if the consumer died, don't leave it blocked on a full queue.
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+async def _produce(loop, queue, tasks, chunk_days, fetch_executor):
+    for i, (estimator, start_date, end_date) in enumerate(tasks):
+        if not _is_chunked(estimator):
+            await queue.put((i, None, None, None))
+            continue
+        for chunk in estimator.chunk_dates(start_date, end_date, chunk_days):
+            try:
+                df_chunk = await loop.run_in_executor(fetch_executor, estimator.load_chunk, chunk)
+            except Exception as e:
+                await queue.put((i, chunk, None, e))
+                break
+            await queue.put((i, chunk, df_chunk, None))
+    await queue.put(_DONE)
+
+
+async def _consume(loop, queue, tasks, chunk_days, estimate_executor, on_result):
+    metrics = get_metrics()
+    rows, results, failures = {}, {}, {}
+    n_chunks = [
+        len(estimator.chunk_dates(start_date, end_date, chunk_days)) if _is_chunked(estimator) else 1
+        for estimator, start_date, end_date in tasks
+    ]
+    n_done = [0] * len(tasks)
+    while True:
+        wait_start = time.perf_counter()
+        item = await queue.get()
+        if item is _DONE:
+            break
+        i, chunk, df_chunk, error = item
+        estimator, start_date, end_date = tasks[i]
+        metrics.add("prefetch_wait", estimator.building_id, calls=1, wall_seconds=time.perf_counter() - wait_start)
+        if i in failures:
+            continue
+        try:
+            if error is not None:
+                raise error
+            if chunk is None:
+                results[i] = await loop.run_in_executor(
+                    estimate_executor, estimator.compute_lease_satisfied_times, start_date, end_date, chunk_days
+                )
+            else:
+                rows.setdefault(i, {}).update(
+                    await loop.run_in_executor(estimate_executor, estimator.estimate_chunk, chunk, df_chunk)
+                )
+            n_done[i] += 1
+            if n_done[i] == n_chunks[i]:
+                _finish(i, results, rows, on_result)
+        except Exception as e:
+            failures[i] = e
+    for i in range(len(tasks)):
+        # Tasks without any days.
+        if i not in failures and i not in results:
+            _finish(i, results, rows, on_result)
+    return results, failures
+
+
+def _finish(i, results, rows, on_result):
+    if i not in results:
+        results[i] = pd.DataFrame.from_dict(rows.pop(i, {}), orient="index")
+    if on_result is not None:
+        on_result(i, results[i])
+
+
+def _is_chunked(estimator):
+    return (
+        type(estimator).compute_lease_satisfied_times is LeaseSatisfiedTimeEstimator.compute_lease_satisfied_times
+    )
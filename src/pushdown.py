@@ -0,0 +1,256 @@
+"""
+This module houses the pushdown execution mode of the lease satisfied time estimation: the building mean per
+timestamp and the first timestamp it is inside the lease obligation temperature range are computed in the database,
+which returns a single row per day instead of every sensor reading.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, Float, bindparam, text
+from .data_loading import get_day_window, values_rows
+from .db import get_engine
+from .instrumentation import get_metrics
+from .lease_satisfied_estimator import DEFAULT_CHUNK_DAYS, YourEstimator, _first_in_band
+from .sensor_matrix import get_internal_temp_matrix
+
+# Where the satisfied time is searched: the whole day window, like YourEstimator, or the operating period of the
+# lease calendar.
+SEARCH_WINDOWS = ("day", "operating")
+
+# Temperature range used on days the lease obligations do not cover, the range getPred2 uses.
+DEFAULT_TEMP_RANGE = (70., 75.)
+
+_WINDOW_COLUMNS = ["day_start", "day_end", "search_start", "search_end", "lower_temp", "upper_temp"]
+
+# Filled in by _lease_satisfied_query with one VALUES row per day.
+LEASE_SATISFIED_QUERY = (
+    "WITH windows (day_start, day_end, search_start, search_end, lower_temp, upper_temp) AS (VALUES {windows}), "
+    "per_time AS ("
+    " SELECT w.day_start, f1.measured_at as time,"
+    " AVG(CASE WHEN b2.id IN :sensor_ids THEN f1.measurement END) as mean_temp"
+    " FROM windows w"
+    " JOIN floor_temperature_measurements f1 ON f1.measured_at >= w.day_start AND f1.measured_at <= w.day_end"
+    " JOIN building_sensor_configs b2 ON b2.id = f1.building_sensor_config_id"
+    " WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False"
+    " GROUP BY w.day_start, f1.measured_at"
+    "), banded AS ("
+    " SELECT p.day_start, p.time, p.mean_temp,"
+    " CASE WHEN p.time >= w.search_start AND p.time <= w.search_end"
+    " AND p.mean_temp >= w.lower_temp AND p.mean_temp <= w.upper_temp THEN 1 ELSE 0 END as in_band"
+    " FROM per_time p JOIN windows w ON w.day_start = p.day_start"
+    "), ranked AS ("
+    " SELECT day_start, time, mean_temp, in_band,"
+    " ROW_NUMBER() OVER (PARTITION BY day_start, in_band ORDER BY time) as band_rank"
+    " FROM banded"
+    ") "
+    "SELECT d.day_start, d.first_time, d.n_times, r.time as lease_satisfied_time, r.mean_temp "
+    "FROM (SELECT day_start, MIN(time) as first_time, COUNT(*) as n_times FROM per_time GROUP BY day_start) d "
+    "LEFT JOIN ranked r ON r.day_start = d.day_start AND r.in_band = 1 AND r.band_rank = 1"
+)
+
+
+def get_lease_satisfied_windows(lease_calendar, start_date, end_date, search_window="day"):
+    """
+    :param lease_calendar: LeaseCalendar of the building
+    :param start_date: A date in string format.
+    :param end_date: A date in string format.
+    :param search_window: one of SEARCH_WINDOWS
+    :return: DataFrame indexed by day with the naive UTC {day_start, day_end} window of readings (see
+    get_day_window), the {search_start, search_end} window the satisfied time is searched in and the
+    {lower_temp, upper_temp} range.
+    """
+    if search_window not in SEARCH_WINDOWS:
+        raise ValueError("search_window must be one of {}, got {!r}".format(SEARCH_WINDOWS, search_window))
+    calendar = lease_calendar.days(start_date, end_date)
+    day_start = calendar.index
+    windows = pd.DataFrame(
+        {
+            "day_start": day_start,
+            "day_end": [get_day_window(str(day))[1] for day in day_start],
+            "lower_temp": calendar["lower_operating_temp"].fillna(DEFAULT_TEMP_RANGE[0]).values,
+            "upper_temp": calendar["upper_operating_temp"].fillna(DEFAULT_TEMP_RANGE[1]).values,
+        },
+        index=day_start,
+    )
+    if search_window == "day":
+        windows["search_start"], windows["search_end"] = windows["day_start"], windows["day_end"]
+    else:
+        # Days without an operating period get an empty search window that ends before the day starts.
+        never = windows["day_start"] - pd.Timedelta(seconds=1)
+        windows["search_start"] = _naive_utc(calendar["utc_operating_start"]).fillna(never)
+        windows["search_end"] = _naive_utc(calendar["utc_operating_end"]).fillna(never - pd.Timedelta(seconds=1))
+    return windows[_WINDOW_COLUMNS]
+
+
+def get_lease_satisfied_times_pushdown(db, building_id, sensor_ids, windows, chunk_days=DEFAULT_CHUNK_DAYS):
+    """
+    Compute the lease satisfied times of a range of days in the database, chunk_days days per query.
+    :param db: an active sql engine, or None for the shared engine.
+    :param building_id: integer
+    :param sensor_ids: set of the sensor ids the building mean is taken over
+    :param windows: DataFrame as returned by get_lease_satisfied_windows
+    :param chunk_days: number of days per query
+    :return: DataFrame indexed by day with columns {first_time, n_times, lease_satisfied_time, mean_temp}. Days
+    without readings are missing. lease_satisfied_time and mean_temp are NaT / NaN if the mean never was in range.
+    """
+    if db is None:
+        db = get_engine()
+    frames = []
+    metrics = get_metrics()
+    with db.connect() as conn:
+        for i in range(0, len(windows), chunk_days):
+            chunk = windows.iloc[i:i + chunk_days]
+            query, params = _lease_satisfied_query(chunk, building_id, sensor_ids)
+            with metrics.stage("sql", building_id) as counters:
+                frames.append(pd.read_sql(query, conn, params=params))
+                counters["rows"] = len(frames[-1])
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=["day_start", "first_time", "n_times", "lease_satisfied_time", "mean_temp"]
+    )
+    for column in ["day_start", "first_time", "lease_satisfied_time"]:
+        df[column] = pd.to_datetime(df[column])
+    return df.set_index("day_start").sort_index()
+
+
+def get_lease_satisfied_times_pandas(db, building_id, sensor_ids, windows, chunk_days=DEFAULT_CHUNK_DAYS,
+                                     cache=None):
+    """
+    Reference implementation of get_lease_satisfied_times_pushdown: the readings are loaded into a SensorMatrix and
+    reduced the way YourEstimator does it.
+    :param cache: optional MeasurementCache to read from instead of the database.
+    :return: Same as get_lease_satisfied_times_pushdown.
+    """
+    rows = {}
+    for i in range(0, len(windows), chunk_days):
+        chunk = windows.iloc[i:i + chunk_days]
+        matrix = get_internal_temp_matrix(
+            db, building_id, str(chunk["day_start"].iloc[0]), str(chunk["day_end"].iloc[-1]), cache=cache
+        )
+        for day, window in chunk.iterrows():
+            day_matrix = matrix.time_slice(window["day_start"], window["day_end"])
+            valid_times = day_matrix.valid_times()
+            if len(valid_times) == 0:
+                continue
+            search = day_matrix.time_slice(window["search_start"], window["search_end"]).select(sensor_ids)
+            mean_temp = search.mean()
+            satisfied_time = _first_in_band(search.times, mean_temp, window["lower_temp"], window["upper_temp"])
+            satisfied = satisfied_time != "Not Satisfied"
+            rows[day] = {
+                "first_time": valid_times[0],
+                "n_times": len(valid_times),
+                "lease_satisfied_time": satisfied_time if satisfied else pd.NaT,
+                "mean_temp": mean_temp[search.times.get_loc(satisfied_time)] if satisfied else np.nan,
+            }
+    df = pd.DataFrame.from_dict(rows, orient="index")
+    df = df.reindex(columns=["first_time", "n_times", "lease_satisfied_time", "mean_temp"])
+    df.index.name = "day_start"
+    return df.sort_index()
+
+
+def compare_pushdown_with_pandas(db, building_id, sensor_ids, windows, chunk_days=DEFAULT_CHUNK_DAYS, cache=None):
+    """
+    Run both implementations and return the days on which they disagree. Means are only compared for days where
+    both find the same satisfied time, up to the float32 rounding of the SensorMatrix.
+    :return: DataFrame indexed by day with the columns of both, suffixed _pushdown and _pandas, for the days where the
+    readings, the satisfied time or the mean differ. Empty if they agree.
+    """
+    pushdown = get_lease_satisfied_times_pushdown(db, building_id, sensor_ids, windows, chunk_days)
+    reference = get_lease_satisfied_times_pandas(db, building_id, sensor_ids, windows, chunk_days, cache=cache)
+    both = pushdown.join(reference, how="outer", lsuffix="_pushdown", rsuffix="_pandas")
+    differs = (
+        (both["first_time_pushdown"] != both["first_time_pandas"])
+        | (both["n_times_pushdown"] != both["n_times_pandas"])
+        | ~_same_times(both["lease_satisfied_time_pushdown"], both["lease_satisfied_time_pandas"])
+        | ~np.isclose(both["mean_temp_pushdown"], both["mean_temp_pandas"], rtol=1e-6, equal_nan=True)
+    )
+    return both[differs]
+
+
+def to_lease_satisfied_times(building_id, results, windows):
+    """
+    Turn the result of get_lease_satisfied_times_pushdown (or _pandas) into the output of
+    compute_lease_satisfied_times. Like operatingDayCheck, a day is operating if its first reading is on a weekday.
+    :return: DataFrame indexed by date string with columns {building_id, operating, lease_satisfied_time}
+    """
+    df_dict = {}
+    for day in windows.index:
+        operating, lease_satisfied_time = None, None
+        if day in results.index:
+            operating = bool(results.loc[day, "first_time"].dayofweek <= 4)
+            satisfied_time = results.loc[day, "lease_satisfied_time"]
+            if operating:
+                lease_satisfied_time = "Not Satisfied" if pd.isna(satisfied_time) else satisfied_time
+        df_dict[str(day)] = {
+            "building_id": building_id,
+            "operating": operating,
+            "lease_satisfied_time": lease_satisfied_time,
+        }
+    return pd.DataFrame.from_dict(df_dict, orient="index")
+
+
+class PushdownEstimator(YourEstimator):
+    """
+    YourEstimator executed in the database. Only the one result row per day is transferred, the measurement cache is
+    not used.
+    """
+
+    def __init__(self, building_id, db=None, cache=None, sensor_index=None, search_window="day", **kwargs):
+        """
+        :param search_window: one of SEARCH_WINDOWS. "day" gives the same results as YourEstimator.
+        """
+        super().__init__(building_id, db=db, cache=cache, sensor_index=sensor_index, **kwargs)
+        self.search_window = search_window
+
+    def get_params(self):
+        """
+        :return: Same as LeaseSatisfiedTimeEstimator.get_params.
+        """
+        return dict(super().get_params(), search_window=self.search_window)
+
+    def compute_lease_satisfied_time(self, estimation_date):
+        """
+        :param estimation_date: date in string format
+        :return: Same as YourEstimator.compute_lease_satisfied_time.
+        """
+        df = self.compute_lease_satisfied_times(estimation_date, estimation_date)
+        return df["operating"].iloc[0], df["lease_satisfied_time"].iloc[0]
+
+    def compute_lease_satisfied_times(self, start_date, end_date, chunk_days=DEFAULT_CHUNK_DAYS):
+        """
+        :param start_date: A date in string format.
+        :param end_date: A date in string format.
+        :param chunk_days: Number of days computed per query.
+        :return: Same as LeaseSatisfiedTimeEstimator.compute_lease_satisfied_times.
+        """
+        windows = get_lease_satisfied_windows(self.lease_calendar, start_date, end_date, self.search_window)
+        results = get_lease_satisfied_times_pushdown(
+            self.db, self.building_id, self.relevant_sensors, windows, chunk_days
+        )
+        return to_lease_satisfied_times(self.building_id, results, windows)
+
+
+def _lease_satisfied_query(windows, building_id, sensor_ids):
+    """
+    :return: tuple (query, params) computing LEASE_SATISFIED_QUERY for the days in windows.
+    """
+    types = OrderedDict(
+        (column, Float if column in ("lower_temp", "upper_temp") else DateTime) for column in _WINDOW_COLUMNS
+    )
+    rows, bindparams, params = values_rows(windows, types)
+    params["building_id"] = building_id
+    # Sensor ids are positive, -1 keeps the IN list valid when no sensor is selected.
+    params["sensor_ids"] = sorted(int(sensor_id) for sensor_id in sensor_ids) or [-1]
+    query = text(LEASE_SATISFIED_QUERY.format(windows=rows)).bindparams(
+        bindparam("sensor_ids", expanding=True), *bindparams
+    )
+    return query, params
+
+
+def _naive_utc(times):
+    return times.dt.tz_convert("UTC").dt.tz_localize(None)
+
+
+def _same_times(a, b):
+    return (a == b) | (a.isna() & b.isna())
@@ -0,0 +1,296 @@
+"""
+This module houses a cache of estimator results per building-day, so that repeated estimates of the same days (e.g.
+for dashboards, re-exports or comparing estimators) skip the query and the computation.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from collections import OrderedDict
+import json
+import os
+import sqlite3
+import threading
+import time
+import pandas as pd
+from .checkpoints import get_day_fingerprints, get_estimator_key
+
+# Bump when the stored format changes. Stores written with another version are emptied on open.
+RESULT_CACHE_VERSION = 1
+
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_MAX_DISK_BYTES = 256 * 2 ** 20
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE IF NOT EXISTS results ("
+    " building_id INTEGER, date TEXT, estimator TEXT, fingerprint TEXT, value TEXT, size INTEGER, last_used REAL,"
+    " PRIMARY KEY (building_id, date, estimator))",
+    "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)",
+]
+
+
+class ResultCache:
+    """
+    Estimator results keyed by (building_id, date, estimator key), see checkpoints.get_estimator_key, and validated
+    against the fingerprint of the day's data, see checkpoints.get_day_fingerprints. A result is only returned while
+    the fingerprint it was computed from is current, so late or re-flagged readings, and a new estimator version or
+    parameters, make it a miss. An in-process LRU of at most max_entries results sits in front of a SQLite file of at
+    most max_disk_bytes, both evict the least recently used results. Safe to share between threads.
+    """
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES, max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        """
+        :param path: SQLite file of the persistent store, created if it does not exist. None keeps results in memory
+        only.
+        :param max_entries: number of results kept in memory
+        :param max_disk_bytes: size of the stored results on disk, after which the least recently used are deleted.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._stats = dict.fromkeys(["memory_hits", "disk_hits", "misses", "stale", "evictions"], 0)
+        self._conn = None
+        self._disk_bytes = 0
+        if path is not None:
+            self._open()
+
+    def get(self, building_id, date, estimator_key, fingerprint):
+        """
+        :param date: date string, see day_key
+        :return: the (operating, lease_satisfied_time) result, or None on a miss.
+        """
+        key = (building_id, day_key(date), estimator_key)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                source = "memory_hits"
+            elif self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT fingerprint, value FROM results WHERE building_id = ? AND date = ? AND estimator = ?", key
+                ).fetchone()
+                if row is not None:
+                    entry = (row[0], _decode(row[1]))
+                    self._conn.execute(
+                        "UPDATE results SET last_used = ? WHERE building_id = ? AND date = ? AND estimator = ?",
+                        (time.time(),) + key,
+                    )
+                    self._conn.commit()
+                    self._remember(key, entry)
+                source = "disk_hits"
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[0] != fingerprint:
+                self._stats["stale"] += 1
+                self._stats["misses"] += 1
+                self._forget(key)
+                return None
+            self._stats[source] += 1
+            return entry[1]
+
+    def put(self, building_id, date, estimator_key, fingerprint, result):
+        """
+        Store the result of a day, replacing what was stored for the same building, date and estimator.
+        :param result: tuple (operating, lease_satisfied_time) as returned by compute_lease_satisfied_time
+        """
+        key = (building_id, day_key(date), estimator_key)
+        entry = (fingerprint, tuple(result))
+        with self._lock:
+            self._remember(key, entry)
+            if self._conn is None:
+                return
+            value = _encode(entry[1])
+            previous = self._conn.execute(
+                "SELECT size FROM results WHERE building_id = ? AND date = ? AND estimator = ?", key
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (fingerprint, value, len(value), time.time()),
+            )
+            self._disk_bytes += len(value) - (previous[0] if previous else 0)
+            self._evict_disk()
+            self._conn.commit()
+
+    def get_or_compute(self, estimator, estimation_date, fingerprints=None):
+        """
+        Cached estimator.compute_lease_satisfied_time. The date is normalized to its day window, see day_key.
+        :param estimator: LeaseSatisfiedTimeEstimator
+        :param estimation_date: A date in string format.
+        :param fingerprints: function of (estimator, DatetimeIndex of days) returning a dict of date string to the
+        fingerprint of the day. Fingerprints the days in the database of the estimator if None.
+        :return: Same as compute_lease_satisfied_time.
+        """
+        date = day_key(estimation_date)
+        estimator_key = get_estimator_key(estimator)
+        fingerprint = (fingerprints or database_fingerprints)(estimator, pd.DatetimeIndex([date]))[date]
+        result = self.get(estimator.building_id, date, estimator_key, fingerprint)
+        if result is None:
+            result = estimator.compute_lease_satisfied_time(date)
+            self.put(estimator.building_id, date, estimator_key, fingerprint, result)
+        return result
+
+    def get_or_compute_range(self, estimator, start_date, end_date, fingerprints=None):
+        """
+        Cached estimator.compute_lease_satisfied_times. The days are fingerprinted in one pass and only the runs of
+        consecutive missing days are computed.
+        :param fingerprints: see get_or_compute
+        :return: Same as compute_lease_satisfied_times.
+        """
+        dates = pd.date_range(start=start_date, end=end_date)
+        estimator_key = get_estimator_key(estimator)
+        fingerprints = (fingerprints or database_fingerprints)(estimator, dates)
+        results = OrderedDict()
+        missing = []
+        for date in dates:
+            results[str(date)] = self.get(estimator.building_id, str(date), estimator_key, fingerprints[str(date)])
+            if results[str(date)] is None:
+                missing.append(date)
+        for run_start, run_end in _consecutive_runs(missing):
+            computed = estimator.compute_lease_satisfied_times(str(run_start.date()), str(run_end.date()))
+            for date, row in computed.iterrows():
+                result = (row["operating"], row["lease_satisfied_time"])
+                self.put(estimator.building_id, date, estimator_key, fingerprints[date], result)
+                results[date] = result
+        return pd.DataFrame.from_dict(
+            OrderedDict(
+                (date, {
+                    "building_id": estimator.building_id,
+                    "operating": result[0],
+                    "lease_satisfied_time": result[1],
+                })
+                for date, result in results.items()
+            ),
+            orient="index",
+        )
+
+    def stats(self):
+        """
+        :return: dict with the memory_hits, disk_hits, misses (including stale), stale (fingerprint changed) and
+        evictions (from memory or disk) so far, the hit_rate, and the current number of memory_entries and
+        disk_bytes.
+        """
+        with self._lock:
+            stats = dict(self._stats, memory_entries=len(self._memory), disk_bytes=self._disk_bytes)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else None
+        return stats
+
+    def clear(self):
+        """
+        Drop all stored results, keeping the statistics.
+        """
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM results")
+                self._conn.commit()
+                self._disk_bytes = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        row = self._conn.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()
+        if row is None or int(row[0]) != RESULT_CACHE_VERSION:
+            self._conn.execute("DELETE FROM results")
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(RESULT_CACHE_VERSION),)
+            )
+        self._conn.commit()
+        self._disk_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _forget(self, key):
+        self._memory.pop(key, None)
+        if self._conn is not None:
+            row = self._conn.execute(
+                "SELECT size FROM results WHERE building_id = ? AND date = ? AND estimator = ?", key
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("DELETE FROM results WHERE building_id = ? AND date = ? AND estimator = ?", key)
+                self._conn.commit()
+                self._disk_bytes -= row[0]
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = self._conn.execute(
+                "SELECT building_id, date, estimator, size FROM results ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for building_id, date, estimator, size in rows:
+                self._conn.execute(
+                    "DELETE FROM results WHERE building_id = ? AND date = ? AND estimator = ?",
+                    (building_id, date, estimator),
+                )
+                self._disk_bytes -= size
+                self._stats["evictions"] += 1
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+
+
+def database_fingerprints(estimator, dates):
+    """
+    :param estimator: LeaseSatisfiedTimeEstimator
+    :param dates: DatetimeIndex of days
+    :return: the current fingerprints of the days in the database of the estimator, see get_day_fingerprints.
+    """
+    return get_day_fingerprints(estimator.db, estimator.building_id, dates)
+
+
+def day_key(date):
+    """
+    :param date: date string or Timestamp
+    :return: the 'yyyy-mm-dd 00:00:00' string of the day, the form the historical runs estimate with and the CSVs
+    are indexed by.
+    """
+    return str(pd.Timestamp(date).normalize())
+
+
+def _consecutive_runs(dates):
+    """
+    :param dates: sorted list of Timestamps of days
+    :return: list of (first day, last day) tuples of the runs of consecutive days
+    """
+    runs = []
+    for date in dates:
+        if runs and date - runs[-1][1] == pd.Timedelta(days=1):
+            runs[-1] = (runs[-1][0], date)
+        else:
+            runs.append((date, date))
+    return runs
+
+
+def _encode(result):
+    operating, lease_satisfied_time = result
+    if isinstance(lease_satisfied_time, str):
+        stored_time = lease_satisfied_time
+    elif lease_satisfied_time is None or pd.isna(lease_satisfied_time):
+        stored_time = None
+    else:
+        stored_time = {"timestamp": str(pd.Timestamp(lease_satisfied_time))}
+    return json.dumps([None if operating is None or pd.isna(operating) else bool(operating), stored_time])
+
+
+def _decode(value):
+    operating, stored_time = json.loads(value)
+    if isinstance(stored_time, dict):
+        stored_time = pd.Timestamp(stored_time["timestamp"])
+    return operating, stored_time
@@ -0,0 +1,331 @@
+"""
+This module houses a materialized rollup of the internal temperatures: per building and 15 minute slot, the count,
+sum, sum of squares, minimum, maximum and count in band of the readings of the relevant sensors. Estimating a day
+from the rollup reads one row per slot instead of one reading per sensor and slot.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from .checkpoints import get_window_fingerprints
+from .data_loading import get_day_window
+from .day_tensor import _slot_index, _slot_times, first_crossings
+from .db import get_engine
+from .instrumentation import get_metrics
+from .lease_satisfied_estimator import DEFAULT_CHUNK_DAYS, YourEstimator
+from .measurement_cache import DEFAULT_VERIFY_DAYS, _atomic_save, _chunk_runs, _remove_partitions
+from .sensor_matrix import GRID_FREQ, get_internal_temp_matrix_in_windows
+
+# Bump when the on-disk layout or the meaning of a column changes. Rollups written with another version are rebuilt
+# on refresh.
+ROLLUP_FORMAT_VERSION = 2
+
+# n_all counts the readings of all sensors, which decides whether a day has data. The other statistics are over the
+# relevant sensors only.
+COLUMN_DTYPES = {
+    "time": "datetime64[ns]",
+    "n_all": "int64",
+    "n": "int64",
+    "sum": "float64",
+    "sum_sq": "float64",
+    "min": "float64",
+    "max": "float64",
+    "n_in_band": "int64",
+}
+
+DATA_RANGE_QUERY = text(
+    "SELECT MIN(f1.measured_at) as first_time, MAX(f1.measured_at) as last_time "
+    "FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False"
+)
+
+
+class SlotRollup:
+    """
+    Per slot statistics of the internal temperatures, one directory per building with one sub directory per month
+    holding one .npy file per column, like the MeasurementCache. Only slots with readings are stored.
+
+    The statistics of a day are computed from the readings in its day window (see get_day_window), on the same
+    SensorMatrix grid the estimators build, with the sum added one sensor after the other in sensor order, so sum / n
+    is bit for bit the mean getPred2 takes on the day. Readings after the end of the day window are left out, they
+    would land on its last slot. A refresh recomputes the days whose data fingerprint over the day window (see
+    checkpoints.get_window_fingerprints) changed: the days after the watermark, and the last
+    verify_days days before it. Changes further back are only picked up by a refresh with verify_days=None. The
+    rollup belongs to one set of relevant sensors and one band, it is rebuilt from scratch when either changes.
+    """
+
+    def __init__(self, rollup_dir):
+        """
+        :param rollup_dir: directory the rollup lives in. Created if it does not exist.
+        """
+        self.rollup_dir = rollup_dir
+        os.makedirs(rollup_dir, exist_ok=True)
+
+    def refresh(self, db, building_id, relevant_sensors, verify_days=DEFAULT_VERIFY_DAYS, lower=70.0, upper=75.0,
+                chunk_days=DEFAULT_CHUNK_DAYS):
+        """
+        Bring the rollup of a building up to date.
+        :param db: an active sql engine, or None for the shared engine.
+        :param building_id: integer
+        :param relevant_sensors: set of the sensor ids the statistics are over, e.g. YourEstimator.relevant_sensors
+        :param verify_days: days before the watermark to check for changes, None to check the whole history.
+        :param lower: lower bound of the band of n_in_band, inclusive
+        :param upper: upper bound of the band of n_in_band, inclusive
+        :param chunk_days: number of days loaded per query.
+        :return: number of days that were rolled up again.
+        """
+        if db is None:
+            db = get_engine()
+        relevant_sensors = sorted(int(sensor_id) for sensor_id in relevant_sensors)
+        meta = self._read_meta(building_id)
+        if meta["relevant_sensors"] != relevant_sensors or meta["band"] != [lower, upper]:
+            meta = _empty_meta()
+        if meta["watermark"] is None:
+            # Starting from scratch, drop partitions of an older rollup or an unfinished first refresh.
+            _remove_partitions(self._building_dir(building_id))
+        meta["relevant_sensors"], meta["band"] = relevant_sensors, [lower, upper]
+
+        with db.connect() as conn:
+            data_range = pd.read_sql(DATA_RANGE_QUERY, conn, params={"building_id": building_id}).iloc[0]
+        if pd.isna(data_range["last_time"]):
+            self._write_meta(building_id, meta)
+            return 0
+        first_day = pd.Timestamp(data_range["first_time"]).normalize()
+        last_day = pd.Timestamp(data_range["last_time"]).normalize()
+        if meta["watermark"] is not None and verify_days is not None:
+            first_day = max(first_day, pd.Timestamp(meta["watermark"]) - pd.Timedelta(days=verify_days))
+        days = pd.date_range(first_day, max(first_day, last_day))
+
+        windows = _day_windows(days)
+        fingerprints = get_window_fingerprints(db, building_id, windows)
+        changed = pd.DatetimeIndex([
+            day for day, fingerprint in zip(days, fingerprints.values())
+            if fingerprint != meta["fingerprints"].get(str(day), "0")
+        ])
+        metrics = get_metrics()
+        for run in _chunk_runs(changed, chunk_days):
+            run_windows = windows[windows["window_start"].isin(run)]
+            matrix = get_internal_temp_matrix_in_windows(
+                db, building_id,
+                run_windows.rename(columns={"window_start": "fetch_start", "window_end": "fetch_end"}),
+                run_windows["window_start"].iloc[0], run_windows["window_end"].iloc[-1],
+            )
+            with metrics.stage("rollup", building_id) as counters:
+                stats = _slot_stats(matrix, relevant_sensors, lower, upper)
+                counters["rows"] = len(stats)
+            self._replace_days(building_id, run, stats)
+            # Written after every run, so an interrupted refresh does not redo the runs that were stored.
+            for day in run:
+                meta["fingerprints"][str(day)] = fingerprints[str(day)]
+            self._write_meta(building_id, meta)
+
+        meta["watermark"] = str(last_day)
+        self._write_meta(building_id, meta)
+        return len(changed)
+
+    def get_relevant_sensors(self, building_id):
+        """
+        :param building_id: integer
+        :return: sorted list of the sensor ids the rollup of the building is over, None if it has none.
+        """
+        return self._read_meta(building_id)["relevant_sensors"]
+
+    def get_slots(self, building_id, start_time, end_time):
+        """
+        :param building_id: integer
+        :param start_time: datetime, inclusive
+        :param end_time: datetime, inclusive
+        :return: DataFrame indexed by slot time with the columns of COLUMN_DTYPES but time, one row per slot with
+        readings.
+        """
+        window_start, window_end = np.datetime64(start_time, "ns"), np.datetime64(end_time, "ns")
+        frames = []
+        for month in pd.period_range(pd.Timestamp(window_start), pd.Timestamp(window_end), freq="M"):
+            columns = self._load_partition(building_id, str(month), mmap_mode="r")
+            if columns is None:
+                continue
+            lo = np.searchsorted(columns["time"], window_start, side="left")
+            hi = np.searchsorted(columns["time"], window_end, side="right")
+            frames.append(pd.DataFrame({column: values[lo:hi] for column, values in columns.items()}))
+        if not frames:
+            return _as_rollup_columns(pd.DataFrame(columns=list(COLUMN_DTYPES))).set_index("time")
+        return pd.concat(frames, ignore_index=True).set_index("time")
+
+    def _replace_days(self, building_id, days, stats):
+        """
+        Replace the slots of days in the stored partitions with stats.
+        """
+        stats_months = stats["time"].dt.to_period("M").astype(str).values
+        for month in sorted(set(str(day.to_period("M")) for day in days)):
+            rows = stats[stats_months == month]
+            columns = self._load_partition(building_id, month)
+            if columns is not None:
+                stored = pd.DataFrame(columns)
+                stored = stored[~stored["time"].dt.normalize().isin(days)]
+                rows = pd.concat([stored, rows], ignore_index=True).sort_values("time")
+            partition_dir = os.path.join(self._building_dir(building_id), month)
+            os.makedirs(partition_dir, exist_ok=True)
+            for column, dtype in COLUMN_DTYPES.items():
+                _atomic_save(os.path.join(partition_dir, column + ".npy"), rows[column].values.astype(dtype))
+
+    def _load_partition(self, building_id, month, mmap_mode=None):
+        partition_dir = os.path.join(self._building_dir(building_id), month)
+        if not os.path.exists(os.path.join(partition_dir, "time.npy")):
+            return None
+        return {
+            column: np.load(os.path.join(partition_dir, column + ".npy"), mmap_mode=mmap_mode)
+            for column in COLUMN_DTYPES
+        }
+
+    def _building_dir(self, building_id):
+        return os.path.join(self.rollup_dir, "building_{}".format(building_id))
+
+    def _read_meta(self, building_id):
+        path = os.path.join(self._building_dir(building_id), "meta.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                meta = json.load(f)
+            if meta.get("version") == ROLLUP_FORMAT_VERSION:
+                return meta
+        return _empty_meta()
+
+    def _write_meta(self, building_id, meta):
+        os.makedirs(self._building_dir(building_id), exist_ok=True)
+        path = os.path.join(self._building_dir(building_id), "meta.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(meta, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+class RollupEstimator(YourEstimator):
+    """
+    YourEstimator that reads the per slot statistics of a SlotRollup instead of the readings. The rollup must have
+    been refreshed with the relevant sensors of the estimator, the results are then the same as YourEstimator's on
+    the data the rollup was refreshed from. Loading from a rollup over other sensors raises a ValueError.
+    """
+
+    def __init__(self, building_id, db=None, cache=None, sensor_index=None, rollup=None, **kwargs):
+        """
+        :param rollup: SlotRollup to read from
+        """
+        super().__init__(building_id, db=db, cache=cache, sensor_index=sensor_index, **kwargs)
+        self.rollup = rollup
+
+    def compute_lease_satisfied_time(self, estimation_date):
+        """
+        :param estimation_date: date in string format
+        :return: Same as YourEstimator.compute_lease_satisfied_time.
+        """
+        df = self.compute_lease_satisfied_times(estimation_date, estimation_date)
+        return df["operating"].iloc[0], df["lease_satisfied_time"].iloc[0]
+
+    def load_chunk(self, chunk):
+        """
+        :param chunk: DatetimeIndex of consecutive days, see chunk_dates
+        :return: DataFrame of the rollup slots of the day windows of the chunk, see SlotRollup.get_slots
+        """
+        rollup_sensors = self.rollup.get_relevant_sensors(self.building_id)
+        relevant_sensors = sorted(int(sensor_id) for sensor_id in self.relevant_sensors)
+        if rollup_sensors != relevant_sensors:
+            raise ValueError(
+                "The rollup of building {} is over sensors {}, not the relevant sensors {} of the estimator. "
+                "Refresh it first.".format(self.building_id, rollup_sensors, relevant_sensors)
+            )
+        chunk_start, _ = get_day_window(str(chunk[0]))
+        _, chunk_end = get_day_window(str(chunk[-1]))
+        with get_metrics().stage("rollup_read", self.building_id) as counters:
+            slots = self.rollup.get_slots(self.building_id, chunk_start, chunk_end)
+            counters["rows"] = len(slots)
+        return slots
+
+    def estimate_chunk(self, chunk, df_chunk):
+        """
+        :param chunk: DatetimeIndex of consecutive days, see chunk_dates
+        :param df_chunk: DataFrame of rollup slots from load_chunk
+        :return: dict of date string to the output row of the day, see compute_lease_satisfied_times
+        """
+        metrics = get_metrics()
+        with metrics.stage("estimate", self.building_id) as counters:
+            slot_times = _slot_times(chunk, GRID_FREQ)
+            index, on_grid = _slot_index(pd.DatetimeIndex(df_chunk.index), slot_times)
+
+            def gather(column):
+                if df_chunk.empty:
+                    return np.zeros(slot_times.shape, dtype=df_chunk[column].dtype)
+                return np.where(on_grid, df_chunk[column].values[index], 0)
+
+            n, readings = gather("n"), gather("n_all").sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                first = first_crossings(np.where(n > 0, gather("sum") / n, np.nan))
+        df_dict = {}
+        for i, date in enumerate(chunk):
+            metrics.record_day(
+                self.building_id, date, rows=int(readings[i]),
+                estimate_wall_seconds=counters["wall_seconds"] / len(chunk),
+                estimate_cpu_seconds=counters["cpu_seconds"] / len(chunk),
+            )
+            if not readings[i]:
+                operating, lease_satisfied_time = None, None
+            elif date.dayofweek > 4:
+                operating, lease_satisfied_time = False, None
+            elif first[i] < 0:
+                operating, lease_satisfied_time = True, "Not Satisfied"
+            else:
+                operating, lease_satisfied_time = True, pd.Timestamp(slot_times[i, first[i]])
+            df_dict[str(date)] = {
+                "building_id": self.building_id,
+                "operating": operating,
+                "lease_satisfied_time": lease_satisfied_time,
+            }
+        return df_dict
+
+
+def _slot_stats(matrix, relevant_sensors, lower, upper):
+    """
+    :param matrix: SensorMatrix of all sensors
+    :param relevant_sensors: set of the sensor ids the statistics are over
+    :return: DataFrame with the columns of COLUMN_DTYPES, one row per grid point of matrix with readings.
+    """
+    relevant = matrix.select(set(relevant_sensors))
+    n = relevant.count()
+    values = relevant.values.astype(np.float64)
+    in_values = np.where(relevant.mask, values, 0.)
+    with np.errstate(invalid="ignore"):
+        in_band = relevant.mask & (relevant.values >= lower) & (relevant.values <= upper)
+    stats = pd.DataFrame({
+        "time": matrix.times.values,
+        "n_all": matrix.count(),
+        "n": n,
+        # The running sum of SensorMatrix.mean, so sum / n is the mean the estimators take.
+        "sum": relevant.sum(),
+        "sum_sq": (in_values * in_values).sum(axis=0),
+        "min": np.where(n > 0, np.where(relevant.mask, values, np.inf).min(axis=0, initial=np.inf), np.nan),
+        "max": np.where(n > 0, np.where(relevant.mask, values, -np.inf).max(axis=0, initial=-np.inf), np.nan),
+        "n_in_band": in_band.sum(axis=0),
+    })
+    return _as_rollup_columns(stats[stats["n_all"] > 0])
+
+
+def _day_windows(days):
+    """
+    :param days: DatetimeIndex of days
+    :return: DataFrame with the window_start and window_end (both inclusive) of the day window of every day, see
+    get_day_window.
+    """
+    return pd.DataFrame(
+        [get_day_window(str(day)) for day in days], columns=["window_start", "window_end"]
+    ).apply(pd.to_datetime)
+
+
+def _as_rollup_columns(df):
+    return pd.DataFrame({column: df[column].values.astype(dtype) for column, dtype in COLUMN_DTYPES.items()})
+
+
+def _empty_meta():
+    return {
+        "version": ROLLUP_FORMAT_VERSION, "watermark": None, "relevant_sensors": None, "band": None,
+        "fingerprints": {},
+    }
@@ -0,0 +1,284 @@
+"""
+This module houses the sensor quality index, which decides which sensors of a building are relevant for estimating
+the building temperature.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from datetime import datetime
+import json
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, bindparam, text
+from .db import get_engine
+
+# Bump when the stored statistics or their meaning change. Indexes stored with another version are rebuilt.
+SENSOR_INDEX_VERSION = 2
+
+# Days before the last reading that are aggregated again on every refresh, to pick up late readings and flag changes.
+DEFAULT_VERIFY_DAYS = 31
+
+DEFAULT_THRESHOLDS = {
+    # Readings outside of this range (deg F) can't be an indoor temperature.
+    "min_plausible_temp": 40.,
+    "max_plausible_temp": 100.,
+    "max_out_of_range_rate": 0.05,
+    # Fraction of the building's timestamps the sensor reported at.
+    "min_coverage": 0.5,
+    # Fraction of readings equal to the previous reading of the same sensor.
+    "max_flatline_rate": 0.9,
+    "min_std": 0.1,
+    # Correlation with the mean of all the building's sensors at the same timestamp.
+    "min_correlation": 0.3,
+}
+
+# Sufficient statistics per sensor. They add up across time ranges, so the index can be updated incrementally.
+SUM_COLUMNS = ["n", "sum_x", "sum_xx", "sum_m", "sum_mm", "sum_xm", "n_out_of_range", "n_repeated"]
+
+SENSOR_STATS_QUERY = text(
+    "WITH readings AS ("
+    # measurement is a real, sums of it would be accumulated in single precision.
+    " SELECT b2.id as sensor_id, f1.measured_at as time, CAST(f1.measurement AS DOUBLE PRECISION) as x"
+    " FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id"
+    " WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False"
+    " and f1.measured_at > :start_time AND f1.measured_at <= :end_time"
+    "), with_context AS ("
+    " SELECT sensor_id, time, x, AVG(x) OVER (PARTITION BY time) as m,"
+    " LAG(x) OVER (PARTITION BY sensor_id ORDER BY time) as prev_x"
+    " FROM readings"
+    ") "
+    "SELECT sensor_id, COUNT(*) as n, SUM(x) as sum_x, SUM(x * x) as sum_xx, SUM(m) as sum_m, SUM(m * m) as sum_mm,"
+    " SUM(x * m) as sum_xm,"
+    " SUM(CASE WHEN x < :min_plausible_temp OR x > :max_plausible_temp THEN 1 ELSE 0 END) as n_out_of_range,"
+    " SUM(CASE WHEN x = prev_x THEN 1 ELSE 0 END) as n_repeated,"
+    " MAX(time) as last_time "
+    "FROM with_context GROUP BY sensor_id"
+).bindparams(bindparam("start_time", type_=DateTime), bindparam("end_time", type_=DateTime))
+
+TIMESTAMP_COUNT_QUERY = text(
+    "SELECT COUNT(DISTINCT f1.measured_at) as n_times "
+    "FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and b2.ignore = False and f1.bad_data = False "
+    "and f1.measured_at > :start_time AND f1.measured_at <= :end_time"
+).bindparams(bindparam("start_time", type_=DateTime), bindparam("end_time", type_=DateTime))
+
+LAST_TIME_QUERY = text(
+    "SELECT MAX(f1.measured_at) as last_time "
+    "FROM building_sensor_configs b2 JOIN floor_temperature_measurements f1 ON b2.id = f1.building_sensor_config_id "
+    "WHERE b2.building_id = :building_id and f1.measured_at <= :end_time"
+).bindparams(bindparam("end_time", type_=DateTime))
+
+ACTIVE_SENSORS_QUERY = text(
+    "SELECT b2.id as sensor_id FROM building_sensor_configs b2 "
+    "WHERE b2.building_id = :building_id and b2.ignore = False"
+)
+
+_START_OF_TIME = datetime(1970, 1, 1)
+
+
+class SensorQualityIndex:
+    """
+    Per sensor quality statistics of a building: out of range rate, flatline rate, standard deviation, correlation
+    with the building mean and coverage. The statistics are aggregated in the database in one pass and kept as sums:
+    the settled sums of the readings up to settled_until, which are aggregated once, plus the sums of the trailing
+    days, which every refresh aggregates again so that late readings and changed bad_data or ignore flags in them are
+    picked up.
+    """
+
+    def __init__(self, building_id, thresholds=None):
+        """
+        :param building_id: integer
+        :param thresholds: dict overriding entries of DEFAULT_THRESHOLDS
+        """
+        self.building_id = building_id
+        self.thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+        self.watermark = None
+        self.n_times = 0
+        self.active_sensors = []
+        self.sums = _empty_sums()
+        self.settled_until = None
+        self.settled_n_times = 0
+        self.settled_sums = _empty_sums()
+        self._relevant_sensors = None
+
+    def refresh(self, db, end_time=None, verify_days=DEFAULT_VERIFY_DAYS):
+        """
+        Aggregate the readings up to end_time into the index. The readings from settled_until up to verify_days before
+        the day of the last reading are added to the settled sums, the ones after that are aggregated again.
+        :param db: an active sql engine, or None for the shared engine.
+        :param end_time: datetime, defaults to now.
+        :param verify_days: number of trailing days aggregated again
+        :return: self
+        """
+        if db is None:
+            db = get_engine()
+        params = {
+            "building_id": self.building_id,
+            "end_time": end_time or datetime.utcnow(),
+            "min_plausible_temp": self.thresholds["min_plausible_temp"],
+            "max_plausible_temp": self.thresholds["max_plausible_temp"],
+        }
+        settled_until = pd.Timestamp(self.settled_until) if self.settled_until else pd.Timestamp(_START_OF_TIME)
+        with db.connect() as conn:
+            last_time = pd.to_datetime(pd.read_sql(LAST_TIME_QUERY, conn, params=params)["last_time"]).iloc[0]
+            cutoff = settled_until
+            if not pd.isna(last_time):
+                cutoff = max(settled_until, last_time.normalize() - pd.Timedelta(days=verify_days))
+            if cutoff > settled_until:
+                sums, n_times = self._aggregate(conn, dict(params, start_time=settled_until, end_time=cutoff))
+                self.settled_sums = self.settled_sums.add(sums, fill_value=0.)
+                self.settled_n_times += n_times
+                self.settled_until = str(cutoff)
+            sums, n_times = self._aggregate(conn, dict(params, start_time=cutoff))
+            active_sensors = pd.read_sql(ACTIVE_SENSORS_QUERY, conn, params=params)["sensor_id"]
+
+        self.active_sensors = sorted(int(sensor_id) for sensor_id in active_sensors)
+        self.sums = self.settled_sums.add(sums, fill_value=0.)
+        self.n_times = self.settled_n_times + n_times
+        if not pd.isna(last_time):
+            self.watermark = str(last_time)
+        self._relevant_sensors = None
+        return self
+
+    @staticmethod
+    def _aggregate(conn, params):
+        """
+        :param params: query parameters with the start_time (exclusive) and end_time (inclusive) of the readings
+        :return: tuple (DataFrame of SUM_COLUMNS per sensor_id, number of distinct timestamps)
+        """
+        params = dict(
+            params, start_time=pd.Timestamp(params["start_time"]).to_pydatetime(),
+            end_time=pd.Timestamp(params["end_time"]).to_pydatetime(),
+        )
+        stats = pd.read_sql(SENSOR_STATS_QUERY, conn, params=params)
+        n_times = pd.read_sql(TIMESTAMP_COUNT_QUERY, conn, params=params)["n_times"].iloc[0]
+        return stats.set_index("sensor_id")[SUM_COLUMNS].astype(float), int(n_times)
+
+    def stats(self):
+        """
+        :return: DataFrame indexed by sensor_id with the quality metrics {n, coverage, out_of_range_rate,
+        flatline_rate, std, correlation, active} and a boolean relevant column.
+        """
+        sums = self.sums
+        n = sums["n"]
+        mean_x, mean_m = sums["sum_x"] / n, sums["sum_m"] / n
+        var_x = (sums["sum_xx"] / n - mean_x ** 2).clip(lower=0.)
+        var_m = (sums["sum_mm"] / n - mean_m ** 2).clip(lower=0.)
+        cov = sums["sum_xm"] / n - mean_x * mean_m
+        stats = pd.DataFrame(
+            {
+                "n": n,
+                "coverage": n / self.n_times if self.n_times else np.nan,
+                "out_of_range_rate": sums["n_out_of_range"] / n,
+                "flatline_rate": sums["n_repeated"] / n,
+                "std": np.sqrt(var_x),
+                # Undefined (NaN) for flat sensors.
+                "correlation": cov / np.sqrt(var_x * var_m).where(var_x * var_m > 0),
+                "active": sums.index.isin(self.active_sensors),
+            },
+            index=sums.index,
+        )
+        t = self.thresholds
+        stats["relevant"] = (
+            stats["active"]
+            & (stats["coverage"] >= t["min_coverage"])
+            & (stats["out_of_range_rate"] <= t["max_out_of_range_rate"])
+            & (stats["flatline_rate"] <= t["max_flatline_rate"])
+            & (stats["std"] >= t["min_std"])
+            & (stats["correlation"] >= t["min_correlation"])
+        )
+        return stats
+
+    @property
+    def relevant_sensors(self):
+        """
+        :return: frozenset of the ids of the relevant sensors, computed once per refresh.
+        """
+        if self._relevant_sensors is None:
+            stats = self.stats()
+            self._relevant_sensors = frozenset(int(sensor_id) for sensor_id in stats.index[stats["relevant"]])
+        return self._relevant_sensors
+
+    def save(self, path):
+        """
+        :param path: json file to write the index to
+        """
+        state = {
+            "version": SENSOR_INDEX_VERSION,
+            "building_id": self.building_id,
+            "thresholds": self.thresholds,
+            "watermark": self.watermark,
+            "n_times": self.n_times,
+            "active_sensors": self.active_sensors,
+            "sums": _sums_to_dict(self.sums),
+            "settled_until": self.settled_until,
+            "settled_n_times": self.settled_n_times,
+            "settled_sums": _sums_to_dict(self.settled_sums),
+        }
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, building_id, thresholds=None):
+        """
+        :param path: json file written by save
+        :param building_id: integer
+        :param thresholds: dict overriding entries of DEFAULT_THRESHOLDS
+        :return: the stored index, or an empty one if there is none, it is for another version or was built with
+        other plausible temperature limits.
+        """
+        index = cls(building_id, thresholds)
+        if not os.path.exists(path):
+            return index
+        with open(path) as f:
+            state = json.load(f)
+        stored_limits = [state["thresholds"].get(k) for k in ("min_plausible_temp", "max_plausible_temp")]
+        limits = [index.thresholds[k] for k in ("min_plausible_temp", "max_plausible_temp")]
+        if state["version"] != SENSOR_INDEX_VERSION or state["building_id"] != building_id or stored_limits != limits:
+            return index
+        index.watermark = state["watermark"]
+        index.n_times = state["n_times"]
+        index.active_sensors = state["active_sensors"]
+        index.sums = _sums_from_dict(state["sums"])
+        index.settled_until = state["settled_until"]
+        index.settled_n_times = state["settled_n_times"]
+        index.settled_sums = _sums_from_dict(state["settled_sums"])
+        return index
+
+
+def get_sensor_index(index_dir, building_id, db=None, refresh=True, thresholds=None):
+    """
+    Load the sensor quality index of a building from index_dir, bring it up to date and store it again.
+    :param index_dir: directory holding one sensor_index_{building_id}.json per building
+    :param building_id: integer
+    :param db: an active sql engine, or None for the shared engine.
+    :param refresh: whether to aggregate new readings. If False the stored index is returned as is.
+    :param thresholds: dict overriding entries of DEFAULT_THRESHOLDS
+    :return: SensorQualityIndex
+    """
+    path = os.path.join(index_dir, "sensor_index_{}.json".format(building_id))
+    index = SensorQualityIndex.load(path, building_id, thresholds)
+    if refresh:
+        os.makedirs(index_dir, exist_ok=True)
+        index.refresh(db)
+        index.save(path)
+    return index
+
+
+def _empty_sums():
+    return pd.DataFrame(columns=SUM_COLUMNS, index=pd.Index([], name="sensor_id"), dtype=float)
+
+
+def _sums_to_dict(sums):
+    return {str(int(sensor_id)): list(row) for sensor_id, row in zip(sums.index, sums.values)}
+
+
+def _sums_from_dict(rows):
+    if not rows:
+        return _empty_sums()
+    sums = pd.DataFrame.from_dict(
+        {int(sensor_id): row for sensor_id, row in rows.items()}, orient="index", columns=SUM_COLUMNS
+    ).astype(float)
+    sums.index.name = "sensor_id"
+    return sums
@@ -0,0 +1,224 @@
+"""
+This module houses a compact float32 representation of the internal temperatures of a building.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import numpy as np
+import pandas as pd
+from .data_loading import DEFAULT_CHUNKSIZE, get_time_bounds, iter_internal_temps, iter_internal_temps_in_windows
+from .instrumentation import get_metrics
+
+# Cadence of the floor temperature measurements.
+GRID_FREQ = "15min"
+
+# Number of sensors reduced at a time by SensorMatrix.sum / mean.
+DEFAULT_SENSOR_CHUNK = 256
+
+
+class SensorMatrix:
+    """
+    Internal temperatures of a building as a float32 (sensor x time) matrix on a regular time grid, with a validity
+    mask marking the cells that have a reading. Readings between grid points go to the grid point before them, and of
+    several readings of a sensor in one slot the last one written is kept.
+
+    For readings on the grid the matrix holds exactly the rows of the DataFrame of get_internal_temps, and the
+    estimator functions give the same results on both. Off the grid they differ: the DataFrame has a row per distinct
+    timestamp and getPred2 averages and returns reading times, while on the matrix the readings of a slot are averaged
+    together and the grid time of the slot is returned.
+    """
+
+    def __init__(self, values, sensor_ids, times, mask=None):
+        """
+        :param values: float32 array of shape (n_sensors, n_times), NaN where there is no reading.
+        :param sensor_ids: int array of the sensor ids of the rows.
+        :param times: DatetimeIndex of the columns, a regular grid.
+        :param mask: boolean array of the shape of values, True where there is a reading. Derived from values if None.
+        """
+        self.values = np.asarray(values, dtype=np.float32)
+        self.sensor_ids = np.asarray(sensor_ids, dtype=np.int64)
+        self.times = pd.DatetimeIndex(times)
+        self.mask = ~np.isnan(self.values) if mask is None else mask
+
+    @classmethod
+    def from_frame(cls, df, start_time=None, end_time=None, freq=GRID_FREQ):
+        """
+        :param df: DataFrame with time as index and columns as internal temperature sensors, e.g. from
+        get_internal_temps.
+        :param start_time: start of the grid, defaults to the first time in df.
+        :param end_time: end of the grid, defaults to the last time in df.
+        :param freq: grid frequency
+        :return: SensorMatrix
+        """
+        builder = _MatrixBuilder(_grid(df.index, start_time, end_time, freq))
+        builder.add(df)
+        return builder.build()
+
+    @property
+    def empty(self):
+        """
+        :return: True if there is not a single reading.
+        """
+        return not self.mask.any()
+
+    def valid_times(self):
+        """
+        :return: DatetimeIndex of the grid points at which at least one sensor has a reading. These are the rows
+        the DataFrame of get_internal_temps has.
+        """
+        return self.times[self.mask.any(axis=0)]
+
+    def select(self, sensor_ids):
+        """
+        :param sensor_ids: set (or other container) of sensor ids
+        :return: SensorMatrix with only the rows of the sensors in sensor_ids.
+        """
+        rows = [i for i, sensor_id in enumerate(self.sensor_ids) if sensor_id in sensor_ids]
+        return SensorMatrix(self.values[rows], self.sensor_ids[rows], self.times, self.mask[rows])
+
+    def time_slice(self, start_time, end_time):
+        """
+        :param start_time: datetime, inclusive
+        :param end_time: datetime, inclusive
+        :return: SensorMatrix viewing the grid points from start_time to end_time.
+        """
+        lo = self.times.searchsorted(pd.Timestamp(start_time), side="left")
+        hi = self.times.searchsorted(pd.Timestamp(end_time), side="right")
+        return SensorMatrix(self.values[:, lo:hi], self.sensor_ids, self.times[lo:hi], self.mask[:, lo:hi])
+
+    def count(self):
+        """
+        :return: int array with the number of readings per grid point.
+        """
+        return self.mask.sum(axis=0)
+
+    def sum(self, sensor_chunk=DEFAULT_SENSOR_CHUNK):
+        """
+        Sum of the readings per grid point. The float32 readings are accumulated in float64, sensor_chunk sensors at a
+        time, so only one chunk is ever up-cast. The readings are added in place into one float64 vector, one sensor
+        after the other in sensor order (a running sum, not numpy's pairwise summation), so the result does not
+        depend on the chunk size or the shape of the matrix and can be reproduced reading by reading.
+        :param sensor_chunk: number of sensors up-cast and reduced at a time.
+        :return: float64 array with the sum per grid point, 0 where there are no readings.
+        """
+        total = np.zeros(len(self.times))
+        for i in range(0, len(self.sensor_ids), sensor_chunk):
+            chunk = np.where(self.mask[i:i + sensor_chunk], self.values[i:i + sensor_chunk].astype(np.float64), 0.)
+            for row in chunk:
+                total += row
+        return total
+
+    def mean(self, sensor_chunk=DEFAULT_SENSOR_CHUNK):
+        """
+        :param sensor_chunk: number of sensors up-cast and reduced at a time.
+        :return: float64 array with the mean reading per grid point, NaN where there are no readings.
+        """
+        count = self.count()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 0, self.sum(sensor_chunk) / count, np.nan)
+
+    def to_frame(self):
+        """
+        :return: DataFrame in the format of get_internal_temps, but float32: only the grid points with readings as
+        index and the sensors that have readings as columns.
+        """
+        has_readings = self.mask.any(axis=0)
+        has_sensor = self.mask.any(axis=1)
+        return pd.DataFrame(
+            self.values[has_sensor][:, has_readings].T,
+            index=pd.DatetimeIndex(self.times[has_readings].values, name="time"),
+            columns=pd.Index(self.sensor_ids[has_sensor], name="sensor_id"),
+        )
+
+
+def get_internal_temp_matrix(db, building_id, start_time, end_time, chunksize=DEFAULT_CHUNKSIZE, cache=None,
+                             freq=GRID_FREQ):
+    """
+    Same as get_internal_temps, but the readings are written into a SensorMatrix as they are streamed in, never
+    building the float64 DataFrame of the whole range.
+    :param db: an active sql engine, or None for the shared engine.
+    :param building_id: integer
+    :param start_time: start time string, see get_internal_temps
+    :param end_time: end time string, see get_internal_temps
+    :param chunksize: number of rows fetched and pivoted at a time.
+    :param cache: optional MeasurementCache to read from instead of the database.
+    :param freq: grid frequency
+    :return: SensorMatrix spanning the window from start_time to end_time.
+    """
+    window_start, window_end = get_time_bounds(start_time, end_time)
+    builder = _MatrixBuilder(_grid(None, window_start, window_end, freq))
+    metrics = get_metrics()
+    if cache is not None:
+        with metrics.stage("cache_read", building_id):
+            df = cache.get_internal_temps(building_id, start_time, end_time)
+        with metrics.stage("matrix", building_id):
+            builder.add(df)
+    else:
+        for df in iter_internal_temps(db, building_id, start_time, end_time, chunksize=chunksize):
+            with metrics.stage("matrix", building_id):
+                builder.add(df)
+    return builder.build()
+
+
+def get_internal_temp_matrix_in_windows(db, building_id, windows, start_time, end_time, chunksize=DEFAULT_CHUNKSIZE,
+                                        freq=GRID_FREQ):
+    """
+    Same as get_internal_temp_matrix, but only the readings within windows are fetched. The grid still spans
+    start_time to end_time, the grid points outside of the windows have no readings.
+    :param windows: DataFrame with the naive UTC fetch_start and fetch_end of non overlapping windows, see
+    iter_internal_temps_in_windows
+    :param start_time: start of the grid, datetime
+    :param end_time: end of the grid, datetime
+    :return: SensorMatrix spanning the window from start_time to end_time.
+    """
+    builder = _MatrixBuilder(_grid(None, start_time, end_time, freq))
+    metrics = get_metrics()
+    for df in iter_internal_temps_in_windows(db, building_id, windows, chunksize=chunksize):
+        with metrics.stage("matrix", building_id):
+            builder.add(df)
+    return builder.build()
+
+
+class _MatrixBuilder:
+    """
+    Fills a preallocated float32 matrix from wide frames. Rows for new sensors are added by doubling the capacity.
+    Readings are floored onto the grid, a later reading of a sensor in the same slot overwrites an earlier one (see
+    SensorMatrix).
+    """
+
+    def __init__(self, times):
+        self.times = times
+        self.rows = {}
+        self.values = np.full((16, len(times)), np.nan, dtype=np.float32)
+
+    def add(self, df):
+        if df.empty:
+            return
+        for sensor_id in df.columns:
+            if sensor_id not in self.rows:
+                self.rows[sensor_id] = len(self.rows)
+        if len(self.rows) > len(self.values):
+            capacity = max(2 * len(self.values), len(self.rows))
+            grown = np.full((capacity, len(self.times)), np.nan, dtype=np.float32)
+            grown[:len(self.values)] = self.values
+            self.values = grown
+        slots = self.times.get_indexer(pd.DatetimeIndex(df.index).floor(self.times.freq))
+        on_grid = slots >= 0
+        rows = [self.rows[sensor_id] for sensor_id in df.columns]
+        block = df.values.T.astype(np.float32)[:, on_grid]
+        slots = slots[on_grid]
+        for i, row in enumerate(rows):
+            has_reading = ~np.isnan(block[i])
+            self.values[row, slots[has_reading]] = block[i, has_reading]
+
+    def build(self):
+        sensor_ids = np.array(sorted(self.rows), dtype=np.int64)
+        order = [self.rows[sensor_id] for sensor_id in sensor_ids]
+        return SensorMatrix(self.values[order], sensor_ids, self.times)
+
+
+def _grid(index, start_time, end_time, freq):
+    start = pd.Timestamp(start_time) if start_time is not None else index.min()
+    end = pd.Timestamp(end_time) if end_time is not None else index.max()
+    if pd.isna(start) or pd.isna(end):
+        return pd.date_range("2018-01-01", periods=0, freq=freq)
+    return pd.date_range(start.floor(freq), end, freq=freq)
@@ -0,0 +1,381 @@
+"""
+This module houses a long running estimation service that keeps the estimators, lease calendars, database pool and
+recent results of the buildings warm, and answers single day and bulk queries over a local HTTP API.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from socketserver import ThreadingMixIn, UnixStreamServer
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+from .checkpoints import get_day_fingerprints
+from .data_loading import get_lease_obligation_schedule
+from .db import get_pool_stats
+from .estimators import make_estimator, refresh_local_stores
+from .lease_calendar import get_lease_calendar
+from .result_cache import ResultCache, _consecutive_runs, day_key
+
+# Latencies kept per endpoint for the percentiles, the most recent ones.
+DEFAULT_LATENCY_WINDOW = 10000
+
+LATENCY_PERCENTILES = [50, 90, 99]
+
+# Queries per bulk request.
+MAX_BULK_QUERIES = 10000
+
+
+class LatencyTracker:
+    """
+    Latencies of the most recent requests per endpoint. Safe to share between threads.
+    """
+
+    def __init__(self, window=DEFAULT_LATENCY_WINDOW):
+        """
+        :param window: number of latencies kept per endpoint
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._counts = {}
+
+    def record(self, endpoint, seconds):
+        """
+        :param endpoint: name of the endpoint
+        :param seconds: wall clock seconds the request took
+        """
+        with self._lock:
+            if endpoint not in self._latencies:
+                self._latencies[endpoint] = deque(maxlen=self.window)
+                self._counts[endpoint] = 0
+            self._latencies[endpoint].append(seconds)
+            self._counts[endpoint] += 1
+
+    def percentiles(self):
+        """
+        :return: dict of endpoint to the total number of requests and the p50_ms, p90_ms, p99_ms and max_ms of the
+        latencies in the window.
+        """
+        with self._lock:
+            latencies = {endpoint: np.array(values) for endpoint, values in self._latencies.items()}
+            counts = dict(self._counts)
+        stats = {}
+        for endpoint in sorted(latencies):
+            milliseconds = latencies[endpoint] * 1000.
+            stats[endpoint] = {"requests": counts[endpoint], "max_ms": float(milliseconds.max())}
+            for q, value in zip(LATENCY_PERCENTILES, np.percentile(milliseconds, LATENCY_PERCENTILES)):
+                stats[endpoint]["p{}_ms".format(q)] = float(value)
+        return stats
+
+
+class EstimationService:
+    """
+    Estimators of the buildings of a run config, created once per building and kept together with their lease
+    calendars, in front of a ResultCache. Results are validated against the fingerprints of the days' data as of the
+    last refresh, kept in memory, so a query for a day served before does not touch the database. A day is
+    fingerprinted in the database on its first query, refresh fingerprints the days served so far again, so new
+    readings in the database are picked up without a restart. The local stores of the config (cache, sensor index,
+    rollup) are only read, refresh brings them up to date too. Safe to share between threads: queries for different
+    buildings run concurrently, queries for the same building one at a time.
+    """
+
+    def __init__(self, config, result_cache=None, db=None):
+        """
+        :param config: dict parsed from config.yml, see example_config.yml. Only the buildings in its buildings list
+        (all buildings if it has none) are served.
+        :param result_cache: ResultCache to keep results in, an in-memory one if None.
+        :param db: an active sql engine, or None for the shared engine.
+        """
+        self.config = config
+        self.building_ids = set(config.get("buildings") or [])
+        self.result_cache = result_cache if result_cache is not None else ResultCache()
+        self.latencies = LatencyTracker()
+        self.started = time.time()
+        self._db = db
+        self._lock = threading.Lock()
+        self._estimators = {}
+        self._building_locks = {}
+        # building_id to a dict of date string to the fingerprint of the day as of the last refresh.
+        self._fingerprints = {}
+
+    def get_estimator(self, building_id):
+        """
+        :param building_id: integer
+        :return: the estimator of the building, created on first use.
+        """
+        with self._building_lock(building_id):
+            with self._lock:
+                estimator = self._estimators.get(building_id)
+            if estimator is None:
+                # Loads the lease obligations and calendar, outside of the service lock.
+                estimator = make_estimator(self.config, building_id, db=self._db)
+                with self._lock:
+                    self._estimators[building_id] = estimator
+            return estimator
+
+    def warm(self, building_ids=None, days=0, end_date=None):
+        """
+        Create the estimators of building_ids ahead of the first query, and fill the result cache with their last
+        days.
+        :param building_ids: list of integers, the buildings of the config if None.
+        :param days: number of days up to end_date to estimate
+        :param end_date: date string of the last day, today if None.
+        """
+        end_date = pd.Timestamp(end_date if end_date is not None else "today").normalize()
+        for building_id in (building_ids if building_ids is not None else sorted(self.building_ids)):
+            self.get_estimator(building_id)
+            if days:
+                self.estimate_range(building_id, str(end_date - pd.Timedelta(days=days - 1)), str(end_date))
+
+    def refresh(self):
+        """
+        Bring the local stores of the config and the fingerprints of the days served so far up to date, while queries
+        keep being answered. The new fingerprints are swapped in with the locks of all buildings held, results of days
+        whose fingerprint changed are computed again on their next query. If any of the local stores or the lease
+        obligations of a building changed, the estimators, lease calendars and stored results are dropped in the same
+        step, so that no query mixes them with the new ones. The estimators are recreated on their next query.
+        :return: True if any of the local stores, lease obligations or fingerprints changed.
+        """
+        changed = False
+        for building_id in sorted(self.building_ids):
+            with self._lock:
+                estimator = self._estimators.get(building_id)
+            # Stores are replaced file by file, queries meanwhile may read a mix. Their results are dropped below.
+            refreshed = refresh_local_stores(self.config, building_id, db=self._db)
+            relevant_sensors = refreshed["relevant_sensors"]
+            if refreshed["new_rows"] or refreshed["rollup_days"] or (estimator is not None and (
+                relevant_sensors is not None
+                and relevant_sensors != sorted(int(sensor_id) for sensor_id in estimator.relevant_sensors)
+                or not estimator.lease_calendar.lease_obligations.equals(get_lease_obligation_schedule(building_id))
+            )):
+                changed = True
+
+        with self._lock:
+            served_days = {building_id: list(days) for building_id, days in self._fingerprints.items()}
+        fingerprints = {
+            building_id: get_day_fingerprints(self._db, building_id, pd.DatetimeIndex(days))
+            for building_id, days in served_days.items() if days
+        }
+
+        # Every building with results, in building order.
+        with self._lock:
+            building_ids = sorted(self.building_ids | set(self._building_locks))
+        locks = [self._building_lock(building_id) for building_id in building_ids]
+        for lock in locks:
+            lock.acquire()
+        try:
+            data_changed = False
+            with self._lock:
+                for building_id, building_fingerprints in fingerprints.items():
+                    known = self._fingerprints[building_id]
+                    data_changed |= any(known[date] != value for date, value in building_fingerprints.items())
+                    known.update(building_fingerprints)
+            if changed:
+                with self._lock:
+                    self._estimators.clear()
+                self.result_cache.clear()
+                get_lease_calendar.cache_clear()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+        return changed or data_changed
+
+    def estimate(self, building_id, estimation_date):
+        """
+        :param building_id: integer
+        :param estimation_date: date string
+        :return: dict with the building_id, date, operating and lease_satisfied_time of the day.
+        """
+        building_id = self._check_building(building_id)
+        # The estimator is taken under the lock of the building, so a refresh cannot swap it out mid query.
+        with self._building_lock(building_id):
+            result = self.result_cache.get_or_compute(
+                self.get_estimator(building_id), estimation_date, fingerprints=self._day_fingerprints
+            )
+        return _as_record(building_id, day_key(estimation_date), result)
+
+    def estimate_range(self, building_id, start_date, end_date):
+        """
+        :param building_id: integer
+        :param start_date: date string
+        :param end_date: date string, inclusive
+        :return: list of dicts as returned by estimate, one per day.
+        """
+        building_id = self._check_building(building_id)
+        if pd.Timestamp(end_date) < pd.Timestamp(start_date):
+            raise ValueError("end_date {} is before start_date {}".format(end_date, start_date))
+        with self._building_lock(building_id):
+            df = self.result_cache.get_or_compute_range(
+                self.get_estimator(building_id), start_date, end_date, fingerprints=self._day_fingerprints
+            )
+        return [
+            _as_record(building_id, date, (row["operating"], row["lease_satisfied_time"]))
+            for date, row in df.iterrows()
+        ]
+
+    def estimate_many(self, queries):
+        """
+        :param queries: list of dicts with a building_id and a date
+        :return: list of dicts as returned by estimate, in the order of queries. The days of a building are looked up
+        in runs of consecutive days.
+        """
+        if len(queries) > MAX_BULK_QUERIES:
+            raise ValueError("At most {} queries per request".format(MAX_BULK_QUERIES))
+        keys = [(self._check_building(query["building_id"]), day_key(query["date"])) for query in queries]
+        dates = OrderedDict()
+        for building_id, date in keys:
+            dates.setdefault(building_id, set()).add(pd.Timestamp(date))
+        records = {}
+        for building_id, building_dates in dates.items():
+            for run_start, run_end in _consecutive_runs(sorted(building_dates)):
+                for record in self.estimate_range(building_id, str(run_start.date()), str(run_end.date())):
+                    records[(building_id, record["date"])] = record
+        return [records[key] for key in keys]
+
+    def stats(self):
+        """
+        :return: dict with the uptime_seconds, the latency percentiles per endpoint, the result_cache statistics, the
+        database pool statistics and the buildings with a warm estimator.
+        """
+        with self._lock:
+            buildings = sorted(self._estimators)
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "latency": self.latencies.percentiles(),
+            "result_cache": self.result_cache.stats(),
+            "pool": get_pool_stats(),
+            "buildings": buildings,
+        }
+
+    def _check_building(self, building_id):
+        building_id = int(building_id)
+        if self.building_ids and building_id not in self.building_ids:
+            raise ValueError("Building {} is not served".format(building_id))
+        return building_id
+
+    def _building_lock(self, building_id):
+        with self._lock:
+            # Reentrant, get_estimator is called with the lock of the building held.
+            return self._building_locks.setdefault(building_id, threading.RLock())
+
+    def _day_fingerprints(self, estimator, dates):
+        """
+        Called with the lock of the building held.
+        :param estimator: estimator of the building
+        :param dates: DatetimeIndex of days
+        :return: dict of date string to the fingerprint of the day as of the last refresh. Days not served before are
+        fingerprinted in the database.
+        """
+        with self._lock:
+            known = self._fingerprints.setdefault(estimator.building_id, {})
+        new_dates = pd.DatetimeIndex([date for date in dates if str(date) not in known])
+        if len(new_dates):
+            new_fingerprints = get_day_fingerprints(estimator.db, estimator.building_id, new_dates)
+            with self._lock:
+                known.update(new_fingerprints)
+        return {str(date): known[str(date)] for date in dates}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class EstimationRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API of an EstimationService, the server's service attribute:
+        GET /estimate?building_id=1&date=2018-03-05
+        GET /estimates?building_id=1&start_date=2018-03-01&end_date=2018-03-31
+        POST /estimates with {"queries": [{"building_id": 1, "date": "2018-03-05"}, ...]}
+        GET /stats
+    Invalid queries get a 400 with an error message, failed estimations a 500.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        service = self.server.service
+        if url.path == "/estimate":
+            self._respond("estimate", lambda: service.estimate(params["building_id"], params["date"]))
+        elif url.path == "/estimates":
+            self._respond("estimates", lambda: service.estimate_range(
+                params["building_id"], params["start_date"], params["end_date"]
+            ))
+        elif url.path == "/stats":
+            self._respond("stats", service.stats)
+        else:
+            self._send(404, {"error": "Unknown path {}".format(url.path)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/estimates":
+            self._send(404, {"error": "Unknown path {}".format(url.path)})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+
+        def estimate_many():
+            return self.server.service.estimate_many(json.loads(self.rfile.read(length).decode("utf-8"))["queries"])
+
+        self._respond("bulk", estimate_many)
+
+    def _respond(self, endpoint, handle):
+        start = time.perf_counter()
+        try:
+            status, body = 200, handle()
+        except (KeyError, ValueError, TypeError) as e:
+            status, body = 400, {"error": "Invalid request: {!r}".format(e)}
+        except Exception as e:
+            status, body = 500, {"error": "Estimation failed: {!r}".format(e)}
+        self._send(status, body)
+        self.server.service.latencies.record(endpoint, time.perf_counter() - start)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else "unix socket"
+
+    def log_message(self, format, *args):
+        # One line per request would dominate the cost of a cached query, see the latencies in /stats instead.
+        pass
+
+
+def make_server(service, host="127.0.0.1", port=8080, socket_path=None):
+    """
+    :param service: EstimationService
+    :param host: address to listen on
+    :param port: port to listen on, 0 picks a free one.
+    :param socket_path: path of a Unix socket to listen on instead of host and port
+    :return: threading server handling every request in its own thread, call serve_forever to start it.
+    """
+    if socket_path is not None:
+        server = ThreadingUnixHTTPServer(socket_path, EstimationRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), EstimationRequestHandler)
+    server.service = service
+    return server
+
+
+def _as_record(building_id, date, result):
+    operating, lease_satisfied_time = result
+    if lease_satisfied_time is not None and not isinstance(lease_satisfied_time, str):
+        lease_satisfied_time = None if pd.isna(lease_satisfied_time) else str(pd.Timestamp(lease_satisfied_time))
+    return {
+        "building_id": building_id,
+        "date": date,
+        "operating": None if operating is None or pd.isna(operating) else bool(operating),
+        "lease_satisfied_time": lease_satisfied_time,
+    }
@@ -0,0 +1,184 @@
+"""
+This module generates synthetic buildings, sensors and floor temperature measurements in the schema of the production
+database, so that the data access and estimation code can be exercised and benchmarked against a local database
+(e.g. SQLite or a throwaway Postgres) instead of the live one.
+:copyright: Cortex
+:author: Sourav Dey <sdey@manifold.ai>
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import Boolean, Column, DateTime, Float, Index, Integer, MetaData, String, Table
+
+METADATA = MetaData()
+
+BUILDINGS = Table(
+    "buildings",
+    METADATA,
+    Column("id", Integer, primary_key=True),
+    Column("name", String(64)),
+)
+
+BUILDING_SENSOR_CONFIGS = Table(
+    "building_sensor_configs",
+    METADATA,
+    Column("id", Integer, primary_key=True),
+    Column("building_id", Integer, nullable=False),
+    Column("ignore", Boolean, nullable=False),
+    Index("ix_building_sensor_configs_building_id", "building_id"),
+)
+
+FLOOR_TEMPERATURE_MEASUREMENTS = Table(
+    "floor_temperature_measurements",
+    METADATA,
+    Column("building_sensor_config_id", Integer, nullable=False),
+    Column("measured_at", DateTime, nullable=False),
+    Column("measurement", Float),
+    Column("bad_data", Boolean, nullable=False),
+    Index("ix_floor_temperature_measurements_sensor_time", "building_sensor_config_id", "measured_at"),
+    Index("ix_floor_temperature_measurements_measured_at", "measured_at"),
+)
+
+DEFAULT_PROFILE = {
+    # Building temperature (deg F) over night and on weekends, and the target during operating hours.
+    "setback_temp": 62.,
+    "target_temp": 72.,
+    # The HVAC starts between these UTC hours on weekdays and needs ramp_hours to reach the target.
+    "earliest_start_hour": 8.,
+    "latest_start_hour": 11.,
+    "ramp_hours": 2.,
+    "sensor_offset_std": 1.5,
+    "noise_std": 0.3,
+    # Fraction of the sensors that are flagged ignore, and that measure spaces the HVAC doesn't control.
+    "ignored_rate": 0.05,
+    "irrelevant_rate": 0.1,
+    # Fraction of the readings that are flagged bad_data (with garbage values), and that are missing.
+    "bad_data_rate": 0.01,
+    "missing_rate": 0.01,
+}
+
+
+def create_schema(db):
+    """
+    Create the buildings, building_sensor_configs and floor_temperature_measurements tables, dropping them first if
+    they exist.
+    :param db: an active sql engine
+    """
+    METADATA.drop_all(db)
+    METADATA.create_all(db)
+
+
+def generate_synthetic_data(db, building_ids, n_sensors, start_date, days, freq="15min", seed=0, days_per_batch=7,
+                            **profile):
+    """
+    Fill a fresh schema with synthetic data. Every building gets n_sensors sensors with ids building_id * 100000 + i.
+    Relevant sensors follow the building's warm-up curve with a per sensor offset and noise, irrelevant ones sit at a
+    constant temperature, some sensors are ignored, and readings are randomly dropped or flagged as bad data with a
+    garbage value. Measurements are inserted days_per_batch days at a time to bound memory.
+    :param db: an active sql engine
+    :param building_ids: list of integer building ids
+    :param n_sensors: number of sensors per building
+    :param start_date: date string of the first day
+    :param days: number of days
+    :param freq: measurement cadence
+    :param seed: random seed, the same arguments always produce the same data
+    :param days_per_batch: number of days generated and inserted at a time
+    :param profile: entries overriding DEFAULT_PROFILE
+    :return: dict with the number of {buildings, sensors, ignored_sensors, irrelevant_sensors, rows, bad_rows}
+    """
+    profile = dict(DEFAULT_PROFILE, **profile)
+    unknown = set(profile) - set(DEFAULT_PROFILE)
+    if unknown:
+        raise ValueError("Unknown profile settings: {}".format(sorted(unknown)))
+    rng = np.random.RandomState(seed)
+    create_schema(db)
+
+    sensors = make_sensors(building_ids, n_sensors, profile, rng)
+    with db.begin() as conn:
+        conn.execute(BUILDINGS.insert(), [
+            {"id": int(building_id), "name": "Synthetic building {}".format(building_id)}
+            for building_id in building_ids
+        ])
+        conn.execute(BUILDING_SENSOR_CONFIGS.insert(), [
+            {"id": int(row.id), "building_id": int(row.building_id), "ignore": bool(row.ignore)}
+            for row in sensors.itertuples(index=False)
+        ])
+
+    summary = {
+        "buildings": len(building_ids),
+        "sensors": len(sensors),
+        "ignored_sensors": int(sensors["ignore"].sum()),
+        "irrelevant_sensors": int((~sensors["relevant"]).sum()),
+        "rows": 0,
+        "bad_rows": 0,
+    }
+    dates = pd.date_range(start_date, periods=days)
+    for i in range(0, len(dates), days_per_batch):
+        measurements = make_measurements(sensors, dates[i:i + days_per_batch], freq, profile, rng)
+        measurements.to_sql(
+            FLOOR_TEMPERATURE_MEASUREMENTS.name, db, if_exists="append", index=False, chunksize=10000
+        )
+        summary["rows"] += len(measurements)
+        summary["bad_rows"] += int(measurements["bad_data"].sum())
+    return summary
+
+
+def make_sensors(building_ids, n_sensors, profile, rng):
+    """
+    :return: DataFrame with the columns {id, building_id, ignore, relevant, offset} and a row per sensor.
+    """
+    n = len(building_ids) * n_sensors
+    return pd.DataFrame(
+        {
+            "id": np.concatenate([building_id * 100000 + np.arange(n_sensors) for building_id in building_ids]),
+            "building_id": np.repeat(building_ids, n_sensors),
+            "ignore": rng.rand(n) < profile["ignored_rate"],
+            "relevant": rng.rand(n) >= profile["irrelevant_rate"],
+            "offset": rng.normal(0., profile["sensor_offset_std"], n),
+        },
+        columns=["id", "building_id", "ignore", "relevant", "offset"],
+    )
+
+
+def make_measurements(sensors, dates, freq, profile, rng):
+    """
+    :param sensors: DataFrame as returned by make_sensors
+    :param dates: DatetimeIndex of the days to generate
+    :return: DataFrame in the schema of floor_temperature_measurements.
+    """
+    times = pd.date_range(dates[0], dates[-1] + pd.Timedelta(days=1), freq=freq)[:-1]
+    hours = np.asarray((times - times.normalize()) / pd.Timedelta(hours=1))
+    day_of_times = np.asarray((times.normalize() - dates[0]).days)
+    weekday = np.asarray(dates.dayofweek <= 4)
+
+    frames = []
+    for building_id, building_sensors in sensors.groupby("building_id", sort=False):
+        start_hour = rng.uniform(profile["earliest_start_hour"], profile["latest_start_hour"], len(dates))
+        warm_up = np.clip((hours - start_hour[day_of_times]) / profile["ramp_hours"], 0., 1.)
+        warm_up[~weekday[day_of_times]] = 0.
+        building_temp = profile["setback_temp"] + (profile["target_temp"] - profile["setback_temp"]) * warm_up
+
+        shape = (len(building_sensors), len(times))
+        temps = np.where(
+            building_sensors["relevant"].values[:, None],
+            building_temp[None, :] + building_sensors["offset"].values[:, None],
+            # Server rooms and the like: a steady temperature of their own.
+            profile["setback_temp"] - 5. + 3. * building_sensors["offset"].values[:, None],
+        ) + rng.normal(0., profile["noise_std"], shape)
+        bad_data = rng.rand(*shape) < profile["bad_data_rate"]
+        temps[bad_data] = rng.choice([-10., 0., 150.], bad_data.sum())
+        present = rng.rand(*shape) >= profile["missing_rate"]
+
+        frames.append(
+            pd.DataFrame(
+                {
+                    "building_sensor_config_id": np.repeat(building_sensors["id"].values, len(times))[
+                        present.ravel()
+                    ],
+                    "measured_at": np.tile(times.values, len(building_sensors))[present.ravel()],
+                    "measurement": temps.round(1).ravel()[present.ravel()],
+                    "bad_data": bad_data.ravel()[present.ravel()],
+                },
+                columns=["building_sensor_config_id", "measured_at", "measurement", "bad_data"],
+            )
+        )
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,109 @@
+"""
+Tests for the checkpoints of the historical runs, against synthetic data in a local SQLite database.
+"""
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from src.checkpoints import WINDOW_FINGERPRINT_QUERY, CheckpointStore, get_day_fingerprints, get_estimator_key
+from src.lease_satisfied_estimator import YourEstimator
+from src.pushdown import PushdownEstimator
+from src.sensor_index import SensorQualityIndex
+from src.synthetic_data import generate_synthetic_data
+
+DATES = pd.date_range("2018-03-01", "2018-03-07")
+
+
+@pytest.fixture
+def db(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 5)
+    return db
+
+
+def _results(dates):
+    return pd.DataFrame.from_dict(
+        {
+            str(date): {
+                "building_id": 1,
+                "operating": date.dayofweek <= 4,
+                "lease_satisfied_time": date + pd.Timedelta(hours=8) if date.dayofweek <= 4 else "Not Satisfied",
+            }
+            for date in dates
+        },
+        orient="index",
+    )
+
+
+def test_day_fingerprints_change_with_data(db):
+    fingerprints = get_day_fingerprints(db, 1, DATES)
+    assert set(fingerprints) == {str(date) for date in DATES}
+    # The synthetic data ends after 5 days.
+    assert fingerprints["2018-03-06 00:00:00"] == "0"
+    assert all(fingerprints[str(date)] != "0" for date in DATES[:5])
+    assert get_day_fingerprints(db, 1, DATES) == fingerprints
+
+    with db.begin() as conn:
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 WHERE measured_at = '2018-03-02 10:00:00.000000'"
+        ))
+    changed = get_day_fingerprints(db, 1, DATES)
+    assert [date for date in fingerprints if changed[date] != fingerprints[date]] == ["2018-03-02 00:00:00"]
+
+    # A change below the resolution of a single precision sum of the day.
+    with db.begin() as conn:
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET measurement = measurement + 0.004 WHERE rowid = ("
+            " SELECT MIN(f1.rowid) FROM floor_temperature_measurements f1"
+            " JOIN building_sensor_configs b2 ON b2.id = f1.building_sensor_config_id"
+            " WHERE f1.measured_at >= '2018-03-03' AND f1.measured_at < '2018-03-04'"
+            " AND f1.bad_data = 0 AND b2.ignore = 0)"
+        ))
+    assert get_day_fingerprints(db, 1, DATES)["2018-03-03 00:00:00"] != fingerprints["2018-03-03 00:00:00"]
+    assert "SUM(CAST(f1.measurement AS DOUBLE PRECISION))" in WINDOW_FINGERPRINT_QUERY
+
+
+def test_store_round_trip_and_pending_dates(tmpdir):
+    store = CheckpointStore(os.path.join(str(tmpdir), "checkpoints.jsonl"))
+    fingerprints = {str(date): "fp" for date in DATES}
+    assert list(store.pending_dates(1, DATES, fingerprints, "a")) == list(DATES)
+
+    df = _results(DATES[:4])
+    store.append(df, fingerprints, "a")
+    # A line torn by a crash is skipped.
+    with open(store.path, "a") as f:
+        f.write('{"building_id": 1, "date": "2018-03-0')
+
+    store = CheckpointStore(store.path)
+    assert list(store.pending_dates(1, DATES, fingerprints, "a")) == list(DATES[4:])
+    fingerprints["2018-03-02 00:00:00"] = "changed"
+    assert list(store.pending_dates(1, DATES, fingerprints, "a")) == [DATES[1]] + list(DATES[4:])
+    assert list(store.pending_dates(1, DATES, fingerprints, "b")) == list(DATES)
+    assert list(store.pending_dates(2, DATES, fingerprints, "a")) == list(DATES)
+
+    # Appending after the torn line keeps the new records.
+    store.append(_results(DATES[4:6]), fingerprints, "a")
+    store = CheckpointStore(store.path)
+    assert list(store.pending_dates(1, DATES, fingerprints, "a")) == [DATES[1]] + list(DATES[6:])
+
+    results = store.results(1, DATES[:4])
+    assert list(results.index) == [str(date) for date in DATES[:4]]
+    assert results.loc["2018-03-01 00:00:00", "lease_satisfied_time"] == "2018-03-01 08:00:00"
+    assert results.loc["2018-03-04 00:00:00", "lease_satisfied_time"] == "Not Satisfied"
+    assert not results.loc["2018-03-04 00:00:00", "operating"]
+
+    store.clear()
+    assert store.results(1, DATES).empty
+    assert not os.path.exists(store.path)
+
+
+def test_estimator_key(db):
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    key = get_estimator_key(YourEstimator(1, db=db, sensor_index=sensor_index))
+    assert key == get_estimator_key(YourEstimator(1, db=db, sensor_index=sensor_index))
+    assert key != get_estimator_key(YourEstimator(1, db=db))
+    assert key != get_estimator_key(PushdownEstimator(1, db=db, sensor_index=sensor_index))
+    assert get_estimator_key(PushdownEstimator(1, db=db, sensor_index=sensor_index)) != get_estimator_key(
+        PushdownEstimator(1, db=db, sensor_index=sensor_index, search_window="operating")
+    )
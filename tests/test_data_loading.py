@@ -12,6 +12,8 @@ from dotenv import load_dotenv, find_dotenv
 
 from src.data_loading import (
     get_internal_temps,
+    get_time_bounds,
+    iter_internal_temps,
     get_lease_obligations,
     get_lease_obligation_temp_range,
     get_operating_period_in_utc,
@@ -39,6 +41,26 @@ def test_get_internal_temps():
     )
 
 
+def test_iter_internal_temps_matches_get_internal_temps():
+    db = create_engine(os.environ["HW_DATABASE_URL"])
+    df = get_internal_temps(db, 37, start_time="2018-02-04", end_time="2018-02-06")
+    frames = list(iter_internal_temps(db, 37, start_time="2018-02-04", end_time="2018-02-06", chunksize=100))
+    assert len(frames) > 1
+    assert sum(len(frame) for frame in frames) == len(df)
+    pd.testing.assert_frame_equal(
+        get_internal_temps(db, 37, start_time="2018-02-04", end_time="2018-02-06", chunksize=100), df
+    )
+
+
+def test_get_time_bounds():
+    assert get_time_bounds("2018-02-04", "2018-02-06") == (datetime(2018, 2, 4), datetime(2018, 2, 6))
+    assert get_time_bounds("2018-02-04", "2018-02-04") == (datetime(2018, 2, 4), datetime(2018, 2, 4, 23, 59, 59))
+    assert get_time_bounds("2018-02-04 00:00:00", "2018-02-04 00:00:00") == (
+        datetime(2018, 2, 4),
+        datetime(2018, 2, 4, 23),
+    )
+
+
 def test_get_lease_obligations():
     lease_df = get_lease_obligations(37)
     assert lease_df.shape[0] == 7
@@ -0,0 +1,58 @@
+"""
+Tests for the vectorized (day x slot x sensor) kernel.
+"""
+import numpy as np
+import pandas as pd
+
+from src.data_loading import get_day_window
+from src.day_tensor import DayTensor, count_day_readings, estimate_days, first_crossings
+from src.lease_satisfied_estimator import _count_readings, getPred2, operatingDayCheck
+from src.sensor_matrix import SensorMatrix
+
+
+def _matrix(start, end, n_sensors=6, seed=0):
+    rng = np.random.RandomState(seed)
+    times = pd.date_range(start, end, freq="15min")
+    values = rng.uniform(66., 76., size=(n_sensors, len(times)))
+    values[rng.uniform(size=values.shape) < 0.3] = np.nan
+    # A day without data, and a day with data in the morning only.
+    values[:, (times >= "2018-03-07") & (times < "2018-03-08")] = np.nan
+    values[:, (times >= "2018-03-09 06:00") & (times < "2018-03-10")] = np.nan
+    # A day that never reaches the band.
+    values[:, (times >= "2018-03-12") & (times < "2018-03-13")] = 60.
+    return SensorMatrix(values, np.arange(10, 10 + n_sensors), times)
+
+
+def test_first_crossings():
+    temps = np.array([
+        [np.nan, 69., 72., 71.],
+        [np.nan, np.nan, np.nan, np.nan],
+        [80., 75., 60., 70.],
+    ])
+    np.testing.assert_array_equal(first_crossings(temps), [2, -1, 1])
+
+
+def test_day_tensor_matches_sensor_matrix():
+    matrix = _matrix("2018-03-05", "2018-03-11 23:00")
+    dates = pd.date_range("2018-03-05", "2018-03-11")
+    tensor = DayTensor.from_matrix(matrix, dates, {11, 13, 14})
+    assert tensor.values.shape == (7, 93, 3)
+    for i, date in enumerate(dates):
+        day = matrix.time_slice(*get_day_window(str(date))).select({11, 13, 14})
+        np.testing.assert_array_equal(tensor.slot_times()[i], day.times.values)
+        np.testing.assert_array_equal(tensor.mean()[i], day.mean())
+
+
+def test_estimate_days_matches_day_by_day_estimate():
+    matrix = _matrix("2018-03-05", "2018-03-14 23:00", n_sensors=40)
+    # The matrix covers only part of the dates.
+    dates = pd.date_range("2018-03-03", "2018-03-16")
+    relevant = set(matrix.sensor_ids[::3])
+    readings, sensors = count_day_readings(matrix, dates)
+    for date, result, n_readings, n_sensors in zip(
+        dates, estimate_days(matrix, dates, relevant), readings, sensors
+    ):
+        day = matrix.time_slice(*get_day_window(str(date)))
+        operating = operatingDayCheck(day, str(date))
+        assert result == (operating, getPred2(day, relevant) if operating else None), date
+        assert (n_readings, n_sensors) == _count_readings(day)
@@ -0,0 +1,53 @@
+"""
+Tests for the shared database engine.
+"""
+import pytest
+from dotenv import load_dotenv, find_dotenv
+
+from src import db
+from src.data_loading import get_internal_temps
+
+load_dotenv(find_dotenv(), verbose=True)
+
+
+@pytest.fixture(autouse=True)
+def reset_settings():
+    yield
+    db.configure()
+
+
+def test_get_engine_is_shared():
+    db.configure("sqlite://")
+    engine = db.get_engine()
+    assert db.get_engine() is engine
+    db.configure("sqlite://")
+    assert db.get_engine() is not engine
+
+
+def test_configure_rejects_unknown_settings():
+    with pytest.raises(ValueError):
+        db.configure(pool_sise=3)
+
+
+def test_pool_stats():
+    db.configure(pool_size=2, pool_recycle=600)
+    df = get_internal_temps(None, 37, start_time="2018-02-04", end_time="2018-02-06")
+    assert len(df) == 193
+    stats = db.get_pool_stats()
+    assert stats["checkouts"] >= 1
+    assert stats["connects"] == 1
+    assert stats["checked_out"] == 0
+
+
+def test_connection_from_before_a_fork_is_replaced():
+    db.configure(pool_size=1)
+    engine = db.get_engine()
+    with engine.connect() as conn:
+        parent_connection = conn.connection.dbapi_connection
+    # Make the pooled connection look like it was opened by a parent process.
+    engine.pool._pool.queue[0].info["pid"] = -1
+    df = get_internal_temps(None, 37, start_time="2018-02-04", end_time="2018-02-06")
+    assert len(df) == 193
+    assert db.get_pool_stats()["connects"] == 2
+    # Left open for the parent.
+    assert not parent_connection.closed
@@ -0,0 +1,75 @@
+"""
+Tests for the multi-variant evaluation engine.
+"""
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.evaluation import AGGREGATORS, DayData, evaluate_building, evaluate_day, summarize_agreement
+from src.lease_satisfied_estimator import YourEstimator
+from src.sensor_index import SensorQualityIndex
+from src.sensor_matrix import SensorMatrix
+from src.synthetic_data import generate_synthetic_data
+
+
+def _day(values):
+    times = pd.date_range("2018-03-05", periods=values.shape[1], freq="15min")
+    return DayData(SensorMatrix(values, np.arange(len(values)), times), {0, 1, 2})
+
+
+def _trim_mean(readings, proportion):
+    cut = int(proportion * len(readings))
+    return np.sort(readings)[cut:len(readings) - cut].mean() if len(readings) > 2 * cut else np.nan
+
+
+def test_aggregators_match_reference_implementations():
+    rng = np.random.RandomState(0)
+    values = rng.uniform(65., 80., size=(12, 96))
+    values[rng.uniform(size=values.shape) < 0.2] = np.nan
+    values[:, 0] = np.nan
+    day = _day(values)
+    readings = [column[~np.isnan(column)] for column in day.matrix.values.astype(np.float64).T]
+    for q in [0.25, 0.5, 0.75]:
+        expected = day.in_band(np.array([np.percentile(r, 100 * q) if len(r) else np.nan for r in readings]))
+        np.testing.assert_array_equal(AGGREGATORS["quantile"](day, "all", q=q), expected)
+    expected = day.in_band(np.array([_trim_mean(r, 0.1) for r in readings]))
+    np.testing.assert_array_equal(AGGREGATORS["trimmed_mean"](day, "all", proportion=0.1), expected)
+    expected = np.array([len(r) > 0 and ((r >= 70.) & (r <= 75.)).mean() >= 0.5 for r in readings])
+    np.testing.assert_array_equal(AGGREGATORS["fraction_in_band"](day, "all", threshold=0.5), expected)
+
+
+def test_evaluate_day_shares_intermediates():
+    values = np.full((3, 8), 68.)
+    values[:, 3:] = [[71.], [72.], [90.]]
+    day = _day(values)
+    row = evaluate_day(day, "2018-03-05", {
+        "mean": ("mean", {"sensors": "all"}),
+        "median": ("quantile", {"sensors": "all", "q": 0.5}),
+        "fraction": ("fraction_in_band", {"sensors": "all", "threshold": 0.6}),
+        "strict_fraction": ("fraction_in_band", {"sensors": "all", "threshold": 1.}),
+    })
+    assert row["operating"]
+    assert row["mean"] == "Not Satisfied"
+    assert row["median"] == day.times[3]
+    assert row["fraction"] == day.times[3]
+    assert row["strict_fraction"] == "Not Satisfied"
+    assert sum(name == "sensor_in_band" for name, _ in day._memo) == 1
+
+
+def test_evaluate_building_matches_your_estimator(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 20, "2018-03-01", 14)
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    df = evaluate_building(1, "2018-02-27", "2018-03-16", db=db, sensor_index=sensor_index, chunk_days=5)
+    expected = YourEstimator(1, db=db, sensor_index=sensor_index).compute_lease_satisfied_times(
+        "2018-02-27", "2018-03-16"
+    )
+    assert list(df.index) == list(expected.index)
+    assert list(df["operating"]) == list(expected["operating"])
+    assert list(df["pred2"]) == list(expected["lease_satisfied_time"])
+
+    summary = summarize_agreement(df)
+    assert summary.loc["pred2", "agreement"] == 1.
+    assert summary.loc["pred2", "mean_minutes_vs_reference"] == 0.
+    assert list(summary.index) == list(df.columns[2:])
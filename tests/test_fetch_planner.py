@@ -0,0 +1,94 @@
+"""
+Tests for the operating window fetch planner, against synthetic data in a local SQLite database.
+"""
+import os
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from src.data_loading import get_day_window, get_lease_obligations, get_operating_period_in_utc
+from src.fetch_planner import OperatingWindowEstimator, get_fetch_fraction, plan_fetch_windows
+from src.instrumentation import reset_metrics
+from src.lease_calendar import LeaseCalendar
+from src.lease_satisfied_estimator import YourEstimator
+from src.sensor_index import SensorQualityIndex
+from src.synthetic_data import generate_synthetic_data
+
+
+def test_plan_fetch_windows():
+    lease_obligations = get_lease_obligations(1)
+    windows = plan_fetch_windows(LeaseCalendar(lease_obligations), "2018-03-09", "2018-03-12", lookback_hours=2)
+    # 9:00 - 18:00 in New York, the clocks went forward on the 11th.
+    assert windows.loc["2018-03-09", "fetch_start"] == pd.Timestamp("2018-03-09 12:00")
+    assert windows.loc["2018-03-09", "fetch_end"] == pd.Timestamp("2018-03-09 23:00")
+    assert windows.loc["2018-03-12", "fetch_start"] == pd.Timestamp("2018-03-12 11:00")
+    assert windows.loc["2018-03-12", "fetch_end"] == pd.Timestamp("2018-03-12 22:00")
+    assert not windows.loc["2018-03-10", "operating"]
+    assert windows.loc[["2018-03-10", "2018-03-11"], "fetch_start"].isna().all()
+    assert get_fetch_fraction(windows) == (11. + 11.) / (4 * 23.)
+
+    # Windows are clipped to the day window.
+    lease_obligations.loc[0, "local_operating_end_hour"] = 21
+    windows = plan_fetch_windows(LeaseCalendar(lease_obligations), "2018-03-12", "2018-03-12", lookback_hours=20)
+    assert windows.loc["2018-03-12", "fetch_start"] == pd.Timestamp("2018-03-12 00:00")
+    assert windows.loc["2018-03-12", "fetch_end"] == pd.Timestamp("2018-03-12 23:00")
+
+
+def test_plan_fetch_windows_clock_changes():
+    # Operating periods starting at wall clock times that are skipped or occur twice.
+    lease_obligations = get_lease_obligations(1)
+    lease_obligations["operating"] = True
+    lease_obligations["local_operating_end_hour"] = 18.
+    for start_hour, dates in [(2., ["2018-03-10", "2018-03-11", "2018-03-12"]), (1., ["2018-11-03", "2018-11-04"])]:
+        lease_obligations["local_operating_start_hour"] = start_hour
+        windows = plan_fetch_windows(LeaseCalendar(lease_obligations), dates[0], dates[-1], lookback_hours=0)
+        for date in dates:
+            operating_start, operating_end = get_operating_period_in_utc(lease_obligations, date)
+            _, day_end = get_day_window(date)
+            assert windows.loc[date, "fetch_start"] == operating_start.replace(tzinfo=None)
+            assert windows.loc[date, "fetch_end"] == min(operating_end.replace(tzinfo=None), day_end)
+
+
+def test_operating_window_estimator(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 20, "2018-03-01", 14)
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    # Never in the band on the 7th.
+    with db.begin() as conn:
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET measurement = 60. "
+            "WHERE measured_at >= '2018-03-07' AND measured_at < '2018-03-08'"
+        ))
+
+    metrics = reset_metrics()
+    expected = YourEstimator(1, db=db, sensor_index=sensor_index).compute_lease_satisfied_times(
+        "2018-03-01", "2018-03-14"
+    )
+    all_rows = metrics.to_dict()["stages"]
+    metrics = reset_metrics()
+    estimator = OperatingWindowEstimator(1, db=db, sensor_index=sensor_index, lookback_hours=3)
+    df = estimator.compute_lease_satisfied_times("2018-03-01", "2018-03-14")
+    pruned_rows = metrics.to_dict()["stages"]
+
+    def fetched(stages):
+        return sum(stage["rows"] for stage in stages if stage["stage"] == "decode")
+
+    assert fetched(pruned_rows) < 0.5 * fetched(all_rows)
+    windows = plan_fetch_windows(estimator.lease_calendar, "2018-03-01", "2018-03-14", lookback_hours=3)
+    for date, row in df.iterrows():
+        window = windows.loc[pd.Timestamp(date)]
+        if not window["operating"]:
+            assert row["operating"] is False and pd.isna(row["lease_satisfied_time"])
+            continue
+        assert row["operating"]
+        satisfied_time = expected.loc[date, "lease_satisfied_time"]
+        if satisfied_time == "Not Satisfied" or satisfied_time >= window["fetch_start"]:
+            assert row["lease_satisfied_time"] == satisfied_time
+        else:
+            # Satisfied before the look-back, found at its start or later.
+            assert row["lease_satisfied_time"] == "Not Satisfied" or row["lease_satisfied_time"] >= window[
+                "fetch_start"
+            ]
+    assert expected.loc["2018-03-07 00:00:00", "lease_satisfied_time"] == "Not Satisfied"
+    assert estimator.compute_lease_satisfied_time("2018-03-05") == (
+        df.loc["2018-03-05 00:00:00", "operating"], df.loc["2018-03-05 00:00:00", "lease_satisfied_time"]
+    )
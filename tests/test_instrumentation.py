@@ -0,0 +1,81 @@
+"""
+Tests for the stage timers and counters.
+"""
+import json
+import os
+import threading
+import time
+from sqlalchemy import create_engine
+
+from src.data_loading import get_internal_temps
+from src.instrumentation import Metrics, merge_profiles, profile, reset_metrics, write_metrics
+from src.synthetic_data import generate_synthetic_data
+
+
+def test_stage_and_merge():
+    metrics = Metrics()
+    with metrics.stage("sql", 37) as counters:
+        counters["rows"] = 10
+    with metrics.stage("sql", 37) as counters:
+        counters["rows"] = 5
+    assert counters["wall_seconds"] >= 0.
+    metrics.record_day(37, "2018-02-05", rows=15)
+
+    merged = Metrics()
+    merged.merge(metrics.to_dict())
+    merged.merge(metrics)
+    stages = merged.to_dict()["stages"]
+    assert len(stages) == 1
+    assert stages[0]["stage"] == "sql" and stages[0]["building_id"] == 37
+    assert stages[0]["calls"] == 4 and stages[0]["rows"] == 30
+    assert len(merged.days) == 2
+    assert list(merged.building_seconds()) == [37]
+
+
+def test_get_internal_temps_is_instrumented(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    summary = generate_synthetic_data(db, [1], 5, "2018-02-05", 1, bad_data_rate=0., ignored_rate=0.)
+    metrics = reset_metrics()
+    get_internal_temps(db, 1, "2018-02-05", "2018-02-05", chunksize=100)
+    stages = {record["stage"]: record for record in metrics.to_dict()["stages"]}
+    assert set(stages) == {"sql", "decode", "pivot"}
+    assert stages["sql"]["rows"] == stages["decode"]["rows"] == stages["pivot"]["rows"] == summary["rows"]
+    assert stages["decode"]["bytes"] > 0
+
+    path = os.path.join(str(tmpdir), "metrics.json")
+    write_metrics(path, metrics, workers=1)
+    with open(path) as f:
+        assert json.load(f)["run"] == {"workers": 1}
+
+
+def test_stage_cpu_seconds_are_of_its_thread():
+    metrics = Metrics()
+    stopped = threading.Event()
+
+    def spin():
+        while not stopped.is_set():
+            pass
+
+    # Busy in another thread while the stage waits.
+    spinner = threading.Thread(target=spin)
+    spinner.start()
+    try:
+        with metrics.stage("wait") as counters:
+            time.sleep(0.2)
+    finally:
+        stopped.set()
+        spinner.join()
+    assert counters["wall_seconds"] >= 0.2
+    assert counters["cpu_seconds"] < 0.05
+
+
+def test_profile(tmpdir):
+    path_prefix = os.path.join(str(tmpdir), "profile")
+    assert profile(lambda: sum(range(10)), path_prefix) == 45
+    assert os.path.exists(path_prefix + ".prof")
+    assert os.path.exists(path_prefix + ".txt")
+    profile(lambda: sorted(range(10)), path_prefix + "_2")
+    merge_profiles([path_prefix + ".prof", path_prefix + "_2.prof"], path_prefix + "_merged")
+    with open(path_prefix + "_merged.txt") as f:
+        report = f.read()
+    assert "sum" in report and "sorted" in report
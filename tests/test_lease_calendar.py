@@ -0,0 +1,77 @@
+"""
+Tests for the vectorized lease calendar.
+"""
+from datetime import datetime
+import pandas as pd
+from dateutil.tz import tzutc
+
+from src.data_loading import (
+    get_lease_obligations,
+    get_lease_obligation_temp_range,
+    get_operating_period_in_utc,
+    make_lease_obligation_schedule,
+)
+from src.lease_calendar import LeaseCalendar, build_lease_calendar, get_lease_calendar
+
+
+def test_build_lease_calendar_matches_single_days():
+    lease_df = get_lease_obligations(37)
+    dates = pd.date_range("2018-01-01", "2018-12-31")
+    calendar = build_lease_calendar(lease_df, dates)
+    assert len(calendar) == len(dates)
+    for date in dates:
+        day = calendar.loc[date]
+        start_dt, end_dt = get_operating_period_in_utc(lease_df, str(date.date()))
+        lower, upper = get_lease_obligation_temp_range(lease_df, str(date.date()))
+        if start_dt is None:
+            assert not day["operating"]
+            assert pd.isna(day["utc_operating_start"])
+            assert pd.isna(day["lower_operating_temp"])
+        else:
+            assert day["operating"]
+            assert day["utc_operating_start"] == start_dt
+            assert day["utc_operating_end"] == end_dt
+            assert (day["lower_operating_temp"], day["upper_operating_temp"]) == (lower, upper)
+
+
+def test_build_lease_calendar_daylight_savings():
+    calendar = build_lease_calendar(get_lease_obligations(37), ["2018-03-09", "2018-03-12"])
+    assert calendar.loc["2018-03-09", "utc_operating_start"] == datetime(2018, 3, 9, 14, 0, tzinfo=tzutc())
+    assert calendar.loc["2018-03-12", "utc_operating_start"] == datetime(2018, 3, 12, 13, 0, tzinfo=tzutc())
+
+
+def test_build_lease_calendar_clock_changes():
+    # Operating periods starting or ending at wall clock times that are skipped or occur twice.
+    dates = pd.date_range("2018-03-10", "2018-03-12").append(pd.date_range("2018-11-03", "2018-11-05"))
+    for start_hour, end_hour in [(2., 3.), (2.5, 26.5), (1., 1.5), (0.5, 2.)]:
+        lease_df = get_lease_obligations(37)
+        lease_df["operating"] = True
+        lease_df["local_operating_start_hour"] = start_hour
+        lease_df["local_operating_end_hour"] = end_hour
+        calendar = build_lease_calendar(lease_df, dates)
+        for date in dates:
+            start_dt, end_dt = get_operating_period_in_utc(lease_df, str(date.date()))
+            assert calendar.loc[date, "utc_operating_start"] == start_dt
+            assert calendar.loc[date, "utc_operating_end"] == end_dt
+
+
+def test_lease_calendar_schedule():
+    winter = get_lease_obligations(37)
+    summer = winter.copy()
+    summer["local_operating_start_hour"] = 7
+    summer["lower_operating_temp"] = 68.
+    schedule = make_lease_obligation_schedule(
+        [("2018-01-01", "2018-06-01", winter), ("2018-06-01", "2019-01-01", summer)]
+    )
+    calendar = LeaseCalendar(schedule)
+    days = calendar.days("2018-05-31", "2018-06-01")
+    assert days.loc["2018-05-31", "utc_operating_start"] == datetime(2018, 5, 31, 13, 0, tzinfo=tzutc())
+    assert days.loc["2018-06-01", "utc_operating_start"] == datetime(2018, 6, 1, 11, 0, tzinfo=tzutc())
+    assert days.loc["2018-06-01", "lower_operating_temp"] == 68
+    # Outside of the schedule
+    assert not calendar.day("2019-01-02")["operating"]
+
+
+def test_get_lease_calendar_is_cached():
+    assert get_lease_calendar(37) is get_lease_calendar(37)
+    assert get_lease_calendar(37).day("2018-02-05")["operating"]
@@ -30,3 +30,17 @@ def test_your_estimator():
     operating, lease_satisfied_time = me.compute_lease_satisfied_time("2018-02-04")
     assert operating == False
     assert lease_satisfied_time is None
+
+
+def test_compute_lease_satisfied_times_matches_single_days():
+    me = YourEstimator(building_id=37)
+    df = me.compute_lease_satisfied_times("2018-02-01", "2018-02-10", chunk_days=4)
+    assert list(df.columns) == ["building_id", "operating", "lease_satisfied_time"]
+    assert len(df) == 10
+    for date in pd.date_range("2018-02-01", "2018-02-10"):
+        operating, lease_satisfied_time = me.compute_lease_satisfied_time(str(date))
+        assert df.loc[str(date)]["operating"] == operating
+        if lease_satisfied_time is None:
+            assert pd.isna(df.loc[str(date)]["lease_satisfied_time"])
+        else:
+            assert df.loc[str(date)]["lease_satisfied_time"] == lease_satisfied_time
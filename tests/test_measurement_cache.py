@@ -0,0 +1,89 @@
+"""
+Tests for the local measurement cache.
+"""
+from datetime import datetime
+import os
+import pandas as pd
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv, find_dotenv
+
+from src.data_loading import get_internal_temps
+from src.measurement_cache import MeasurementCache
+from src.synthetic_data import FLOOR_TEMPERATURE_MEASUREMENTS, generate_synthetic_data
+
+load_dotenv(find_dotenv(), verbose=True)
+
+
+def test_cache_matches_database(tmpdir):
+    db = create_engine(os.environ["HW_DATABASE_URL"])
+    cache = MeasurementCache(str(tmpdir))
+    assert cache.refresh(db, 37) > 0
+    for start_time, end_time in [("2018-02-04", "2018-02-06"), ("2018-02-05 00:00:00", "2018-02-05 00:00:00")]:
+        pd.testing.assert_frame_equal(
+            cache.get_internal_temps(37, start_time, end_time),
+            get_internal_temps(db, 37, start_time=start_time, end_time=end_time),
+        )
+    # Nothing new since the last refresh.
+    assert cache.refresh(db, 37) == 0
+
+
+def test_get_internal_temps_reads_from_cache(tmpdir):
+    db = create_engine(os.environ["HW_DATABASE_URL"])
+    cache = MeasurementCache(str(tmpdir))
+    cache.refresh(db, 37)
+    df = get_internal_temps(None, 37, start_time="2018-02-04", end_time="2018-02-06", cache=cache)
+    assert len(df) == 193
+    assert len(df.columns) == 9
+
+
+def test_refresh_picks_up_late_changes(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 14)
+    cache = MeasurementCache(os.path.join(str(tmpdir), "cache"))
+    assert cache.refresh(db, 1) > 0
+    assert cache.refresh(db, 1) == 0
+
+    def assert_cache_matches_database(day):
+        pd.testing.assert_frame_equal(
+            cache.get_internal_temps(1, day, day), get_internal_temps(db, 1, start_time=day, end_time=day)
+        )
+
+    # A reading that arrives behind the watermark, readings flagged as bad after they were cached, and a change too
+    # far back for the verify window.
+    with db.begin() as conn:
+        conn.execute(FLOOR_TEMPERATURE_MEASUREMENTS.insert(), [{
+            "building_sensor_config_id": 100001, "measured_at": datetime(2018, 3, 12, 9, 7),
+            "measurement": 71.5, "bad_data": False,
+        }])
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 "
+            "WHERE measured_at >= '2018-03-13 10:00:00' AND measured_at < '2018-03-13 12:00:00'"
+        ))
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 "
+            "WHERE measured_at >= '2018-03-02 10:00:00' AND measured_at < '2018-03-02 12:00:00'"
+        ))
+    n_rows = cache.refresh(db, 1, verify_days=7)
+    # The two days in the window are fetched again, nothing else.
+    assert 0 < n_rows < 3 * 24 * 4 * 10
+    assert_cache_matches_database("2018-03-12")
+    assert_cache_matches_database("2018-03-13")
+    assert not cache.get_internal_temps(1, "2018-03-02", "2018-03-02").equals(
+        get_internal_temps(db, 1, start_time="2018-03-02", end_time="2018-03-02")
+    )
+
+    assert cache.refresh(db, 1, verify_days=None) > 0
+    assert_cache_matches_database("2018-03-02")
+    assert cache.refresh(db, 1, verify_days=None) == 0
+
+
+def test_verify_fetches_nothing_for_unchanged_days(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 14)
+    # Readings with all the digits of a real column, not just one decimal.
+    with db.begin() as conn:
+        conn.execute(text("UPDATE floor_temperature_measurements SET measurement = measurement * 1.0000037 + 0.0123"))
+    cache = MeasurementCache(os.path.join(str(tmpdir), "cache"))
+    assert cache.refresh(db, 1) > 0
+    # Every cached day is verified against the database, none of them is fetched again.
+    assert cache.refresh(db, 1, verify_days=None) == 0
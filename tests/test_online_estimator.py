@@ -0,0 +1,93 @@
+"""
+Tests for the online lease satisfied time estimator.
+"""
+import numpy as np
+import pandas as pd
+
+from src.data_loading import get_lease_obligations
+from src.lease_calendar import LeaseCalendar
+from src.lease_satisfied_estimator import YourEstimator
+from src.online_estimator import OnlineLeaseSatisfiedEstimator
+from src.sensor_matrix import SensorMatrix
+
+
+def _readings():
+    rng = np.random.RandomState(0)
+    times = pd.date_range("2018-02-02", "2018-02-05 23:45", freq="15min")
+    frames = []
+    for sensor_id, offset in [(44, 0.), (45, 1.3), (46, -0.7), (99, 20.)]:
+        hours = np.asarray(times.hour + times.minute / 60.)
+        temperature = 62. + offset + 12. * np.clip((hours - 4.) / 8., 0., 1.) + rng.normal(0, 0.3, len(times))
+        frames.append(pd.DataFrame({"time": times, "sensor_id": sensor_id, "temperature": temperature.round(1)}))
+    readings = pd.concat(frames).sort_values("time", kind="mergesort").reset_index(drop=True)
+    # A gap and readings between the grid points.
+    readings = readings[~readings["time"].between("2018-02-05 06:00", "2018-02-05 07:00")]
+    readings.loc[readings["sensor_id"] == 45, "time"] += pd.Timedelta(minutes=4)
+    return readings.sort_values("time", kind="mergesort").reset_index(drop=True)
+
+
+def _batch_result(readings, estimation_date):
+    window = readings[readings["time"].between(estimation_date, estimation_date + " 23:00")]
+    df = window.pivot_table(index="time", columns="sensor_id", values="temperature", aggfunc="last")
+    matrix = SensorMatrix.from_frame(df, estimation_date, estimation_date + " 23:00")
+    estimator = YourEstimator.__new__(YourEstimator)
+    estimator.sensor_index = None
+    return estimator.estimate_from_temps(matrix, estimation_date)
+
+
+def test_replay_matches_batch():
+    readings = _readings()
+    online = OnlineLeaseSatisfiedEstimator(37, lease_calendar=LeaseCalendar(get_lease_obligations(37)))
+    events = []
+    for _, batch in readings.groupby(readings["time"].dt.floor("H")):
+        events.extend(online.update(batch))
+    events.extend(online.flush())
+
+    for estimation_date in ["2018-02-02", "2018-02-03", "2018-02-04", "2018-02-05"]:
+        assert online.result(estimation_date) == _batch_result(readings, estimation_date)
+    assert online.result("2018-02-06") == (None, None)
+    assert [event["date"] for event in events] == ["2018-02-02 00:00:00", "2018-02-05 00:00:00"]
+    assert list(online.results_frame()["operating"]) == [True, False, False, True]
+
+
+def test_out_of_order_sensors_match_batch():
+    readings = _readings()
+    # Sensor 44 reports every hour an hour late, after the others sent the next hour.
+    lagging = readings["sensor_id"] == 44
+    hours = readings["time"].dt.floor("H") + np.where(lagging, pd.Timedelta(hours=1), pd.Timedelta(0))
+    batches = [batch for _, batch in readings.groupby([hours, lagging])]
+
+    online = OnlineLeaseSatisfiedEstimator(
+        37, lease_calendar=LeaseCalendar(get_lease_obligations(37)), allowed_lateness="2H"
+    )
+    for batch in batches:
+        online.update(batch)
+    online.flush()
+    assert online.n_late == 0
+    for estimation_date in ["2018-02-02", "2018-02-03", "2018-02-04", "2018-02-05"]:
+        assert online.result(estimation_date) == _batch_result(readings, estimation_date)
+
+    impatient = OnlineLeaseSatisfiedEstimator(
+        37, lease_calendar=LeaseCalendar(get_lease_obligations(37)), allowed_lateness=0
+    )
+    for batch in batches:
+        impatient.update(batch)
+    assert impatient.n_late > 0
+
+
+def test_late_readings_are_dropped():
+    online = OnlineLeaseSatisfiedEstimator(
+        37, lease_calendar=LeaseCalendar(get_lease_obligations(37)), allowed_lateness=0
+    )
+    readings = pd.DataFrame(
+        {
+            "time": pd.to_datetime(["2018-02-05 10:00", "2018-02-05 10:15", "2018-02-05 10:30"]),
+            "sensor_id": [44, 44, 44],
+            "temperature": [60., 71., 72.],
+        }
+    )
+    assert online.update(readings.iloc[:1]) == []
+    events = online.update(readings.iloc[1:])
+    assert [event["lease_satisfied_time"] for event in events] == [pd.Timestamp("2018-02-05 10:15")]
+    assert online.update(readings.iloc[:1]) == []
+    assert online.n_late == 1
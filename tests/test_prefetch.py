@@ -0,0 +1,87 @@
+"""
+Tests for the prefetching fetch / estimate pipeline.
+"""
+import os
+import threading
+import time
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from src.lease_satisfied_estimator import YourEstimator
+from src.prefetch import run_prefetched
+from src.pushdown import PushdownEstimator
+from src.sensor_index import SensorQualityIndex
+from src.synthetic_data import generate_synthetic_data
+
+
+class _CountingEstimator(YourEstimator):
+    """
+    Tracks the number of chunks that were loaded but not estimated yet.
+    """
+
+    def __init__(self, *args, fail_on=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    def load_chunk(self, chunk):
+        if self.fail_on is not None and self.fail_on in chunk:
+            raise RuntimeError("fetch failed")
+        df_chunk = super().load_chunk(chunk)
+        with self.lock:
+            self.outstanding += 1
+            self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        return df_chunk
+
+    def estimate_chunk(self, chunk, df_chunk):
+        # Slow estimation, so the fetches run ahead as far as the queue lets them.
+        time.sleep(0.01)
+        with self.lock:
+            self.outstanding -= 1
+        return super().estimate_chunk(chunk, df_chunk)
+
+
+@pytest.fixture(scope="module")
+def db(tmpdir_factory):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir_factory.mktemp("prefetch")), "synthetic.db"))
+    generate_synthetic_data(db, [1, 2], 10, "2018-03-01", 14)
+    return db
+
+
+def test_prefetched_matches_serial(db):
+    estimators = [_CountingEstimator(building_id, db=db) for building_id in [1, 2]]
+    for estimator in estimators:
+        estimator.sensor_index = SensorQualityIndex(estimator.building_id).refresh(db)
+    tasks = [
+        (estimators[0], "2018-03-01", "2018-03-07"),
+        (estimators[0], "2018-03-08", "2018-03-14"),
+        (estimators[1], "2018-03-01", "2018-03-14"),
+        (PushdownEstimator(1, db=db, sensor_index=estimators[0].sensor_index), "2018-03-01", "2018-03-14"),
+    ]
+    results, failures = run_prefetched(tasks, prefetch=1, chunk_days=2)
+    assert failures == {}
+    for i, (estimator, start_date, end_date) in enumerate(tasks):
+        pd.testing.assert_frame_equal(
+            results[i], YourEstimator.compute_lease_satisfied_times(estimator, start_date, end_date, chunk_days=2)
+        )
+    # One chunk queued, one being fetched and one being estimated.
+    assert max(estimator.max_outstanding for estimator in estimators) <= 3
+
+
+def test_failed_task_does_not_stop_the_others(db):
+    tasks = [
+        (_CountingEstimator(1, db=db, fail_on=pd.Timestamp("2018-03-03")), "2018-03-01", "2018-03-06"),
+        (_CountingEstimator(2, db=db), "2018-03-01", "2018-03-06"),
+    ]
+    results, failures = run_prefetched(tasks, prefetch=2, chunk_days=2)
+    assert list(failures) == [0]
+    assert list(results) == [1]
+    assert len(results[1]) == 6
+
+
+def test_prefetch_must_be_positive():
+    with pytest.raises(ValueError):
+        run_prefetched([], prefetch=0)
@@ -0,0 +1,52 @@
+"""
+Tests for the pushdown execution mode, against synthetic data in a local SQLite database.
+"""
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from src.data_loading import get_lease_obligations
+from src.lease_calendar import LeaseCalendar
+from src.lease_satisfied_estimator import YourEstimator
+from src.pushdown import (
+    PushdownEstimator,
+    compare_pushdown_with_pandas,
+    get_lease_satisfied_times_pushdown,
+    get_lease_satisfied_windows,
+)
+from src.sensor_index import SensorQualityIndex
+from src.synthetic_data import generate_synthetic_data
+
+
+@pytest.fixture(scope="module")
+def db(tmpdir_factory):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir_factory.mktemp("pushdown")), "synthetic.db"))
+    generate_synthetic_data(db, [1], 30, "2018-03-01", 21)
+    return db
+
+
+@pytest.mark.parametrize("search_window", ["day", "operating"])
+def test_pushdown_matches_pandas(db, search_window):
+    sensor_ids = SensorQualityIndex(1).refresh(db).relevant_sensors
+    windows = get_lease_satisfied_windows(
+        LeaseCalendar(get_lease_obligations(1)), "2018-02-27", "2018-03-22", search_window
+    )
+    mismatches = compare_pushdown_with_pandas(db, 1, sensor_ids, windows, chunk_days=5)
+    assert mismatches.empty, mismatches
+    results = get_lease_satisfied_times_pushdown(db, 1, sensor_ids, windows, chunk_days=5)
+    # One row per day with data, none for the days before the data starts and after it ends.
+    assert list(results.index) == list(pd.date_range("2018-03-01", "2018-03-21"))
+    assert results["lease_satisfied_time"].notna().sum() >= 10
+
+
+def test_pushdown_estimator_matches_your_estimator(db):
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    me = YourEstimator(1, db=db, sensor_index=sensor_index)
+    pushdown = PushdownEstimator(1, db=db, sensor_index=sensor_index)
+    pd.testing.assert_frame_equal(
+        pushdown.compute_lease_satisfied_times("2018-02-27", "2018-03-22"),
+        me.compute_lease_satisfied_times("2018-02-27", "2018-03-22"),
+    )
+    for date in ["2018-02-28", "2018-03-04", "2018-03-05"]:
+        assert pushdown.compute_lease_satisfied_time(date) == me.compute_lease_satisfied_time(date)
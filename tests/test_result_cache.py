@@ -0,0 +1,87 @@
+"""
+Tests for the estimator result cache, against synthetic data in a local SQLite database.
+"""
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from src.lease_satisfied_estimator import YourEstimator
+from src.result_cache import ResultCache
+from src.sensor_index import SensorQualityIndex
+from src.synthetic_data import generate_synthetic_data
+
+
+@pytest.fixture
+def db(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 7)
+    return db
+
+
+@pytest.fixture
+def estimator(db):
+    return YourEstimator(1, db=db, sensor_index=SensorQualityIndex(1).refresh(db))
+
+
+def test_get_put_and_stats(tmpdir):
+    path = os.path.join(str(tmpdir), "results.sqlite")
+    cache = ResultCache(path)
+    satisfied = (True, pd.Timestamp("2018-03-01 08:15:00"))
+    assert cache.get(1, "2018-03-01", "a", "fp") is None
+    cache.put(1, "2018-03-01", "a", "fp", satisfied)
+    cache.put(1, "2018-03-03 00:00:00", "a", "fp", (False, "Not Satisfied"))
+    cache.put(1, "2018-03-04", "a", "0", (None, None))
+    assert cache.get(1, "2018-03-01 00:00:00", "a", "fp") == satisfied
+    assert cache.get(1, "2018-03-01", "b", "fp") is None
+    cache.close()
+
+    cache = ResultCache(path)
+    assert cache.get(1, "2018-03-01", "a", "fp") == satisfied
+    assert cache.get(1, "2018-03-01", "a", "fp") == satisfied
+    assert cache.get(1, "2018-03-03", "a", "fp") == (False, "Not Satisfied")
+    assert cache.get(1, "2018-03-04", "a", "0") == (None, None)
+    # A changed fingerprint invalidates the stored result.
+    assert cache.get(1, "2018-03-03", "a", "changed") is None
+    assert cache.get(1, "2018-03-03", "a", "fp") is None
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1
+    assert stats["disk_hits"] == 3
+    assert stats["stale"] == 1
+    assert stats["misses"] == 2
+    assert stats["hit_rate"] == pytest.approx(4 / 6.)
+
+
+def test_eviction(tmpdir):
+    cache = ResultCache(os.path.join(str(tmpdir), "results.sqlite"), max_entries=2, max_disk_bytes=100)
+    for day in range(1, 6):
+        cache.put(1, "2018-03-0{}".format(day), "a", "fp", (True, "Not Satisfied"))
+    stats = cache.stats()
+    assert stats["memory_entries"] == 2
+    assert 0 < stats["disk_bytes"] <= 100
+    # The most recent results are still stored, the oldest were evicted.
+    assert cache.get(1, "2018-03-05", "a", "fp") == (True, "Not Satisfied")
+    assert cache.get(1, "2018-03-01", "a", "fp") is None
+    assert stats["evictions"] > 3
+
+
+def test_get_or_compute(db, estimator, tmpdir):
+    cache = ResultCache(os.path.join(str(tmpdir), "results.sqlite"))
+    expected = estimator.compute_lease_satisfied_time("2018-03-05 00:00:00")
+    assert cache.get_or_compute(estimator, "2018-03-05") == expected
+    assert cache.get_or_compute(estimator, "2018-03-05") == expected
+    assert cache.stats()["memory_hits"] == 1
+
+    pd.testing.assert_frame_equal(
+        cache.get_or_compute_range(estimator, "2018-03-01", "2018-03-08"),
+        estimator.compute_lease_satisfied_times("2018-03-01", "2018-03-08"),
+    )
+    assert cache.stats()["memory_hits"] == 2
+
+    with db.begin() as conn:
+        conn.execute(text("UPDATE floor_temperature_measurements SET bad_data = 1 WHERE measured_at < '2018-03-02'"))
+    cache.get_or_compute_range(estimator, "2018-03-01", "2018-03-08")
+    stats = cache.stats()
+    assert stats["stale"] == 1
+    assert stats["memory_hits"] == 9
+    assert cache.get_or_compute(estimator, "2018-03-01") == (None, None)
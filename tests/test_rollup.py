@@ -0,0 +1,125 @@
+"""
+Tests for the materialized slot rollup, against synthetic data in a local SQLite database.
+"""
+from datetime import datetime
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from src.lease_satisfied_estimator import YourEstimator
+from src.rollup import RollupEstimator, SlotRollup
+from src.sensor_index import SensorQualityIndex
+from src.sensor_matrix import get_internal_temp_matrix
+from src.synthetic_data import FLOOR_TEMPERATURE_MEASUREMENTS, generate_synthetic_data
+
+
+def _assert_same_results(db, rollup, sensor_index, start_date, end_date):
+    expected = YourEstimator(1, db=db, sensor_index=sensor_index).compute_lease_satisfied_times(start_date, end_date)
+    df = RollupEstimator(1, db=db, sensor_index=sensor_index, rollup=rollup).compute_lease_satisfied_times(
+        start_date, end_date
+    )
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def test_slot_statistics(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 12, "2018-03-01", 3)
+    relevant = {100000, 100003, 100004, 100007}
+    rollup = SlotRollup(os.path.join(str(tmpdir), "rollup"))
+    assert rollup.refresh(db, 1, relevant) == 3
+
+    slots = rollup.get_slots(1, pd.Timestamp("2018-03-02"), pd.Timestamp("2018-03-02 23:45"))
+    # Over the day window.
+    matrix = get_internal_temp_matrix(db, 1, "2018-03-02 00:00:00", "2018-03-02 23:00:00")
+    values = pd.DataFrame(
+        np.where(matrix.mask, matrix.values.astype(np.float64), np.nan).T,
+        index=matrix.times, columns=matrix.sensor_ids,
+    )
+    values = values[values.notnull().any(axis=1)]
+    relevant_values = values[sorted(relevant & set(matrix.sensor_ids))]
+    assert slots.index.equals(values.index)
+    np.testing.assert_array_equal(slots["n_all"], values.count(axis=1))
+    np.testing.assert_array_equal(slots["n"], relevant_values.count(axis=1))
+    np.testing.assert_array_equal(slots["sum"] / slots["n"], matrix.select(relevant).mean()[matrix.count() > 0])
+    np.testing.assert_allclose(slots["sum_sq"], (relevant_values ** 2).sum(axis=1))
+    np.testing.assert_array_equal(slots["min"], relevant_values.min(axis=1))
+    np.testing.assert_array_equal(slots["max"], relevant_values.max(axis=1))
+    np.testing.assert_array_equal(
+        slots["n_in_band"], ((relevant_values >= 70.) & (relevant_values <= 75.)).sum(axis=1)
+    )
+
+    # A rollup over other sensors is rebuilt.
+    assert rollup.refresh(db, 1, relevant | {100001}) == 3
+
+
+def test_rollup_refresh_is_incremental(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 20, "2018-03-01", 21)
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    rollup = SlotRollup(os.path.join(str(tmpdir), "rollup"))
+
+    # The last week has not landed yet.
+    late_query = "SELECT * FROM floor_temperature_measurements WHERE measured_at >= '2018-03-15'"
+    late_rows = pd.read_sql(late_query, db)
+    with db.begin() as conn:
+        conn.execute(text("DELETE FROM floor_temperature_measurements WHERE measured_at >= '2018-03-15'"))
+    assert rollup.refresh(db, 1, sensor_index.relevant_sensors) == 14
+    _assert_same_results(db, rollup, sensor_index, "2018-03-01", "2018-03-21")
+
+    late_rows.to_sql("floor_temperature_measurements", db, if_exists="append", index=False)
+    assert rollup.refresh(db, 1, sensor_index.relevant_sensors) == 7
+    assert rollup.refresh(db, 1, sensor_index.relevant_sensors) == 0
+    _assert_same_results(db, rollup, sensor_index, "2018-03-01", "2018-03-21")
+
+    # Readings flagged as bad after the day was rolled up.
+    with db.begin() as conn:
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 "
+            "WHERE measured_at >= '2018-03-05 12:00:00' AND measured_at < '2018-03-05 15:00:00'"
+        ))
+    assert rollup.refresh(db, 1, sensor_index.relevant_sensors) == 1
+    _assert_same_results(db, rollup, sensor_index, "2018-03-01", "2018-03-21")
+    assert RollupEstimator(1, db=db, sensor_index=sensor_index, rollup=rollup).compute_lease_satisfied_time(
+        "2018-03-05"
+    ) == YourEstimator(1, db=db, sensor_index=sensor_index).compute_lease_satisfied_time("2018-03-05")
+
+
+def test_readings_after_the_day_window_are_left_out(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 3)
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    sensor_id = min(sensor_index.relevant_sensors)
+    # Floored onto the 23:00 slot, but after the end of the day window.
+    with db.begin() as conn:
+        conn.execute(FLOOR_TEMPERATURE_MEASUREMENTS.insert(), [{
+            "building_sensor_config_id": sensor_id, "measured_at": datetime(2018, 3, 2, 23, 5),
+            "measurement": 99., "bad_data": False,
+        }])
+    rollup = SlotRollup(os.path.join(str(tmpdir), "rollup"))
+    rollup.refresh(db, 1, sensor_index.relevant_sensors)
+
+    slots = rollup.get_slots(1, pd.Timestamp("2018-03-02 23:00"), pd.Timestamp("2018-03-02 23:45"))
+    matrix = get_internal_temp_matrix(db, 1, "2018-03-02 00:00:00", "2018-03-02 23:00:00").select(
+        set(sensor_index.relevant_sensors)
+    )
+    assert list(slots.index) == [pd.Timestamp("2018-03-02 23:00")]
+    assert slots["max"].iloc[0] < 99.
+    assert slots["sum"].iloc[0] / slots["n"].iloc[0] == matrix.mean()[-1]
+    estimator = RollupEstimator(1, db=db, sensor_index=sensor_index, rollup=rollup)
+    assert estimator.compute_lease_satisfied_time("2018-03-02") == YourEstimator(
+        1, db=db, sensor_index=sensor_index
+    ).compute_lease_satisfied_time("2018-03-02")
+
+
+def test_rollup_over_other_sensors_is_rejected(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 3)
+    sensor_index = SensorQualityIndex(1).refresh(db)
+    rollup = SlotRollup(os.path.join(str(tmpdir), "rollup"))
+    rollup.refresh(db, 1, set(sensor_index.relevant_sensors) - {min(sensor_index.relevant_sensors)})
+    with pytest.raises(ValueError):
+        RollupEstimator(1, db=db, sensor_index=sensor_index, rollup=rollup).compute_lease_satisfied_times(
+            "2018-03-01", "2018-03-03"
+        )
@@ -0,0 +1,119 @@
+"""
+Tests for the historical estimation script, against synthetic data in a local SQLite database.
+"""
+import os
+import sys
+from click.testing import CliRunner
+import yaml
+from sqlalchemy import create_engine, text
+
+from src.lease_satisfied_estimator import YourEstimator
+from src.synthetic_data import generate_synthetic_data
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import run_historical_estimation  # noqa: E402
+
+
+def _write_config(tmpdir, name, **settings):
+    config = dict(
+        buildings=[1, 2],
+        start_date="2018-03-01",
+        end_date="2018-03-14",
+        error_analysis_dir=os.path.join(str(tmpdir), name),
+        database={"url": "sqlite:///" + os.path.join(str(tmpdir), "synthetic.db")},
+        **settings
+    )
+    path = os.path.join(str(tmpdir), name + ".yml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path, config["error_analysis_dir"]
+
+
+def _run(config_file, *args):
+    return CliRunner().invoke(
+        run_historical_estimation.estimate_lease_satisfied_times, [config_file, "--overwrite"] + list(args)
+    )
+
+
+def _read_csvs(error_analysis_dir):
+    csvs = {}
+    for building_id in [1, 2]:
+        path = os.path.join(error_analysis_dir, "lease_obligation_satisfied_times_{}.csv".format(building_id))
+        with open(path, "rb") as f:
+            csvs[building_id] = f.read()
+    return csvs
+
+
+def test_workers_write_the_same_csvs_as_a_serial_run(tmpdir):
+    generate_synthetic_data(create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db")), [1, 2], 10,
+                            "2018-03-01", 14)
+    serial_config, serial_dir = _write_config(tmpdir, "serial")
+    result = _run(serial_config, "--workers", "1", "--shard-days", "7")
+    assert result.exit_code == 0, result.output
+    parallel_config, parallel_dir = _write_config(tmpdir, "parallel")
+    result = _run(parallel_config, "--workers", "2", "--shard-days", "4")
+    assert result.exit_code == 0, result.output
+    assert _read_csvs(parallel_dir) == _read_csvs(serial_dir)
+
+
+def test_failing_shard_is_reported(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1, 2], 10, "2018-03-01", 14)
+    # The workers open the database themselves, so the failure is planted there rather than patched into this
+    # process: an unparseable reading of building 2 breaks only the shard that loads 2018-03-09.
+    with db.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO floor_temperature_measurements (building_sensor_config_id, measured_at, measurement, bad_data) "
+            "VALUES (200000, '2018-03-09 1O:00:00', 70.0, 0)"
+        ))
+    config_file, error_analysis_dir = _write_config(tmpdir, "failing")
+    result = _run(config_file, "--workers", "2", "--shard-days", "7")
+    assert result.exit_code == 1
+    assert "1 of 4 shards failed" in result.output
+    assert "(2, '2018-03-08', '2018-03-14')" in result.output
+    # The other shards finished and were written.
+    csvs = _read_csvs(error_analysis_dir)
+    assert csvs[1].count(b"\n") == 15
+    assert csvs[2].count(b"\n") == 8
+
+
+def test_profile_keeps_the_slowest_building(tmpdir):
+    generate_synthetic_data(create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db")), [1, 2], 10,
+                            "2018-03-01", 14)
+    for workers in ["1", "2"]:
+        config_file, error_analysis_dir = _write_config(tmpdir, "profiled_" + workers)
+        result = _run(config_file, "--workers", workers, "--shard-days", "7", "--profile")
+        assert result.exit_code == 0, result.output
+        files = sorted(os.listdir(error_analysis_dir))
+        profiles = [name for name in files if name.startswith("profile_building_")]
+        # Profiled during the run, one building, no leftover shard profiles.
+        assert len(profiles) == 2
+        assert profiles[0].endswith(".prof") and profiles[1].endswith(".txt")
+        assert all(not os.path.isdir(os.path.join(error_analysis_dir, name)) for name in files)
+        with open(os.path.join(error_analysis_dir, profiles[1])) as f:
+            assert "compute_lease_satisfied_times" in f.read()
+
+
+def test_only_resume_fingerprints(tmpdir, monkeypatch):
+    generate_synthetic_data(create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db")), [1, 2], 10,
+                            "2018-03-01", 14)
+    config_file, error_analysis_dir = _write_config(tmpdir, "resumed")
+
+    def unexpected(*args):
+        raise AssertionError("Unexpected call")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(run_historical_estimation, "get_day_fingerprints", unexpected)
+        result = _run(config_file, "--shard-days", "7")
+        assert result.exit_code == 0, result.output
+    csvs = _read_csvs(error_analysis_dir)
+
+    # Days checkpointed without fingerprints are computed again, after that nothing is left to compute.
+    args = [config_file, "--resume", "--shard-days", "7"]
+    result = CliRunner().invoke(run_historical_estimation.estimate_lease_satisfied_times, args)
+    assert result.exit_code == 0, result.output
+    monkeypatch.setattr(YourEstimator, "load_chunk", unexpected)
+    result = CliRunner().invoke(run_historical_estimation.estimate_lease_satisfied_times, args)
+    assert result.exit_code == 0, result.output
+    assert _read_csvs(error_analysis_dir) == csvs
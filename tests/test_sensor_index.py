@@ -0,0 +1,123 @@
+"""
+Tests for the sensor quality index.
+"""
+from datetime import datetime
+import os
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv, find_dotenv
+
+from src.sensor_index import SENSOR_STATS_QUERY, SUM_COLUMNS, SensorQualityIndex, get_sensor_index
+from src.synthetic_data import FLOOR_TEMPERATURE_MEASUREMENTS, generate_synthetic_data
+
+load_dotenv(find_dotenv(), verbose=True)
+
+
+def _sums(n, values, building_means):
+    x, m = pd.Series(values), pd.Series(building_means)
+    return [n, x.sum(), (x * x).sum(), m.sum(), (m * m).sum(), (x * m).sum(), 0, 0]
+
+
+def test_relevant_sensors():
+    building_means = [70., 71., 72., 73.]
+    index = SensorQualityIndex(1)
+    index.n_times = 4
+    index.active_sensors = [1, 2, 3, 4]
+    index.sums = pd.DataFrame.from_dict(
+        {
+            1: _sums(4, [69.5, 71., 72.5, 73.], building_means),
+            # flat
+            2: _sums(4, [71., 71., 71., 71.], building_means),
+            # anti correlated
+            3: _sums(4, [74., 73., 72., 70.], building_means),
+            # only reported once
+            4: _sums(1, [70.], building_means[:1]),
+        },
+        orient="index",
+        columns=SUM_COLUMNS,
+    )
+    stats = index.stats()
+    assert stats.loc[1, "correlation"] > 0.9
+    assert pd.isna(stats.loc[2, "correlation"])
+    assert stats.loc[3, "correlation"] < 0
+    assert stats.loc[4, "coverage"] == 0.25
+    assert index.relevant_sensors == frozenset([1])
+
+
+def test_save_and_load(tmpdir):
+    index = SensorQualityIndex(1)
+    index.n_times = 4
+    index.watermark = "2018-02-05 00:00:00"
+    index.sums = pd.DataFrame.from_dict(
+        {1: _sums(4, [69.5, 71., 72.5, 73.], [70., 71., 72., 73.])}, orient="index", columns=SUM_COLUMNS
+    ).astype(float)
+    path = str(tmpdir.join("index.json"))
+    index.save(path)
+    loaded = SensorQualityIndex.load(path, 1)
+    pd.testing.assert_frame_equal(loaded.stats(), index.stats(), check_names=False)
+    assert loaded.watermark == index.watermark
+    # Built with other limits, so it starts over.
+    assert SensorQualityIndex.load(path, 1, thresholds={"max_plausible_temp": 90.}).watermark is None
+
+
+def test_incremental_refresh(tmpdir):
+    db = create_engine(os.environ["HW_DATABASE_URL"])
+    full = SensorQualityIndex(37).refresh(db, end_time=datetime(2018, 3, 1))
+    incremental = SensorQualityIndex(37).refresh(db, end_time=datetime(2018, 2, 1))
+    incremental.refresh(db, end_time=datetime(2018, 3, 1))
+    assert (incremental.stats()["n"] == full.stats()["n"]).all()
+    assert incremental.watermark == full.watermark
+    index = get_sensor_index(str(tmpdir), 37, db=db)
+    assert get_sensor_index(str(tmpdir), 37, refresh=False).relevant_sensors == index.relevant_sensors
+
+
+def test_stats_of_single_precision_readings(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 1)
+    # Readings as a real column returns them, around 68.7 with a small spread. Summed in single precision the
+    # spread is lost in E[x^2] - E[x]^2.
+    rng = np.random.RandomState(0)
+    values = (68.7 + 0.05 * rng.randn(2000)).astype(np.float32)
+    with db.begin() as conn:
+        conn.execute(text("DELETE FROM floor_temperature_measurements"))
+        conn.execute(FLOOR_TEMPERATURE_MEASUREMENTS.insert(), [
+            {
+                "building_sensor_config_id": 100000, "measured_at": datetime(2018, 3, 1) + pd.Timedelta(minutes=i),
+                "measurement": float(value), "bad_data": False,
+            }
+            for i, value in enumerate(values)
+        ])
+    stats = SensorQualityIndex(1).refresh(db, end_time=datetime(2018, 3, 5)).stats()
+    assert np.isclose(stats.loc[100000, "std"], values.astype(np.float64).std(), rtol=1e-6)
+    # Postgres sums a real column as a real.
+    assert "CAST(f1.measurement AS DOUBLE PRECISION)" in str(SENSOR_STATS_QUERY)
+
+
+def test_refresh_picks_up_late_changes(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1], 10, "2018-03-01", 14)
+    end_time = datetime(2018, 3, 20)
+    index = SensorQualityIndex(1).refresh(db, end_time=end_time, verify_days=7)
+    n = index.stats()["n"]
+    assert index.settled_until == "2018-03-07 00:00:00"
+
+    # Readings flagged as bad after they were aggregated, in the trailing days and before them.
+    with db.begin() as conn:
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 WHERE building_sensor_config_id = 100000 "
+            "AND measured_at >= '2018-03-12 10:00:00' AND measured_at < '2018-03-12 12:00:00'"
+        ))
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 WHERE building_sensor_config_id = 100001 "
+            "AND measured_at >= '2018-03-02 10:00:00' AND measured_at < '2018-03-02 12:00:00'"
+        ))
+    index.refresh(db, end_time=end_time, verify_days=7)
+    assert index.stats().loc[100000, "n"] == n[100000] - 8
+    assert index.stats().loc[100001, "n"] == n[100001]
+
+    path = str(tmpdir.join("index.json"))
+    index.save(path)
+    loaded = SensorQualityIndex.load(path, 1)
+    assert loaded.settled_until == index.settled_until
+    pd.testing.assert_frame_equal(loaded.refresh(db, end_time=end_time, verify_days=7).stats(), index.stats())
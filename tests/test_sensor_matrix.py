@@ -0,0 +1,81 @@
+"""
+Tests for the compact sensor matrix.
+"""
+import numpy as np
+import pandas as pd
+
+from src.lease_satisfied_estimator import getPred2, operatingDayCheck
+from src.sensor_matrix import SensorMatrix
+
+
+def _temps():
+    times = pd.date_range("2018-02-05", "2018-02-05 23:00", freq="15min")
+    df = pd.DataFrame(
+        {
+            44: np.linspace(65., 74., len(times)).round(1),
+            45: np.linspace(66., 75., len(times)).round(1),
+            99: np.full(len(times), 90.),
+        },
+        index=pd.Index(times, name="time"),
+    )
+    df.columns.name = "sensor_id"
+    df.iloc[:10, 1] = np.nan
+    return df.drop(df.index[20:24])
+
+
+def test_from_frame():
+    df = _temps()
+    matrix = SensorMatrix.from_frame(df)
+    assert matrix.values.dtype == np.float32
+    assert matrix.values.shape == (3, 93)
+    assert list(matrix.sensor_ids) == [44, 45, 99]
+    assert matrix.mask.sum() == df.notna().values.sum()
+    assert (matrix.valid_times() == df.index).all()
+    pd.testing.assert_frame_equal(matrix.to_frame(), df.astype(np.float32))
+
+
+def test_mean():
+    df = _temps()
+    matrix = SensorMatrix.from_frame(df)
+    mean = pd.Series(matrix.mean(sensor_chunk=2), index=matrix.times).dropna()
+    np.testing.assert_allclose(mean.values, df.mean(axis=1).values, rtol=1e-6)
+    assert np.isnan(matrix.mean()[20:24]).all()
+
+
+def test_off_grid_readings_are_floored():
+    df = pd.DataFrame({1: [70., 71.]}, index=pd.DatetimeIndex(["2018-02-05 00:00", "2018-02-05 00:17"]))
+    matrix = SensorMatrix.from_frame(df, "2018-02-05 00:00", "2018-02-05 00:30")
+    assert list(matrix.values[0][:2]) == [70., 71.]
+    assert np.isnan(matrix.values[0][2])
+
+
+def test_off_grid_and_duplicate_slot_readings():
+    df = pd.DataFrame(
+        {
+            1: [69., np.nan, 70.5, np.nan, 72.],
+            2: [np.nan, 71., np.nan, 68., np.nan],
+        },
+        index=pd.DatetimeIndex(
+            ["2018-02-05 09:00", "2018-02-05 09:07", "2018-02-05 09:10", "2018-02-05 09:20", "2018-02-05 09:40"],
+            name="time",
+        ),
+    )
+    matrix = SensorMatrix.from_frame(df, "2018-02-05 09:00", "2018-02-05 09:45")
+    # The 09:10 reading of sensor 1 replaces the one at 09:00, both of sensor 2 go to their slot.
+    np.testing.assert_array_equal(matrix.values[0], [70.5, np.nan, 72., np.nan])
+    np.testing.assert_array_equal(matrix.values[1], [71., 68., np.nan, np.nan])
+    np.testing.assert_array_equal(matrix.mean(), [70.75, 68., 72., np.nan])
+    # The slot of 09:00 is in band on the matrix, the DataFrame first is at the 09:07 reading.
+    assert getPred2(matrix, {1, 2}) == pd.Timestamp("2018-02-05 09:00")
+    assert getPred2(df, {1, 2}) == pd.Timestamp("2018-02-05 09:07")
+
+
+def test_estimator_functions_accept_matrix():
+    df = _temps()
+    matrix = SensorMatrix.from_frame(df)
+    assert getPred2(matrix, {44, 45}) == getPred2(df, {44, 45})
+    assert getPred2(matrix.select({99}), {99}) == "Not Satisfied"
+    assert operatingDayCheck(matrix, "2018-02-05") == True
+    day = matrix.time_slice("2018-02-05 05:00", "2018-02-05 06:00")
+    assert len(day.times) == 5
+    assert operatingDayCheck(day.select(set()), "2018-02-05") is None
@@ -0,0 +1,151 @@
+"""
+Tests for the estimation service, against synthetic data in a local SQLite database.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import pytest
+from sqlalchemy import create_engine, text
+
+from src import result_cache as result_cache_module, service as service_module
+from src.data_loading import get_lease_obligation_schedule
+from src.lease_calendar import get_lease_calendar
+from src.lease_satisfied_estimator import YourEstimator
+from src.service import EstimationService, LatencyTracker, make_server
+from src.synthetic_data import generate_synthetic_data
+
+
+def _get(url, data=None):
+    request = Request(url, data=json.dumps(data).encode("utf-8") if data is not None else None)
+    with urlopen(request) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+@pytest.fixture
+def served(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    generate_synthetic_data(db, [1, 2], 10, "2018-03-01", 14)
+    service = EstimationService({"buildings": [1, 2]}, db=db)
+    server = make_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield db, service, "http://127.0.0.1:{}".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_latency_tracker():
+    latencies = LatencyTracker(window=100)
+    for i in range(1, 201):
+        latencies.record("estimate", i / 1000.)
+    stats = latencies.percentiles()["estimate"]
+    assert stats["requests"] == 200
+    assert stats["max_ms"] == 200.
+    assert 149. < stats["p50_ms"] < 151.
+    assert stats["p50_ms"] < stats["p90_ms"] < stats["p99_ms"] <= stats["max_ms"]
+
+
+def test_service_answers_queries(served):
+    db, service, url = served
+    expected = YourEstimator(1, db=db).compute_lease_satisfied_times("2018-03-01", "2018-03-14")
+
+    def as_expected(date):
+        operating, lease_satisfied_time = expected.loc[date, ["operating", "lease_satisfied_time"]]
+        if lease_satisfied_time is not None and lease_satisfied_time != "Not Satisfied":
+            lease_satisfied_time = str(lease_satisfied_time)
+        return {"building_id": 1, "date": date, "operating": operating, "lease_satisfied_time": lease_satisfied_time}
+
+    assert _get(url + "/estimate?building_id=1&date=2018-03-05") == as_expected("2018-03-05 00:00:00")
+    records = _get(url + "/estimates?building_id=1&start_date=2018-03-01&end_date=2018-03-14")
+    assert records == [as_expected(date) for date in expected.index]
+
+    queries = [{"building_id": 1, "date": date} for date in ["2018-03-09", "2018-03-02", "2018-03-10", "2018-03-09"]]
+    records = _get(url + "/estimates", {"queries": queries + [{"building_id": 2, "date": "2018-03-09"}]})
+    assert records[:4] == [as_expected(query["date"] + " 00:00:00") for query in queries]
+    assert records[4]["building_id"] == 2
+
+    # Concurrent queries over both buildings, answered from the warm caches.
+    with ThreadPoolExecutor(8) as executor:
+        records = list(executor.map(
+            lambda i: _get(url + "/estimate?building_id={}&date=2018-03-{:02d}".format(1 + i % 2, 1 + i % 14)),
+            range(56),
+        ))
+    assert [record for record in records if record["building_id"] == 1] == [
+        as_expected("2018-03-{:02d} 00:00:00".format(1 + i % 14)) for i in range(0, 56, 2)
+    ]
+
+    stats = _get(url + "/stats")
+    assert stats["buildings"] == [1, 2]
+    assert stats["latency"]["estimate"]["requests"] == 57
+    assert stats["result_cache"]["hit_rate"] > 0.5
+    assert service.refresh() is False
+
+
+def test_refresh_answers_queries_meanwhile_and_swaps_in_one_step(served, monkeypatch):
+    db, service, url = served
+    before = _get(url + "/estimate?building_id=1&date=2018-03-05")
+    answered = []
+
+    def refresh_local_stores(config, building_id, db=None):
+        # A query for the building being refreshed is answered, from the old estimator.
+        query = threading.Thread(target=lambda: answered.append(service.estimate(building_id, "2018-03-05")))
+        query.start()
+        query.join(10)
+        assert not query.is_alive()
+        return {"new_rows": None, "relevant_sensors": None, "rollup_days": None}
+
+    monkeypatch.setattr(service_module, "refresh_local_stores", refresh_local_stores)
+    assert service.refresh() is False
+    assert answered[0] == before
+    assert service.stats()["buildings"] == [1, 2]
+
+    # Changed lease obligations drop the estimators, results and lease calendars.
+    schedule = get_lease_obligation_schedule(1)
+    schedule["upper_operating_temp"] += 1.
+    monkeypatch.setattr(service_module, "get_lease_obligation_schedule", lambda building_id: schedule)
+    assert service.refresh() is True
+    assert service.stats()["buildings"] == []
+    assert service.result_cache.stats()["memory_entries"] == 0
+    assert get_lease_calendar.cache_info().currsize == 0
+
+
+def test_hits_do_not_query_the_database(served, monkeypatch):
+    db, service, _ = served
+    records = service.estimate_range(1, "2018-03-01", "2018-03-07")
+
+    def unexpected(*args):
+        raise AssertionError("Unexpected call")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(service_module, "get_day_fingerprints", unexpected)
+        patched.setattr(result_cache_module, "get_day_fingerprints", unexpected)
+        assert service.estimate(1, "2018-03-05") == records[4]
+        assert service.estimate_range(1, "2018-03-01", "2018-03-07") == records
+
+    # Changed data is picked up on the next refresh.
+    with db.begin() as conn:
+        conn.execute(text(
+            "UPDATE floor_temperature_measurements SET bad_data = 1 "
+            "WHERE measured_at >= '2018-03-05 08:00:00' AND measured_at < '2018-03-05 12:00:00'"
+        ))
+    assert service.refresh() is True
+    stale = service.result_cache.stats()["stale"]
+    service.estimate(1, "2018-03-05")
+    assert service.result_cache.stats()["stale"] == stale + 1
+    assert service.refresh() is False
+
+
+def test_service_rejects_invalid_queries(served):
+    _, _, url = served
+    for query in ["/estimate?building_id=1", "/estimate?building_id=3&date=2018-03-05",
+                  "/estimate?building_id=1&date=yesterday-ish",
+                  "/estimates?building_id=1&start_date=2018-03-05&end_date=2018-03-01"]:
+        with pytest.raises(HTTPError) as e:
+            _get(url + query)
+        assert e.value.code == 400
+        assert "error" in json.loads(e.value.read().decode("utf-8"))
+    with pytest.raises(HTTPError) as e:
+        _get(url + "/unknown")
+    assert e.value.code == 404
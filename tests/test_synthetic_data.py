@@ -0,0 +1,44 @@
+"""
+Tests for the synthetic data generator, against a local SQLite database.
+"""
+import os
+import pandas as pd
+from sqlalchemy import create_engine
+
+from src.data_loading import get_internal_temps
+from src.synthetic_data import generate_synthetic_data
+
+
+def test_generate_synthetic_data(tmpdir):
+    db = create_engine("sqlite:///" + os.path.join(str(tmpdir), "synthetic.db"))
+    summary = generate_synthetic_data(
+        db, [1, 2], 20, "2018-02-05", 3, ignored_rate=0.2, bad_data_rate=0.05, days_per_batch=2
+    )
+    assert summary["sensors"] == 40
+    assert summary["ignored_sensors"] > 0
+    assert summary["bad_rows"] > 0
+
+    counts = pd.read_sql(
+        "SELECT COUNT(*) as n, SUM(CASE WHEN bad_data THEN 1 ELSE 0 END) as n_bad FROM floor_temperature_measurements",
+        db,
+    )
+    assert counts["n"].iloc[0] == summary["rows"]
+    assert counts["n_bad"].iloc[0] == summary["bad_rows"]
+    # 3 days at a 15 minute cadence, with 1% of the readings missing.
+    assert 0.95 * 40 * 3 * 96 < summary["rows"] < 40 * 3 * 96
+
+    sensors = pd.read_sql("SELECT * FROM building_sensor_configs WHERE building_id = 1", db)
+    df = get_internal_temps(db, 1, "2018-02-05", "2018-02-05")
+    assert len(df) == 96
+    assert set(df.columns) <= set(sensors["id"][~sensors["ignore"].astype(bool)])
+    # Bad data is filtered out, so the garbage values never show up.
+    assert df.min().min() > 40.
+
+
+def test_generate_synthetic_data_is_reproducible(tmpdir):
+    frames = []
+    for name in ["a", "b"]:
+        db = create_engine("sqlite:///" + os.path.join(str(tmpdir), name + ".db"))
+        generate_synthetic_data(db, [1], 5, "2018-02-05", 1, seed=3)
+        frames.append(pd.read_sql("SELECT * FROM floor_temperature_measurements", db))
+    pd.testing.assert_frame_equal(frames[0], frames[1])